@@ -282,13 +282,17 @@ class XRF_scanliveview():
         #grid_x, grid_y = np.mgrid[xmin:xmax:nx*1j, ymin:ymax:ny*1j]
         grid_y, grid_x = np.mgrid[ymin:ymax:ny*1j, xmin:xmax:nx*1j]
 
-        # interpolate the map for each ROI
+        # interpolate the maps of all ROIs with the same number of valid
+        # points in one go, each over all of its own points
+        batches = {}
         for key in self.ROIs.keys():
-            values = np.array(self.element_data[key])
-            lpos = len(positions)
-            ldat = len(values)
-            l = min(lpos,ldat)
-            self.element_maps[key] = griddata(positions[:l], values[:l], (grid_y, grid_x), method='nearest')
+            l = min(lpos, len(self.element_data[key]))
+            batches.setdefault(l, []).append(key)
+        for l, keys in batches.items():
+            values = np.array([self.element_data[key][:l] for key in keys]).T
+            maps = griddata(positions[:l], values, (grid_y, grid_x), method='nearest')
+            for i, key in enumerate(keys):
+                self.element_maps[key] = maps[..., i]
 
     def add_new_spectrum(self, new_spectrum):
         # update the last buffered spectrum
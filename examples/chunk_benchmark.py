@@ -0,0 +1,55 @@
+"""
+Benchmark of the chunk shapes chosen by Scan.export for each access
+pattern. A dummy scan is exported once per access hint, then the time
+is measured for reading whole frames (as when browsing images) and for
+reading all positions of a small pixel or channel region (as when
+building maps).
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+import h5py
+from nmutils.core import dummyScan
+
+N_FRAMES = 20 # random frames read per test
+REPEATS = 3   # best of this many runs
+
+def best(func):
+    times = []
+    for i in range(REPEATS):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return min(times)
+
+# a 2D scan with 2D detector frames, and one with spectra
+xrd = dummyScan()
+xrd.addData(dataSource='fake-xrd', stepsize=8, framesize=128, name='xrd')
+xrf = dummyScan()
+xrf.addData(dataSource='fake-xrf', stepsize=4, framesize=256, name='xrf')
+cases = [(xrd, 'xrd', (slice(60, 68), slice(60, 68))),
+         (xrf, 'xrf', (slice(100, 116),))]
+
+print('%-5s %-9s %-22s %12s %12s' % ('data', 'access', 'chunks', 'frames (s)', 'map (s)'))
+tmpdir = tempfile.mkdtemp()
+for scan, name, roi in cases:
+    for access in ('frames', 'maps', 'balanced'):
+        fn = os.path.join(tmpdir, '%s_%s.h5' % (name, access))
+        scan.export(fn, method='none', access=access)
+        with h5py.File(fn, 'r') as fp:
+            dset = fp['entry0/data/' + name]
+            rows = np.sort(np.random.choice(dset.shape[0], N_FRAMES, replace=False))
+            # reopen for every run, so that the chunk cache starts empty
+            def frames():
+                with h5py.File(fn, 'r') as f:
+                    d = f['entry0/data/' + name]
+                    for i in rows:
+                        d[i]
+            def roiMap():
+                with h5py.File(fn, 'r') as f:
+                    np.sum(f['entry0/data/' + name][(slice(None),) + roi], axis=tuple(range(1, len(roi) + 1)))
+            print('%-5s %-9s %-22s %12.4f %12.4f' % (name, access, dset.chunks, best(frames), best(roiMap)))
+        os.remove(fn)
+os.rmdir(tmpdir)
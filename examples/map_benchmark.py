@@ -0,0 +1,39 @@
+"""
+Benchmark of the ways of mapping a Fermat spiral scan onto a regular
+grid: griddata, the cached nearest-neighbour operator built with a
+KD-tree, and the Voronoi rasterizer ('voronoi' method). The first map
+on a new grid builds the operator, and later maps on the same grid,
+for example of other ROIs, only apply it.
+"""
+
+import time
+import numpy as np
+from scipy.interpolate import griddata
+from nmutils.core import Scan
+
+N = 200000
+
+# a Fermat spiral with unit density
+k = np.arange(N)
+r, theta = np.sqrt(k), k * np.pi * (3 - np.sqrt(5))
+scan = Scan()
+scan.positions = np.vstack((r * np.cos(theta), r * np.sin(theta))).T
+values = np.random.rand(N)
+
+def timed(func):
+    t0 = time.time()
+    result = func()
+    return result, time.time() - t0
+
+print('%-12s %-12s %10s %10s %10s %10s %8s' % ('oversampling', 'pixels', 'griddata',
+      'nearest', 'voronoi', 'cached', 'agree'))
+for oversampling in (1, 2, 4, 8):
+    # start from scratch, except for the KD-tree which the scan keeps
+    scan._positionIndex = None
+    scan.positionIndex.tree
+    (x, y, z), tVoronoi = timed(lambda: scan.interpolatedMap(values, oversampling, method='voronoi'))
+    z, tCached = timed(lambda: scan.interpolatedMap(values, oversampling, method='voronoi')[-1])
+    zNearest, tNearest = timed(lambda: scan.interpolatedMap(values, oversampling, method='nearest')[-1])
+    zGrid, tGrid = timed(lambda: griddata(scan.positions, values, (x, y), method='nearest'))
+    print('%-12u %-12s %10.3f %10.3f %10.3f %10.4f %8.3f' % (oversampling, '%ux%u' % x.shape,
+          tGrid, tNearest, tVoronoi, tCached, np.mean(z == zGrid)))
@@ -1,6 +1,15 @@
 class NoDataException(Exception):
 	pass
 
+class MemoryBudgetError(MemoryError):
+	"""
+	Raised before reading a dataset which would not fit in the memory
+	budget. suggestions holds addData() options which would fit.
+	"""
+	def __init__(self, message, suggestions=()):
+		super().__init__(message)
+		self.suggestions = list(suggestions)
+
 import sys
 try:
     assert sys.version[0] == '3'
@@ -9,12 +9,31 @@ import numpy as np
 import h5py
 import copy as cp
 import os.path
-from .. import NoDataException
+import hashlib
+import weakref
+from .. import NoDataException, MemoryBudgetError
+from .lazy import ArrayProxy, LazyDataset
+from .segmented import SegmentedDataset
+from .scaled import ScaledDataset
+from . import filepool
+from . import reductions
+from . import writers
+from . import cache
+from .spatial import PositionIndex, inRangeMask, voronoiRaster
 
 import scipy.ndimage.measurements
 from scipy.interpolate import griddata
+import scipy.sparse
 from functools import reduce
 
+# psutil gives the available memory on all platforms, otherwise it is
+# read from /proc/meminfo where that exists.
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
 __docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
 
 
@@ -32,6 +51,46 @@ class Scan(object):
             }
     }
 
+    # Attributes (as set by _prepareData) which together with the file
+    # determine the positions. Subclasses which list them here let addData
+    # skip re-reading unchanged positions, see _positionFingerprint().
+    positionOptions = ()
+
+    # Memory (bytes) allowed for the prefix sums of all 1D datasets
+    prefixSumBudget = 1 << 30 # 1 GiB
+
+    # Subclasses whose _readData() only returns the data from
+    # self.firstPosition onwards set this, making refresh() cheap.
+    incrementalReading = False
+
+    # How rows are filled in for missing frames: 'mean' gives the
+    # average frame, 'nan' gives NaN (integer datasets become floats).
+    missingFrames = 'mean'
+
+    # How loaded data is stored, see _storageDtype(). None keeps the
+    # dtypes the loader returns, and loaders which normalize data offer
+    # the other policies as the dataType option, see dataTypeOption.
+    dataType = None
+    dataTypeOption = {
+        'value': 'compact',
+        'type': ['compact', 'float32', 'float64'],
+        'doc': "storage of loaded data, 'compact' keeps loaded dtypes and reads normalized data as float32",
+        }
+
+    # Memory (bytes) that a dataset read by addData() may take, by
+    # default 3/4 of what is available, checked against _estimateData()
+    # before reading. Datasets which don't fit raise MemoryBudgetError
+    # listing options which would, or with memoryPolicy = 'adapt' are
+    # read with the first of these instead.
+    memoryBudget = None
+    memoryPolicy = 'raise'
+
+    # Persistent cache for reductions of datasets of at least
+    # cacheMinBytes, such as average frames, sums, ROI integrals and
+    # centers of mass, see cache.ProductCache. None disables it.
+    productCache = cache.store
+    cacheMinBytes = 1 << 26 # 64 MiB
+
     def __init__(self):
         """ 
         Only initializes counters and containers. Parameters, positions
@@ -41,7 +100,11 @@ class Scan(object):
         # A dict of datasets, where each value is an array, the first
         # index of which is the position, so (Npositions x M x N) or
         # (Npositions x M) for example. Each dataset can have different
-        # dimensionality.
+        # dimensionality. Datasets loaded in lazy mode are LazyDataset
+        # instances, which behave like arrays but read from file,
+        # merged or refreshed datasets are SegmentedDataset instances,
+        # and normalized datasets are ScaledDataset instances which
+        # apply the normalization as the data is read, see setI0().
         self.data = {}
 
         # An array of scanning positions (Npositions x Ndimensions),
@@ -56,6 +119,41 @@ class Scan(object):
         self.dataDimLabels = {}     # labels for each of the data dimensions
         self.dataAxes = {}          # numerical values for the axes of each dataset
 
+        # Bookkeeping for refresh(): the addData options of each dataset,
+        # and how many of its rows were actually read rather than padded.
+        self._loadOptions = {}
+        self._nValid = {}
+
+        # I0 channels given to setI0(), which refresh() keeps reading,
+        # and the datasets which loaders normalized as they read them,
+        # see _readScale()
+        self._I0Channels = {}
+        self._readNormalized = set()
+        self._normalizedOnRead = False
+
+        # Set by refresh() while reading, loaders should open files in
+        # SWMR mode and (if incrementalReading) start at firstPosition.
+        self.swmr = False
+        self.firstPosition = 0
+
+        # files borrowed from the shared pool, given back by close()
+        self._files = set()
+
+        # the files read for each dataset and a weak reference to the
+        # data as loaded from them, {name: (paths, ref)}, which identify
+        # cached products
+        self._sources = {}
+        self._loadFiles = set()
+
+        # (fingerprint, shape, digest) of the positions last read from file
+        self._positionCache = None
+
+        # spatial index on the positions, see the positionIndex property
+        self._positionIndex = None
+
+        # cumulative sums along 1D datasets, {name: (data, sums)}
+        self._prefixSums = {}
+
     @property
     def nDatasets(self):
         return len(self.data)
@@ -113,6 +211,102 @@ class Scan(object):
         """
         raise NotImplementedError
 
+    def _readI0(self, channel=None):
+        """
+        Placeholder method to be subclassed. Returns the vector to
+        normalize the data from _readData() by, one value per frame
+        from self.firstPosition onwards, or None. The channel is that
+        in the options by default, or one given to setI0(). The data
+        itself should be returned unnormalized.
+        """
+        return None
+
+    def _estimateData(self, name):
+        """
+        Placeholder method to be subclassed. Returns the (shape, dtype)
+        in which _readData() would hold the data in memory with the
+        current options, and the bytes it takes on top of that while
+        reading, as (shape, dtype, transient). This is worked out from
+        file metadata without reading the data. Returns None if the
+        data stays on disk or its size is not known.
+        """
+        return None
+
+    def _memoryOptions(self, name):
+        """
+        Placeholder method to be subclassed. Returns changes to the
+        addData() options which make the data smaller, such as lazy
+        mode, binning or cropping, as a list of dicts in order of
+        preference.
+        """
+        return []
+
+    @staticmethod
+    def _availableMemory():
+        """
+        The memory available for new data in bytes, or None if unknown.
+        """
+        if HAS_PSUTIL:
+            return psutil.virtual_memory().available
+        try:
+            with open('/proc/meminfo') as fp:
+                for line in fp:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def _memoryBudget(self):
+        """
+        The memoryBudget in bytes, or None if it is not set and the
+        available memory is unknown.
+        """
+        if self.memoryBudget is not None:
+            return self.memoryBudget
+        available = self._availableMemory()
+        return None if available is None else available * 3 // 4
+
+    def _checkMemory(self, name, kwargs):
+        """
+        Checks that the dataset about to be read fits in memoryBudget,
+        and returns the addData() options to read it with. These are
+        kwargs unless the policy is to adapt them, in which case the
+        data is prepared again with the new options.
+        """
+        if self.memoryPolicy not in ('raise', 'adapt'):
+            raise ValueError("memoryPolicy should be 'raise' or 'adapt'")
+        budget = self._memoryBudget()
+        estimate = self._estimateData(name)
+        if budget is None or estimate is None:
+            return kwargs
+        nbytes = lambda est: 0 if est is None else int(np.prod(est[0])) * np.dtype(est[1]).itemsize
+        peak = lambda est: 0 if est is None else nbytes(est) + est[2]
+        if peak(estimate) <= budget:
+            return kwargs
+
+        # see which of the smaller options fit
+        fits = []
+        for change in self._memoryOptions(name):
+            self._prepareData(**dict(kwargs, **change))
+            if peak(self._estimateData(name)) <= budget:
+                fits.append(change)
+        size = lambda n: '%.1f GB' % (n / 1e9) if n >= 1e9 else '%.1f MB' % (n / 1e6)
+        message = "Dataset '%s' would take %s as %s %s" % (
+            name, size(nbytes(estimate)), estimate[0], np.dtype(estimate[1]))
+        if estimate[2]:
+            message += ' and %s more while reading' % size(estimate[2])
+        message += ', more than the budget of %s' % size(budget)
+        if self.memoryPolicy == 'adapt' and fits:
+            kwargs = dict(kwargs, **fits[0])
+            print(message + ', loading with %s instead' % fits[0])
+        elif fits:
+            message += ', consider one of %s' % ', '.join(str(f) for f in fits[:3])
+        self._prepareData(**kwargs)
+        if self.memoryPolicy == 'raise' or not fits:
+            raise MemoryBudgetError(message, fits)
+        return kwargs
+
     def _updateOpts(self, opts, **kwargs):
         """
         Helper method which updates the 'value' fields of an options 
@@ -157,6 +351,27 @@ class Scan(object):
             raise NoDataException('Dataset %s not found in %s' % (path, fp.filename))
         return a
 
+    def _openFile(self, fileName):
+        """
+        Borrows an open, read-only handle to an HDF5 file from the shared
+        pool for use in a with statement, in SWMR mode when following a
+        running scan. The handle should not be closed by the caller.
+        """
+        self._files.add(os.path.abspath(fileName))
+        self._loadFiles.add(os.path.abspath(fileName))
+        return filepool.pool.borrow(fileName, swmr=self.swmr)
+
+    def close(self):
+        """
+        Closes the pooled files used by this scan, which are otherwise
+        kept open for further loads until the pool evicts them. Loaded
+        data is kept, and LazyDataset instances reopen their files when
+        needed.
+        """
+        for fileName in self._files:
+            filepool.pool.close(fileName)
+        self._files = set()
+
     def _safe_get_dataset(self, fp, path):
         """
         Attempts to get dataset from fp[path], raising an informative
@@ -168,7 +383,7 @@ class Scan(object):
             raise NoDataException('Dataset %s not found in %s' % (path, fp.filename))
         return a
 
-    def addData(self, name=None, **kwargs):
+    def addData(self, name=None, forcePositionCheck=False, **kwargs):
         """ 
         This method adds positions the first time data is loaded. Then,
         subsequent data additions should check for consistency and
@@ -176,12 +391,18 @@ class Scan(object):
         hint at what type of data we're reading (for example 'pilatus', 
         'transmission', ...), so data from different sources can be 
         handled by this method.
+
+        Positions are not read again if their source is unchanged since
+        they were loaded (see _positionFingerprint), unless
+        forcePositionCheck is set.
         """
 
         if not name:
             name = 'data%u' % self.nDatasets
 
+        self._loadFiles = set()
         self._prepareData(**kwargs)
+        fingerprint = self._positionFingerprint()
 
         # Check if any data exists.
         if not self.nDatasets:
@@ -194,13 +415,24 @@ class Scan(object):
             if name in self.data.keys():
                 raise ValueError("Dataset '%s' already exists!" % name)
             # verify that positions are are consistent
-            if not np.all(self.positions == self._readPositions()):
-                raise ValueError(
-                    "Positions of new dataset are inconsistent with previously loaded positions!")
+            if forcePositionCheck or not self._positionsUnchanged(fingerprint):
+                if not np.array_equal(self.positions, self._readPositions()):
+                    raise ValueError(
+                        "Positions of new dataset are inconsistent with previously loaded positions!")
+        self._positionCache = self._positionRecord(fingerprint)
 
         # The actual reading is done by _readData() which knows about the
-        # details of the hdf5 file
+        # details of the hdf5 file, once the data is known to fit
+        kwargs = self._checkMemory(name, kwargs)
+        self._normalizedOnRead = False
         data = self._readData(name)
+        if isinstance(data, np.ndarray):
+            data = data.astype(self._storageDtype(data.dtype), copy=False)
+        if self._normalizedOnRead:
+            self._readNormalized.add(name)
+        else:
+            self._readNormalized.discard(name)
+            data = self._scaleData(data, self._readI0(), self._fillNonFinite())
 
         # Check if _readData has filled in the info fields, otherwise generate something
         if self.dataTitles.get(name) is None:
@@ -213,24 +445,339 @@ class Scan(object):
         assert len(self.dataDimLabels[name]) == data.ndim - 1
         assert len(self.dataAxes[name]) == data.ndim - 1
 
+        self._loadOptions[name] = kwargs
+        self._nValid[name] = min(data.shape[0], self.nPositions)
+        self.data[name] = data
+        del data
+        self._fitToPositions(name)
+        self._sources[name] = (sorted(self._loadFiles), weakref.ref(self.data[name]))
+
+    def _storageDtype(self, dtype, scaled=False):
+        """
+        The dtype in which to store data of the given dtype, according
+        to self.dataType, or with scaled set that in which normalized
+        data is read, see ScaledDataset. With None, data is kept as it
+        is and normalized data is double precision. With 'compact', data
+        is also kept as it is, and normalized data is single precision.
+        'float32' and 'float64' convert everything.
+        """
+        dtype = np.dtype(dtype)
+        if self.dataType is None:
+            return np.promote_types(dtype, np.float64) if scaled else dtype
+        if self.dataType not in self.dataTypeOption['type']:
+            raise ValueError('dataType should be one of %s' % self.dataTypeOption['type'])
+        if self.dataType == 'compact' and not scaled:
+            return dtype
+        if dtype.kind == 'c':
+            return np.dtype(np.complex128 if self.dataType == 'float64' else np.complex64)
+        if self.dataType == 'float64':
+            return np.dtype(np.float64)
+        return np.dtype(np.float32)
+
+    def _scaleData(self, data, I0, fillNonFinite=False):
+        """
+        Returns data normalized by I0, as a ScaledDataset which keeps
+        the data as it is and multiplies it by 1 / I0 as it is read, in
+        the dtype given by _storageDtype. If either is longer, it is
+        trimmed to the other's length.
+        """
+        if I0 is None:
+            return data
+        I0 = np.asarray(I0, dtype=np.float64).reshape(-1)
+        n = min(data.shape[0], len(I0))
+        if data.shape[0] > n:
+            data = data.take(np.arange(n)) if isinstance(data, ArrayProxy) else data[:n]
+        with np.errstate(divide='ignore'):
+            scale = 1. / I0[:n]
+        return ScaledDataset(data, scale, dtype=self._storageDtype(data.dtype, scaled=True),
+                             fillNonFinite=fillNonFinite)
+
+    def _readScale(self):
+        """
+        For loaders which normalize data block by block as they read
+        it: returns the scale (1 / I0) for the rows from
+        self.firstPosition onwards, or None if there is no I0. The data
+        read is then taken to be normalized, and addData() and refresh()
+        leave it as it is, which means that setI0() can't change it.
+        """
+        I0 = self._readI0()
+        if I0 is None:
+            return None
+        self._normalizedOnRead = True
+        with np.errstate(divide='ignore'):
+            return 1. / np.asarray(I0, dtype=np.float64).reshape(-1)
+
+    def _fillNonFinite(self):
+        """
+        Whether normalized values which are infinite or NaN, where I0
+        is zero, should read as the mean of the finite ones, for the
+        data set up by _prepareData. Subclasses can override this.
+        """
+        return False
+
+    def _normalization(self, name):
+        """
+        Returns a dataset without its normalization, and the scale it
+        is normalized by (one value per row) or None. This looks into
+        ScaledDataset instances, also within segmented datasets.
+        """
+        def scaled(data):
+            if isinstance(data, SegmentedDataset):
+                return any(scaled(seg) for seg in data.segments)
+            return isinstance(data, ScaledDataset)
+
+        def split(data):
+            if isinstance(data, ScaledDataset):
+                return data.base, data.scale
+            if isinstance(data, SegmentedDataset):
+                parts = [split(seg) for seg in data.segments]
+                return (SegmentedDataset([part for part, scale in parts]),
+                        np.concatenate([scale for part, scale in parts] or [np.ones(0)]))
+            return data, np.ones(len(data))
+
+        if not scaled(self.data[name]):
+            return self.data[name], None
+        return split(self.data[name])
+
+    def _fillsNonFinite(self, name):
+        """
+        Whether a normalized dataset, or any of its segments, reads
+        non-finite values as the mean, see _fillNonFinite().
+        """
+        def fills(data):
+            if isinstance(data, SegmentedDataset):
+                return any(fills(seg) for seg in data.segments)
+            return getattr(data, 'fillNonFinite', False)
+        return fills(self.data[name])
+
+    def setI0(self, I0, name=None):
+        """
+        Normalizes a dataset (default all) by I0, a vector with one
+        value per position, or removes the normalization if I0 is None.
+        Datasets are kept as loaded and only the scale (1 / I0) they are
+        multiplied by as they are read is replaced, see ScaledDataset,
+        so this is instant and takes no extra memory. I0 can also be the
+        name of a channel, such as 'alba2/1', which loaders implementing
+        _readI0() read from the scan file and refresh() keeps reading.
+        """
+        names = self.listData() if name is None else [name]
+        for name in names:
+            if name in self._readNormalized:
+                raise RuntimeError("Dataset '%s' was normalized as it was read, reload it to change I0" % name)
+        for name in names:
+            data = self._normalization(name)[0]
+            if I0 is None:
+                self._I0Channels[name] = ''
+                self.data[name] = data
+                self._resetSource(name)
+                continue
+            if name in self._loadOptions:
+                self._prepareData(**self._loadOptions[name])
+                fillNonFinite = self._fillNonFinite()
+            else:
+                fillNonFinite = self._fillsNonFinite(name)
+            if isinstance(I0, str):
+                if name not in self._loadOptions:
+                    raise RuntimeError('I0 channels can only be read for scans loaded with addData(), not merged or subset ones')
+                vector = self._readI0(I0)
+                if vector is None:
+                    raise NotImplementedError('%s cannot read I0 channels' % self.__class__.__name__)
+                self._I0Channels[name] = I0
+            else:
+                vector = I0
+                self._I0Channels.pop(name, None)
+            vector = np.asarray(vector, dtype=np.float64).reshape(-1)
+            if len(vector) < data.shape[0]:
+                # padded positions keep their values
+                vector = np.concatenate((vector, np.ones(data.shape[0] - len(vector))))
+            self.data[name] = self._scaleData(data, vector, fillNonFinite)
+            if isinstance(I0, str):
+                self._resetSource(name)
+
+    def _resetSource(self, name):
+        """
+        Marks the current data of a dataset as what its sources and
+        load options (including the I0 channel) give, see _productKey.
+        """
+        if name in self._sources:
+            self._sources[name] = (self._sources[name][0], weakref.ref(self.data[name]))
+
+    def _positionFingerprint(self):
+        """
+        Describes the source of the positions for the current options,
+        or returns None if that isn't possible. By default this is the
+        file, its modification time and size, and the attributes listed
+        in positionOptions. Subclasses with positions from several files
+        can override this.
+        """
+        fileName = getattr(self, 'fileName', None)
+        if not self.positionOptions or not fileName:
+            return None
+        try:
+            st = os.stat(fileName)
+        except (OSError, TypeError):
+            return None
+        opts = tuple(repr(getattr(self, k, None)) for k in self.positionOptions)
+        return (os.path.abspath(fileName), st.st_mtime_ns, st.st_size) + opts
+
+    def _positionRecord(self, fingerprint):
+        """
+        Combines a fingerprint with the shape and a hash of the current
+        positions, so that later changes to either can be detected.
+        """
+        if fingerprint is None or self.positions is None:
+            return None
+        digest = hashlib.sha1(np.ascontiguousarray(self.positions).tobytes()).hexdigest()
+        return (fingerprint, self.positions.shape, digest)
+
+    def _positionsUnchanged(self, fingerprint):
+        """
+        Whether the loaded positions are known to match what would be
+        read with the current options.
+        """
+        record = self._positionRecord(fingerprint)
+        return record is not None and record == self._positionCache
+
+    def _fitToPositions(self, name):
+        """
+        Pads or trims self.data[name] so that there is one row per
+        position. Arrays are resized in place when possible, so that
+        there is never more than one copy of the data in memory.
+        """
+        # take the data out of the dict, so that this is the only
+        # reference and the array can be resized
+        data = self.data.pop(name)
+        nRows, n = data.shape[0], self.nPositions
+        isProxy = isinstance(data, ArrayProxy)
+        if self.missingFrames not in ('mean', 'nan'):
+            raise ValueError("missingFrames should be 'mean' or 'nan'")
+
         # pad the data in case there were missing frames
-        if data.shape[0] < self.nPositions:
-            missing = self.nPositions - data.shape[0]
-            print("there were %d missing images for dataset '%s', filling with average values"%(missing, name))
-            pads = ((0, missing),) + ((0, 0),) * (data.ndim - 1)
-            data = np.pad(data, pads, mode='mean')
+        dtype = fill = None
+        if nRows < n:
+            print("there were %d missing images for dataset '%s', filling with %s values"
+                  % (n - nRows, name, 'average' if self.missingFrames == 'mean' else 'NaN'))
+            if isProxy:
+                value = None if self.missingFrames == 'mean' else np.nan
+                data = data.pad(n - nRows, value=value)
+            else:
+                if self.missingFrames == 'mean':
+                    # streamed, so there is no full-size temporary
+                    fill = reductions.reduce(data, op='mean', over='positions')
+                    if data.dtype.kind in 'iub':
+                        fill = np.around(fill)
+                    fill = fill.astype(data.dtype)
+                else:
+                    fill = np.nan
+                dtype = data.dtype
+                if self.missingFrames == 'nan' and dtype.kind not in 'fc':
+                    dtype = np.dtype(np.float64)
 
         # remove data in case too much has been returned
-        if data.shape[0] > self.nPositions:
-            excess = data.shape[0] - self.nPositions
-            print("there were %d too many images for dataset '%s', ignoring"%(excess, name))
-            data = data[:self.nPositions]
+        elif nRows > n:
+            print("there were %d too many images for dataset '%s', ignoring"%(nRows - n, name))
+            if isProxy:
+                data = data.take(np.arange(n))
+            else:
+                dtype = data.dtype
+
+        if dtype is not None:
+            # resize in place if numpy finds no other reference to the
+            # array, which has to be done here where the only one is,
+            # otherwise copy into a new array of the final size
+            shape = (n,) + data.shape[1:]
+            resized = False
+            if (dtype == data.dtype and data.flags.owndata and data.flags.c_contiguous
+                    and data.flags.writeable):
+                try:
+                    data.resize(shape)
+                    resized = True
+                except ValueError:
+                    pass
+            if not resized:
+                out = np.empty(shape, dtype=dtype)
+                out[:min(n, nRows)] = data[:min(n, nRows)]
+                data = out
+            if fill is not None:
+                data[nRows:] = fill
 
         self.data[name] = data
+
+    def refresh(self):
+        """
+        Appends the positions and data recorded since the scan was
+        loaded, for following a scan which is still running. Files are
+        opened in SWMR mode, and loaders with incrementalReading only
+        read the new frames. Frames which were missing (and padded)
+        before are read again. Returns the number of new positions.
+        """
+        if not self.nDatasets:
+            return 0
+        if not all(name in self._loadOptions for name in self.listData()):
+            raise RuntimeError('Only scans loaded with addData() can be refreshed, not merged or subset ones')
+
+        self.swmr = True
+        try:
+            self._prepareData(**self._loadOptions[self.listData()[0]])
+            fingerprint = self._positionFingerprint()
+            positions = self._readPositions()
+            nNew = positions.shape[0] - self.nPositions
+            if nNew <= 0:
+                return 0
+            if not np.allclose(positions[:self.nPositions], self.positions):
+                raise ValueError('Positions already loaded have changed, please reload the scan')
+
+            new = {}
+            for name in self.listData():
+                self._prepareData(**self._loadOptions[name])
+                n = self._nValid[name]
+                self.firstPosition = n if self.incrementalReading else 0
+                self._normalizedOnRead = False
+                data = self._readData(name)
+                if isinstance(data, np.ndarray):
+                    data = data.astype(self._storageDtype(data.dtype), copy=False)
+                I0 = None
+                if not self._normalizedOnRead:
+                    I0 = self._readI0(self._I0Channels.get(name))
+                if not self.incrementalReading:
+                    data = data[n:]
+                    I0 = None if I0 is None else I0[n:]
+                new[name] = self._scaleData(data, I0, self._fillNonFinite())
+
+            # only touch the scan once everything has been read
+            self.positions = positions
+            self._positionCache = self._positionRecord(fingerprint)
+            for name, data in new.items():
+                self._prefixSums.pop(name, None)
+                old = self.data[name]
+                n = self._nValid[name]
+                if isinstance(old, LazyDataset) and isinstance(data, LazyDataset):
+                    data = old.take(np.arange(n)).append(data)
+                else:
+                    # append the new rows as a segment, without copying
+                    if isinstance(old, SegmentedDataset):
+                        old = old.take(np.arange(n))
+                    elif isinstance(old, ArrayProxy):
+                        old = SegmentedDataset([old.take(np.arange(n))])
+                    else:
+                        old = SegmentedDataset([old[:n]])
+                    old.append(data)
+                    data = old
+                self._nValid[name] = min(data.shape[0], self.nPositions)
+                self.data[name] = data
+                self._fitToPositions(name)
+                self._resetSource(name)
+            print('refreshed scan with %u new positions' % nNew)
+            return nNew
+        finally:
+            self.swmr = False
+            self.firstPosition = 0
         
     def removeData(self, name):
         if name in list(self.data.keys()):
             self.data.pop(name, None)
+            self._sources.pop(name, None)
+            self._readNormalized.discard(name)
         else:
             raise ValueError("Dataset '%s' doesn't exist!" % name)
 
@@ -239,49 +786,268 @@ class Scan(object):
 
     def meanData(self, name=None):
         """ Returns the scan-average of the specified data set. """
+        return self.reduceData(name, op='mean', over='positions')
+
+    def reduceData(self, name=None, op='mean', over='positions', mask=None,
+                   positions=None, nThreads=1):
+        """
+        Sum, mean, max or min of a dataset over positions or over
+        pixels, streamed in blocks so that the whole dataset never has
+        to be in memory (or read from file, for lazy datasets) at once.
+
+        name: the dataset, can be omitted if there is only one
+        op: 'sum', 'mean', 'max' or 'min'
+        over: 'positions' gives a frame, 'pixels' one value per position
+        mask: boolean frame-shaped array of pixels to include (over='pixels')
+        positions: indices of the positions to include, default all
+        nThreads: number of blocks to reduce in parallel
+        """
+        name = self._datasetName(name)
+        return self._cached(name, ('reduce', op, over, mask, positions),
+                            lambda: reductions.reduce(self.data[name], op=op, over=over, mask=mask,
+                                                      rows=positions, nThreads=nThreads))
+
+    def roiIntegrals(self, name=None, rois=(), op='sum', positions=None, nThreads=1):
+        """
+        Integrates many ROIs in a single pass over a dataset, returning
+        an (Npositions x Nrois) array.
+
+        name: the dataset, can be omitted if there is only one
+        rois: channel windows (lower, upper) for 1D data, upper excluded,
+              or boolean frame-shaped pixel masks for 2D data
+        op: 'sum' or 'mean'
+        positions: indices of the positions to include, default all
+        nThreads: number of blocks to integrate in parallel
+        """
+        name = self._datasetName(name)
+        return self._cached(name, ('roiIntegrals', list(rois), op, positions),
+                            lambda: reductions.roiIntegrals(self.data[name], rois, op=op,
+                                                            rows=positions, nThreads=nThreads,
+                                                            prefixSums=self._validPrefixSums(name)))
+
+    def centerOfMass(self, name=None, mask=None, positions=None):
+        """
+        Center of mass (row, column) of each frame of a 2D dataset, as
+        an (Npositions x 2) array, in a single streamed pass. Frames
+        without intensity give NaN.
+
+        name: the dataset, can be omitted if there is only one
+        mask: boolean frame-shaped array of pixels to leave out
+        positions: indices of the positions to include, default all
+        """
+        name = self._datasetName(name)
+        return self._cached(name, ('centerOfMass', mask, positions),
+                            lambda: reductions.centerOfMass(self.data[name], mask=mask, rows=positions))
+
+    def _productKey(self, name, *args):
+        """
+        Key for a product of a dataset in productCache, made from the
+        loader, its options, the source files as they are now and args.
+        None if the product should not be cached: the dataset is small,
+        or it has been changed, merged or subset since it was loaded.
+        """
+        if self.productCache is None or name not in self._sources or name not in self._loadOptions:
+            return None
+        paths, ref = self._sources[name]
+        data = self.data[name]
+        if not paths or ref() is not data or data.nbytes < self.cacheMinBytes:
+            return None
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            stamps.append((path, st.st_mtime_ns, st.st_size))
+        return self.productCache.key(self.__class__.__name__, self._loadOptions[name], stamps,
+                                     self._I0Channels.get(name), self.missingFrames, self.dataType,
+                                     data.shape, data.dtype.str, *args)
+
+    def _cached(self, name, args, compute):
+        """
+        Returns the result of compute(), from productCache if it has
+        been stored there under the dataset and args before.
+        """
+        key = self._productKey(name, *args)
+        if key is not None:
+            result = self.productCache.get(key)
+            if result is not None:
+                return result
+        result = compute()
+        if key is not None:
+            self.productCache.put(key, result)
+        return result
+
+    def prefixSums(self, name=None):
+        """
+        Builds (once) and returns the cumulative sums along the channels
+        of a 1D dataset, after which roiIntegrals on that dataset only
+        look up two columns per window. The float64 sums are kept as
+        long as the dataset isn't replaced, refreshed or merged, within
+        a total memory of prefixSumBudget bytes. Returns None if the
+        budget doesn't allow it, leaving the caller to report that.
+        """
+        name = self._datasetName(name)
+        cs = self._validPrefixSums(name)
+        if cs is not None:
+            return cs
+        data = self.data[name]
+        if not data.ndim == 2:
+            raise ValueError('Prefix sums are only available for 1D datasets')
+        nbytes = data.shape[0] * (data.shape[1] + 1) * 8
+        used = sum(cs.nbytes for d, cs in self._prefixSums.values())
+        if used + nbytes > self.prefixSumBudget:
+            return None
+        cs = reductions.prefixSums(data)
+        self._prefixSums[name] = (data, cs)
+        return cs
+
+    def _validPrefixSums(self, name):
+        """
+        The prefix sums of a dataset if they are up to date, dropping
+        any which belong to replaced or removed datasets.
+        """
+        for key, (data, cs) in list(self._prefixSums.items()):
+            if self.data.get(key) is not data:
+                del self._prefixSums[key]
+        entry = self._prefixSums.get(name)
+        return None if entry is None else entry[1]
+
+    def roiMaps(self, name=None, rois=(), oversampling=1, op='sum', origin='lr',
+                method='nearest', equal=False, nThreads=1):
+        """
+        Integrates many ROIs in one pass (see roiIntegrals) and maps them
+        with a single interpolation (see interpolatedMap), returning x, y
+        and an (ny x nx x Nrois) stack of maps.
+        """
+        values = self.roiIntegrals(name, rois, op=op, nThreads=nThreads)
+        return self.interpolatedMap(values, oversampling, origin=origin,
+                                    method=method, equal=equal)
+
+    def _datasetName(self, name):
+        """
+        Returns the name of a dataset, which can be omitted if there is
+        only one.
+        """
         if not name:
             if self.nDatasets == 1:
                 name = self.listData()[0]
             else:
                 raise ValueError(
                     "There is more than one dataset to choose from. Please specify!")
-        return np.mean(self.data[name], axis=0)
+        return name
 
     def copy(self, data=True):
         """ 
-        Returns a copy of the Scan instance. The kwarg data can be set
-        to False to ignore data and positions, which is useful for
-        creating Scan instances with only a subset of the data. This
-        method also copies all attributes and does not need to be
-        updated.
+        Returns a copy of the Scan instance. Positions and datasets are
+        not duplicated but shared, and the shared arrays are made
+        read-only in both instances, so that neither can change the
+        other's data. Either instance gets writable data of its own
+        again, copied on demand, with ownData(). The kwarg data can be
+        set to False to get a metadata-only copy without data and
+        positions, which is useful for creating Scan instances with only
+        a subset of the data. This method also copies all attributes and
+        does not need to be updated.
         """
+        # create a new object of the right subclass and copy all the
+        # non-data attributes, which are small
+        new = self.__class__.__new__(self.__class__)
+        for key, val in self.__dict__.items():
+            if key not in ('data', 'positions', '_positionIndex', '_prefixSums', '_sources'):
+                new.__dict__[key] = cp.deepcopy(val)
 
-        # copy all
-        if data:
-            return cp.deepcopy(self)
+        if not data:
+            new.positions = None
+            new.data = {dataset: None for dataset in self.data.keys()}
+            new._positionIndex = None
+            new._prefixSums = {}
+            new._sources = {}
+            return new
 
-        # otherwise, construct a new objects and copy all the attributes
-        # create a new object of the right subclass:
-        new = self.__class__()
+        # share everything else read-only, including the caches
+        new.positions = self._readOnly(self.positions)
+        new.data = {name: self._readOnly(d) for name, d in self.data.items()}
+        new._positionIndex = self._positionIndex
+        new._prefixSums = dict(self._prefixSums)
+        new._sources = dict(self._sources)
+        return new
 
-        # copy all the non-data attributes
-        for key in self.__dict__.keys():
-            if key not in ['data', 'positions']:
-                exec("new.%s = cp.deepcopy(self.%s)" % (key, key))
-        for dataset in self.data.keys():
-            new.data[dataset] = None
+    @staticmethod
+    def _readOnly(data):
+        """
+        Marks numpy arrays, also within segmented and scaled datasets,
+        as read-only.
+        """
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        elif isinstance(data, SegmentedDataset):
+            for seg in data.segments:
+                Scan._readOnly(seg)
+        elif isinstance(data, ScaledDataset):
+            Scan._readOnly(data.base)
+            Scan._readOnly(data.scale)
+        return data
 
-        return new
+    def ownData(self, name=None):
+        """
+        Gives this instance its own writable copy of a dataset (default
+        all datasets and the positions) if it is shared read-only after
+        copy(), which is the copy in copy-on-write: call it before
+        changing data in place. Lazy and segmented datasets become
+        numpy arrays, and normalized ones ScaledDataset instances on a
+        numpy array of raw data, which is the base to change.
+        """
+        names = self.listData() if name is None else [name]
+        for dataset in names:
+            data, scale = self._normalization(dataset)
+            if isinstance(data, np.ndarray) and data.flags.writeable:
+                continue
+            data = np.array(data)
+            if scale is not None:
+                data = ScaledDataset(data, scale.copy(), dtype=self.data[dataset].dtype,
+                                     fillNonFinite=self._fillsNonFinite(dataset))
+            self.data[dataset] = data
+        if name is None and self.positions is not None:
+            if not self.positions.flags.writeable:
+                self.positions = self.positions.copy()
 
     def merge(self, scanobj):
         """
         Adds positions and data from another Scan object. The scans must
-        have the same datasets.
+        have the same datasets. The data is not copied, but appended as
+        segments of SegmentedDataset instances, so that merging many
+        scans one by one stays linear. See consolidate() for getting
+        contiguous arrays.
         """
         assert self.data.keys() == scanobj.data.keys()
+        self._loadOptions = {}
+        self._positionIndex = None
+        self._prefixSums = {}
+        self._readNormalized |= scanobj._readNormalized
         self.positions = np.concatenate((self.positions, scanobj.positions), axis=0)
         for key in self.data.keys():
-            self.data[key] = np.concatenate((self.data[key], scanobj.data[key]), axis=0)
+            old, other = self.data[key], scanobj.data[key]
+            # a new container, as the old one may be shared with copies
+            data = SegmentedDataset([old])
+            data.append(other)
+            self.data[key] = data
+
+    def consolidate(self, name=None):
+        """
+        Replaces segmented datasets (see merge) with contiguous numpy
+        arrays, for all datasets or only the named one. Normalized
+        segments are joined as raw data, keeping their scale.
+        """
+        names = self.listData() if name is None else [name]
+        for name in names:
+            data, scale = self._normalization(name)
+            if isinstance(data, SegmentedDataset):
+                dtype = self.data[name].dtype
+                data = data.consolidate()
+                if scale is not None:
+                    data = ScaledDataset(data, scale, dtype=dtype,
+                                         fillNonFinite=self._fillsNonFinite(name))
+                self.data[name] = data
 
     def subset(self, posRange, closest=False):
         """ 
@@ -290,58 +1056,247 @@ class Scan(object):
         ymax, ...]]). If the kwarg closest is True, and the specified
         range contains no positions, then the returned instance contains
         only the single closest position.
-        """
-        new = self.copy(data=False)
 
-        # lists of data and positions to fill in
-        new.positions = []
-        for dataset in self.data.keys():
-            new.data[dataset] = []
-
-        # go through all positions and only include the ones which are
-        # within range
-        for i in range(self.nPositions):
-            ok = True
-            for dim in range(self.nDimensions):
-                pos = self.positions[i, dim]
-                if pos < posRange[0, dim] or pos > posRange[1, dim]:
-                    ok = False
-                    break
-            if ok:
-                for dataset in self.data.keys():
-                    new.data[dataset].append(self.data[dataset][i])
-                new.positions.append(self.positions[i])
+        The selection is vectorised, and uses the position index if it
+        has been built already (see positionIndex).
+        """
+        posRange = np.asarray(posRange)
+        indexed = (self._positionIndex is not None
+                   and self._positionIndex.positions is self.positions)
+        if indexed:
+            rows = self.positionIndex.inRange(posRange)
+        else:
+            rows = np.flatnonzero(inRangeMask(self.positions, posRange))
 
         # get the closest positions if requested
-        if (len(new.positions) == 0) and closest:
+        if not len(rows) and closest:
             rangeCenter = np.mean(posRange, axis=0)
-            # using sum instead of linalg.norm here, for old numpy at beamline:
-            index = np.argmin(
-                np.sum((self.positions - rangeCenter)**2, axis=1))
-            for dataset in self.data.keys():
-                new.data[dataset].append(self.data[dataset][index])
-            new.positions.append(self.positions[index])
-
-        # convert lists to arrays
+            if indexed:
+                rows = self.positionIndex.nearest(rangeCenter[None, :])[0]
+            else:
+                # using sum instead of linalg.norm here, for old numpy at beamline:
+                rows = np.array([np.argmin(
+                    np.sum((self.positions - rangeCenter)**2, axis=1))])
+
+        new = self.copy(data=False)
+        new._loadOptions = {}
+        new.positions = self.positions[rows]
         for dataset in self.data.keys():
-            new.data[dataset] = np.array(new.data[dataset])
-        new.positions = np.array(new.positions)
+            data = self.data[dataset]
+            if isinstance(data, ArrayProxy):
+                new.data[dataset] = data.take(rows)
+            else:
+                new.data[dataset] = data[rows]
 
         return new
 
-    def interpolatedMap(self, values, oversampling, origin='lr', method='nearest', equal=False):
+    @property
+    def positionIndex(self):
+        """
+        Spatial index on the positions, built on first use and rebuilt
+        whenever the positions are replaced.
+        """
+        index = self._positionIndex
+        if index is None or index.positions is not self.positions:
+            index = PositionIndex(self.positions)
+            self._positionIndex = index
+        return index
+
+    def nearest(self, points):
+        """
+        Returns the indices of the positions closest to each of the
+        (M x Ndimensions) points, and the distances to them.
+        """
+        points = np.asarray(points, dtype=float).reshape((-1, self.nDimensions))
+        return self.positionIndex.nearest(points)
+
+    def within(self, points, radius):
+        """
+        Returns the sorted indices of the positions within a distance
+        radius of any of the (M x Ndimensions) points.
+        """
+        return self.positionIndex.within(points, radius)
+
+    def interpolatedMap(self, values, oversampling, origin='lr', method='nearest', equal=False,
+                        regular=None):
         """ 
         Provides a regular and interpolated xy map of the scan, with the
         values provided. For example, a ROI integral can be provided which
         results in an interpolated map of that ROI.
 
-        values: a length-N array, with one value per position
+        values: a length-N array, with one value per position, or an
+                (N x ...) array which gives a (ny x nx x ...) stack of maps
         oversampling: the oversampling ratio relative to the average position spacing
         origin: 'lr', 'll', 'ur', 'ul'
         equal: use equal pixel sizes for x and y
+        regular: whether to map positions on a rectilinear mesh (raster
+                 or snake scans) by reshaping instead of with griddata,
+                 None detects this automatically
+
+        The 'nearest' and 'linear' methods are linear operators on the
+        values, which are cached (see mapOperator) so that mapping new
+        values on the same positions is a single sparse product. The
+        'voronoi' method is a fast approximation of 'nearest' for
+        scattered positions such as spiral scans, which rasterizes the
+        cells of the positions (see spatial.voronoiRaster) and agrees
+        with it except for a few pixels at cell boundaries.
         """
         assert self.nDimensions == 2
+        values = np.asarray(values)
+
+        if method in ('nearest', 'linear', 'voronoi'):
+            x, y, operator, outside = self.mapOperator(oversampling, origin, method, equal, regular)
+            flat = values.reshape((self.nPositions, -1))
+            if flat.dtype.kind in 'iub':
+                flat = flat.astype(float)
+            z = operator @ flat
+            if outside is not None:
+                z[outside] = np.nan
+            z = z.reshape(x.shape + values.shape[1:])
+            return x, y, z
+
+        if regular:
+            raise ValueError('The %s method is not supported on regular grids' % method)
+        x, y = self._mapGrid(oversampling, equal)
+        z = griddata(self.positions, values, (x, y), method=method)
+        return self._flipMap(origin, x, y, z)
+
+    def mapOperator(self, oversampling, origin='lr', method='nearest', equal=False, regular=None):
+        """
+        Returns (x, y, operator, outside) for interpolatedMap, where the
+        sparse (Npixels x N) operator maps a vector of values onto the
+        raveled map, and outside is None or a boolean mask of the pixels
+        outside the convex hull of the positions, which should be NaN.
+        The last few operators are cached with the position index (see
+        PositionIndex.maxMaps), and the arguments are as for
+        interpolatedMap.
+        """
+        assert method in ('nearest', 'linear', 'voronoi')
+        index = self.positionIndex
+        key = (oversampling, origin, method, bool(equal), regular)
+        if key not in index.maps:
+            grid = index.grid if regular or regular is None else None
+            if grid is not None:
+                # positions on a mesh are mapped exactly anyway
+                x, y, rows, cols, weights, outside = self._regularOperator(
+                    grid, oversampling, 'nearest' if method == 'voronoi' else method, equal)
+            elif regular:
+                raise ValueError('The positions are not on a regular grid')
+            else:
+                x, y = self._mapGrid(oversampling, equal)
+                rows, cols, weights, outside = self._scatteredOperator(x, y, method)
+
+            # apply the origin to the pixel order, we've been assuming lower-right.
+            pixels = self._flipMap(origin, np.arange(x.size).reshape(x.shape))[0]
+            x, y = self._flipMap(origin, x, y)
+            inverse = np.empty(x.size, dtype=int)
+            inverse[pixels.ravel()] = np.arange(x.size)
+            operator = scipy.sparse.csr_matrix((weights, (inverse[rows], cols)),
+                                               shape=(x.size, self.nPositions))
+            if outside is not None:
+                outside = outside.reshape(-1)[pixels.ravel()]
+            index.maps[key] = (x, y, operator, outside)
+            while len(index.maps) > index.maxMaps:
+                index.maps.popitem(last=False)
+        index.maps.move_to_end(key)
+        return index.maps[key]
+
+    @staticmethod
+    def _flipMap(origin, *arrays):
+        """
+        Flips arrays defined with lower-right origin to another origin.
+        """
+        flipped = []
+        for a in arrays:
+            if origin in ('ll', 'ul'):
+                a = np.fliplr(a)
+            if origin in ('ur', 'ul'):
+                a = np.flipud(a)
+            flipped.append(a)
+        return tuple(flipped)
+
+    def _regularOperator(self, grid, oversampling, method, equal):
+        """
+        Mapping for positions on a rectilinear mesh, with nearest
+        neighbour or bilinear oversampling. Returns x and y with lower
+        right origin, and the rows, columns and weights of the operator.
+        """
+        order, xCoords, yCoords = grid
+
+        def span(c):
+            # pixel edges for nearest, centres of the outer positions for linear
+            if method == 'linear' or len(c) < 2:
+                return c[0], c[-1]
+            return c[0] - (c[1] - c[0]) / 2, c[-1] + (c[-1] - c[-2]) / 2
+        (x0, x1), (y0, y1) = span(xCoords), span(yCoords)
+        nx = max(1, int(round(len(xCoords) * oversampling)))
+        ny = max(1, int(round(len(yCoords) * oversampling)))
+        if equal:
+            step = min((x1 - x0) / nx, (y1 - y0) / ny)
+            nx = max(1, int(round((x1 - x0) / step)))
+            ny = max(1, int(round((y1 - y0) / step)))
+        if method == 'linear':
+            tx = np.linspace(x1, x0, nx)
+            ty = np.linspace(y1, y0, ny)
+        else:
+            # pixel centres, descending for the lower-right origin
+            tx = x1 - (np.arange(nx) + .5) * (x1 - x0) / nx
+            ty = y1 - (np.arange(ny) + .5) * (y1 - y0) / ny
+        y, x = np.meshgrid(ty, tx, indexing='ij')
+        pixels = np.arange(nx * ny).reshape((ny, nx))
+
+        if method == 'nearest':
+            ix = np.searchsorted((xCoords[1:] + xCoords[:-1]) / 2, tx)
+            iy = np.searchsorted((yCoords[1:] + yCoords[:-1]) / 2, ty)
+            cols = order[iy[:, None], ix[None, :]]
+            return x, y, pixels.ravel(), cols.ravel(), np.ones(x.size), None
+
+        def weights(c, t):
+            i = np.clip(np.searchsorted(c, t) - 1, 0, len(c) - 2)
+            return i, ((t - c[i]) / (c[i+1] - c[i]))
+        ix, wx = weights(xCoords, tx)
+        iy, wy = weights(yCoords, ty)
+        rows, cols, vals = [], [], []
+        for dy, fy in ((0, 1 - wy), (1, wy)):
+            for dx, fx in ((0, 1 - wx), (1, wx)):
+                rows.append(pixels)
+                cols.append(order[(iy + dy)[:, None], (ix + dx)[None, :]])
+                vals.append(fy[:, None] * fx[None, :])
+        rows, cols, vals = (np.concatenate([a.ravel() for a in l]) for l in (rows, cols, vals))
+        return x, y, rows, cols, vals, None
 
+    def _scatteredOperator(self, x, y, method):
+        """
+        Mapping for scattered positions, equivalent to griddata. Nearest
+        uses the position KD-tree, linear the barycentric weights in
+        the Delaunay triangulation of the positions, and voronoi
+        rasterizes the positions onto the grid. Returns the rows,
+        columns and weights of the operator, and the outside mask.
+        """
+        if method == 'voronoi':
+            cols = voronoiRaster(self.positions, x, y).ravel()
+            return np.arange(x.size), cols, np.ones(x.size), None
+        points = np.vstack((x.ravel(), y.ravel())).T
+        pixels = np.arange(len(points))
+        if method == 'nearest':
+            cols = self.positionIndex.nearest(points)[0]
+            return pixels, cols, np.ones(len(points)), None
+        tri = self.positionIndex.triangulation
+        simplex = tri.find_simplex(points)
+        outside = simplex < 0
+        simplex[outside] = 0
+        T = tri.transform[simplex]
+        b = np.einsum('ijk,ik->ij', T[:, :2], points - T[:, 2])
+        weights = np.hstack((b, 1 - b.sum(axis=1, keepdims=True)))
+        weights[outside] = 0
+        cols = tri.simplices[simplex]
+        return np.repeat(pixels, 3), cols.ravel(), weights.ravel(), outside.reshape(x.shape)
+
+    def _mapGrid(self, oversampling, equal):
+        """
+        The regular grid onto which scattered positions are mapped,
+        as x and y arrays with lower-right origin.
+        """
         xMin, xMax = np.min(self.positions[:,0]), np.max(self.positions[:,0])
         yMin, yMax = np.min(self.positions[:,1]), np.max(self.positions[:,1])
 
@@ -363,31 +1318,14 @@ class Scan(object):
             xmargin = oversampling * xstepsize / 2
             ymargin = oversampling * ystepsize / 2
             y, x = np.mgrid[yMax+ymargin:yMin-ymargin:-ystepsize, xMax+xmargin:xMin-xmargin:-xstepsize]
-        z = griddata(self.positions, values, (x, y), method=method)
-        
-        # we've been assuming lower-right origin. adjust:
-        if origin == 'll':
-            x = np.fliplr(x)
-            y = np.fliplr(y)
-            z = np.fliplr(z)
-        elif origin == 'ur':
-            x = np.flipud(x)
-            y = np.flipud(y)
-            z = np.flipud(z)
-        elif origin == 'ul':
-            x = np.flipud(x)
-            y = np.flipud(y)
-            z = np.flipud(z)
-            x = np.fliplr(x)
-            y = np.fliplr(y)
-            z = np.fliplr(z)
-
-        return x, y, z
-    
-    def export(self, filepath, method='reshape', shape=None, oversampling=1, equal=True):
+        return x, y
+
+    def export(self, filepath, method='reshape', shape=None, oversampling=1, equal=True,
+               compression='lzf', nThreads=1, access='frames'):
         """ 
         Dumps data into a single HDF5 file in order to allow export into other software
-        or reload later.
+        or reload later. Datasets are written in chunk-aligned blocks, so
+        that lazy and segmented data is never loaded all at once.
 
         filepath: full path and name of the output file
         method: "reshape"  - attempt to cast the data on a regular grid,
@@ -398,12 +1336,21 @@ class Scan(object):
         oversampling: the oversampling ratio relative to the typical step size,
                       used with "resample"
         equal:  use equal step sizes in x and y for "resample"
+        compression: 'lzf', 'gzip', 'bitshuffle' (LZ4, needs bitshuffle) or None
+        nThreads: number of threads compressing chunks, used with 'gzip'
+                  and 'bitshuffle'
+        access: how the file will be read, which decides the chunk shapes,
+                "frames" - whole frames at a time (default),
+                "maps" - all positions for a few pixels or channels at a time,
+                "balanced" - a compromise, see _calcChunkSize
         """
         # this only applies for 1D and 2D scans
         assert self.nDimensions in (1, 2)
 
         # check input arguments
         assert method in ('reshape', 'resample', 'none')
+        assert compression in writers.COMPRESSIONS
+        assert access in ('frames', 'maps', 'balanced')
 
         # export to hdf5 file
         with h5py.File(filepath, 'w-', libver='earliest') as h5f:
@@ -420,83 +1367,136 @@ class Scan(object):
             grp_path = "/entry0/data"
             grp = h5f.create_group(grp_path)
             # save positions
+            operator, outside = None, None
             if method == 'reshape':
                 if shape is None:
                     shape, fast_axis_label = self._shapeFromPositions2D(self.positions[:,0],self.positions[:,1])
                     if not np.prod(shape) == self.nPositions:
                         raise Exception('Something went really wrong when trying to reshape the scan grid')
                     print("Fast axis detectected to be: %s" % (fast_axis_label,))
-                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=self.positions[:,0], shape=shape, dtype=np.float, compression="lzf")
-                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=self.positions[:,1], shape=shape, dtype=np.float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=self.positions[:,0].reshape(shape), dtype=float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=self.positions[:,1].reshape(shape), dtype=float, compression="lzf")
             elif method == 'resample':
-                x, y = self.interpolatedMap(np.zeros(self.nPositions), oversampling, equal=equal)[:2]
+                # the cached interpolation weights, applied block by block
+                x, y, operator, outside = self.mapOperator(oversampling, equal=equal)
                 shape = x.shape
-                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=x, dtype=np.float, compression="lzf")
-                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=y, dtype=np.float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=x, dtype=float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=y, dtype=float, compression="lzf")
             elif method == 'none':
-                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=self.positions[:,0], dtype=np.float, compression="lzf")
-                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=self.positions[:,1], dtype=np.float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_x", data=self.positions[:,0], dtype=float, compression="lzf")
+                dset = h5f.create_dataset(name=grp_path+"/positions_y", data=self.positions[:,1], dtype=float, compression="lzf")
             # create datasets
             for dsetname in self.data.keys():
                 # total data shape
                 if method in ('reshape', 'resample'):
-                    shp = shape + self.data[dsetname].shape[1:]
+                    shp = tuple(shape) + self.data[dsetname].shape[1:]
                 else:
                     shp = self.data[dsetname].shape
                 # chunking
                 dt = self.data[dsetname].dtype
-                chunk = self._calcChunkSize(shp, dt.itemsize)
-                print("%s, shape: %s, chunk: %s" % (dsetname, shp, chunk,))
-                # what data to write?
-                if method in ('reshape', 'none'):
-                    data = self.data[dsetname]
-                elif method == 'resample':
-                    data = self.interpolatedMap(self.data[dsetname], oversampling, equal=equal)[-1]
+                scanDims = 2 if method in ('reshape', 'resample') else 1
+                chunk = self._calcChunkSize(shp, dt.itemsize, access, scanDims)
+                dset = writers.createDataset(grp, dsetname, shp, dt, chunk or None, compression)
+                print("%s, shape: %s, chunk: %s" % (dsetname, shp, dset.chunks,))
                 # write it
-                if chunk not in [None,[]]:
-                    dset = h5f.create_dataset(name=grp_path+"/"+dsetname, data=data, shape=shp, chunks=chunk, dtype=dt, compression="lzf")
-                else:
-                    dset = h5f.create_dataset(name=grp_path+"/"+dsetname, data=data, shape=shp, dtype=dt, compression="lzf")
+                blocks = self._exportBlocks(dsetname, dset, method, operator, outside)
+                writers.writeBlocks(dset, blocks, compression, nThreads)
             print("Scan data were exported to %s:%s" % (filepath,grp_path,))
 
-    def _calcChunkSize(self,shape,dsize):
+    def _exportBlocks(self, name, dset, method, operator=None, outside=None):
+        """
+        Generator yielding chunk-aligned (offset, block) pairs of dset
+        for export(), reading or resampling only the positions and
+        pixels needed for each block. For resampling, operator and
+        outside are as from mapOperator.
+        """
+        data = self.data[name]
+        gridded = method in ('reshape', 'resample')
+        scanDims = 2 if gridded else 1
+        # blocks are whole lines of the grid, so that the positions of
+        # a block are consecutive
+        shape = writers.blockShape(dset, full=(1,) if gridded else ())
+        nx = dset.shape[1] if gridded else 1
+        for offset in writers.blockOffsets(dset.shape, shape):
+            stop = min(offset[0] + shape[0], dset.shape[0])
+            pixels = slice(offset[0] * nx, stop * nx)
+            frame = tuple(slice(o, o + n) for o, n in zip(offset[scanDims:], shape[scanDims:]))
+            if method in ('reshape', 'none'):
+                block = np.asarray(data[(pixels,) + frame])
+            else:
+                # only the positions used by these rows of the map
+                band = operator[pixels]
+                cols = np.unique(band.indices)
+                values = np.asarray(data[(cols,) + frame])
+                flat = values.reshape((len(cols), -1))
+                if flat.dtype.kind in 'iub':
+                    flat = flat.astype(float)
+                block = band[:, cols] @ flat
+                if outside is not None:
+                    block[outside[pixels]] = np.nan
+                block = block.reshape((-1,) + values.shape[1:])
+            yield offset, block.reshape((stop - offset[0],) + dset.shape[1:scanDims] + block.shape[1:])
+
+    def _calcChunkSize(self, shape, dsize, access='frames', scanDims=1):
         """ 
         Returns optimal shape of chunks for this type of data. Returns none if chunking is discouraged.
+
+        The first scanDims dimensions of shape are positions and the
+        others the frame, and access is the reading pattern to suit:
+        'frames' keeps whole frames in a chunk, 'maps' keeps all
+        positions for a few pixels, and 'balanced' splits the chunk
+        evenly between positions and pixels. Data without frame
+        dimensions is chunked along the positions only.
         """
         maxChunkSz = 1 << 22 # 22 ... 4Mib, 20 ... 1MiB, 10 ... 1kiB
-        # determine chunk dimensions
-        dims = len(shape)
-        if dims==0:
+        frameChunkSz = 1 << 20 # smaller, as single frames are read
+        shape = tuple(int(n) for n in shape)
+        if not shape or dsize * np.prod(shape) <= maxChunkSz:
             # no chunking
             return None
-        elif dims==1:
-            # calc chunk size directly
-            if dsize*shape[0]<=maxChunkSz:
-                # no sense for chunking for this dimension
-                return None
-            else:
-                return (int(maxChunkSz/dsize),) 
-        else:
-            # try chunking just on the last dimension
-            chunk = self._calcChunkSize(shape[-1:], dsize)
-            if chunk:
-                # chunking here is adviced, just do it
-                return (1,)*(dims-1) + chunk 
-            else:
-                # chunking on the last dim is not adviced (too small), try next
-                dsz = shape[-1]*dsize
-                chunk = self._calcChunkSize(shape[:-1], dsz)
-                if chunk:
-                    # use chunking
-                    return chunk + (shape[-1],)
-                else:
-                    # chunking was not adviced
-                    from operator import mul
-                    if dsize*reduce(mul,shape)>maxChunkSz:
-                        # chunk everything
-                        return shape
-                    else:
-                        return None
+        budget = max(1, maxChunkSz // dsize)
+        positionDims = list(range(scanDims))
+        frameDims = list(range(scanDims, len(shape)))
+        chunk = [1] * len(shape)
+        if access not in ('frames', 'maps', 'balanced'):
+            raise ValueError("access should be 'frames', 'maps' or 'balanced'")
+        if not frameDims:
+            self._fillChunk(chunk, shape, positionDims[::-1], budget)
+        elif access == 'frames':
+            self._fillChunk(chunk, shape, frameDims[::-1], budget)
+            frameSize = int(np.prod([chunk[d] for d in frameDims]))
+            self._fillChunk(chunk, shape, positionDims[::-1], frameChunkSz // dsize // frameSize)
+        elif access == 'maps':
+            budget = self._fillChunk(chunk, shape, positionDims[::-1], budget)
+            self._balanceChunk(chunk, shape, frameDims, budget)
+        elif access == 'balanced':
+            self._balanceChunk(chunk, shape, positionDims, int(budget ** .5))
+            budget //= int(np.prod([chunk[d] for d in positionDims]))
+            self._balanceChunk(chunk, shape, frameDims, budget)
+        return tuple(chunk)
+
+    @staticmethod
+    def _fillChunk(chunk, shape, dims, budget):
+        """
+        Extends the chunk over the dimensions dims in order, each as
+        far as the budget (in elements) allows. Returns what is left.
+        """
+        for d in dims:
+            chunk[d] = max(1, min(shape[d], budget))
+            budget //= chunk[d]
+        return budget
+
+    @staticmethod
+    def _balanceChunk(chunk, shape, dims, budget):
+        """
+        Shares the budget (in elements) out evenly over the dimensions
+        dims, giving what small dimensions can't use to the others.
+        """
+        dims = sorted(dims, key=lambda d: shape[d])
+        for i, d in enumerate(dims):
+            n = int(budget ** (1. / (len(dims) - i)) + 1e-6)
+            chunk[d] = max(1, min(shape[d], n))
+            budget //= chunk[d]
 
     def _shapeFromPositions2D(self,x,y):
         """ 
@@ -520,7 +1520,7 @@ class Scan(object):
 
         idx_breaks = np.where(fast_axis_adiff>fast_axis_total_diff/2.)
         dim = np.diff(np.insert(idx_breaks,0,-1))
-        fast_axis_dim = np.mean(dim,dtype=np.int)
+        fast_axis_dim = int(np.mean(dim))
         if np.all(dim!=fast_axis_dim):
             print("Warning: something wrong in fast axis length calculation")
         slow_axis_dim = fast_axis.size // fast_axis_dim
@@ -8,6 +8,10 @@ except ImportError:
     HAS_HDF5PLUGIN = False
     
 from .Scan import *
+from .lazy import LazyDataset
+from .segmented import SegmentedDataset
+from .scaled import ScaledDataset
+from .cache import ProductCache
 from .dummy import *
 from .nanomax_nov2017 import flyscan_nov2017
 from .nanomax_nov2018 import *
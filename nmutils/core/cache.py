@@ -0,0 +1,146 @@
+"""
+A persistent, content-addressed cache of reduced scan products, such
+as average frames, per-position sums, ROI integrals and centers of
+mass. Products are stored under a hash of everything they depend on,
+typically the loader and its options, the path, modification time and
+size of the source files, and the arguments of the reduction. A
+changed file therefore never matches an old entry, which just ages
+out of the cache.
+
+Each product is an npz file in the cache directory. The least recently
+used ones are deleted when the directory grows beyond
+ProductCache.maxBytes.
+"""
+
+import os
+import zipfile
+import hashlib
+import tempfile
+import numpy as np
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+def _defaultDirectory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nmutils')
+
+
+class ProductCache(object):
+    """
+    Directory of npz files holding one array each, keyed on hashes
+    made with key(). Reading an entry marks it as recently used by
+    touching its modification time.
+    """
+
+    # total size of the cached files
+    maxBytes = 1 << 30 # 1 GiB
+
+    def __init__(self, directory=None, maxBytes=None):
+        self.directory = _defaultDirectory() if directory is None else directory
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+
+    @staticmethod
+    def _update(h, part):
+        """
+        Feeds a key part into a hash. Arrays are hashed by content,
+        sequences and dicts element by element, and the rest by repr.
+        """
+        if isinstance(part, np.ndarray):
+            h.update(repr(('array', part.dtype.str, part.shape)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (list, tuple)):
+            h.update(('%s%u(' % (type(part).__name__, len(part))).encode())
+            for item in part:
+                ProductCache._update(h, item)
+            h.update(b')')
+        elif isinstance(part, dict):
+            ProductCache._update(h, sorted(part.items(), key=lambda item: repr(item[0])))
+        else:
+            h.update(repr(part).encode())
+        h.update(b'\0')
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hex digest identifying the given parts.
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            ProductCache._update(h, part)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the array stored under key, or None if there is none.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                value = npz['value']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """
+        Stores an array under key, then evicts old entries if needed.
+        The file is written under a temporary name and then renamed,
+        so that other processes never see it half written.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    np.savez(fp, value=np.asarray(value))
+                os.replace(tmp, self._path(key))
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError as e:
+            print('could not write to the cache in %s: %s' % (self.directory, e))
+            return
+        self.evict()
+
+    def evict(self, maxBytes=None):
+        """
+        Deletes the least recently used entries until the cache takes
+        at most maxBytes, by default self.maxBytes.
+        """
+        maxBytes = self.maxBytes if maxBytes is None else maxBytes
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.npz'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Deletes all entries.
+        """
+        self.evict(0)
+
+
+# the cache shared by all scans in this process
+store = ProductCache()
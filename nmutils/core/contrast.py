@@ -1,4 +1,6 @@
 from . import Scan
+from .lazy import LazyDataset
+from .readers import readFrames, frameLayout, readBuffers
 from ..utils import fastBinPixels
 from .. import NoDataException
 import numpy as np
@@ -11,6 +13,12 @@ class contrast_scan(Scan):
     General format for Contrast at NanoMAX.
     """
 
+    # options which determine the positions, see Scan.positionOptions
+    positionOptions = ('fileName', 'xMotor', 'yMotor', 'nMaxPositions', 'globalPositions')
+
+    # _readData() respects self.firstPosition, see Scan.refresh()
+    incrementalReading = True
+
     alba_names = ['alba%u/%u'%(i,j) for i in (2,0) for j in (1,2,3,4)]
     default_opts = {
         'scanNr': {
@@ -51,13 +59,18 @@ class contrast_scan(Scan):
         'xrdBinning': {
             'value': 1,
             'type': int,
-            'doc': 'bin pixels n by n (disables cropping)',
+            'doc': 'bin pixels n by n (after cropping)',
             },
         'I0': {
             'value': '',
             'type': str,
             'doc': 'channel over which to normalize signals, eg "alba2/1"',
             },
+        'normalizeOnRead': {
+            'value': False,
+            'type': bool,
+            'doc': 'normalize 2D detector frames as they are read, giving plain arrays which need a reload to change I0',
+            },
         'waxsPath': {
             'value': '../../process/azint/<sampledir>',
             'type': str,
@@ -83,11 +96,32 @@ class contrast_scan(Scan):
             'type': bool,
             'doc': 'adds base motor values to piezo positions',
         },
+        'burstOp': {
+            'value': 'sum',
+            'type': ['sum', 'mean', 'max'],
+            'doc': 'how to combine 2D detector bursts taken at each position',
+        },
+        'nWorkers': {
+            'value': 1,
+            'type': int,
+            'doc': 'number of processes reading 2D detector data in parallel',
+        },
+        'directChunks': {
+            'value': True,
+            'type': bool,
+            'doc': 'decompress bitshuffle/LZ4 (Eiger) chunks directly in nWorkers threads',
+        },
+        'lazy': {
+            'value': False,
+            'type': bool,
+            'doc': 'read 2D detector frames from file on demand instead of loading them',
+        },
         'cake_downsample': {
             'value': 1,
             'type': int,
             'doc': 'how to downsample cake data to save memory (1 for no binning)',
         },
+        'dataType': Scan.dataTypeOption,
     }
 
     # an optional class attribute which lets scanViewer know what
@@ -115,6 +149,9 @@ class contrast_scan(Scan):
     sourceDims.update(albaDims)
     assert sorted(sourceDims.keys()) == sorted(default_opts['dataSource']['type'])
 
+    # sources read as stacks of detector frames
+    areaDetectors = ('merlin', 'pilatus', 'pilatus1m', 'eiger(old)', 'eiger500k', 'eiger1m', 'eiger4m', 'andor', 'selunCZT')
+
     def _prepareData(self, **kwargs):
         """ 
         This method gets the kwargs passed to the addData() method, and
@@ -139,7 +176,7 @@ class contrast_scan(Scan):
         path_options = ['entry/snapshot/',
                         'entry/snapshots/pre_scan/',
                         'entry/snapshots/prost_scan/']
-        with h5py.File(self.fileName, 'r') as F:
+        with self._openFile(self.fileName) as F:
             existing_paths = [x for x in path_options if x in F.keys()]
         if existing_paths==[]:
             print('[!] no snapshot found in scan file')
@@ -155,7 +192,7 @@ class contrast_scan(Scan):
         if not os.path.exists(self.fileName):
             print('File not found! \n    ', self.fileName)
             raise NoDataException(self.fileName)
-        with h5py.File(self.fileName, 'r') as fp:
+        with self._openFile(self.fileName) as fp:
             # replace sx, sy, sz by buffered positions
             if 'entry/measurement/npoint_buff' in fp:
                 mapping = {'s%s'%dim: 'npoint_buff/%s'%dim for dim in 'xyz'}
@@ -228,69 +265,51 @@ class contrast_scan(Scan):
         Override data reading. In principle these are the same for
         all data sources (except WAXS), it's just that there are
         some detector-specific cropping and channel options to respect.
+        Only positions from self.firstPosition onwards are returned.
         """
+        first = self.firstPosition
 
-        if self.I0:
-            with h5py.File(self.fileName, 'r') as fp:
-                try:
-                    I0_data = fp['entry/measurement/%s' % self.I0][:].flatten()
-                except KeyError:
-                    print('I0 data %s not found'%self.I0)
-                    raise NoDataException()
-
-        if self.dataSource in ('merlin', 'pilatus', 'pilatus1m', 'eiger(old)', 'eiger500k', 'eiger1m', 'eiger4m', 'andor', 'selunCZT'):
+        if self.dataSource in self.areaDetectors:
             print('loading %s data...' % self.dataSource)
-            if self.dataSource == 'eiger(old)':
-                self.dataSource = 'eiger' # legacy thing
-            with h5py.File(self.fileName, 'r') as fp:
-                try:
-                    group = fp['entry/measurement/%s' % self.dataSource]
-                except KeyError:
-                    raise NoDataException()
-                if 'frames' in group:
-                    dset = group['frames']
-                elif 'data' in group:
-                    dset = group['data']
-                else:
-                    print('couldnt find %s'%self.dataSource)
-                    raise NoDataException()
+            with self._openFile(self.fileName) as fp:
+                dset = self._detectorDataset(fp)
+                if self.dataSource == 'eiger(old)':
+                    self.dataSource = 'eiger' # legacy thing
 
                 # find out what to load
-                if self.xrdCropping:
-                    i0, i1, j0, j1 = self.xrdCropping
+                crop, im_per_pos, nmax = self._detectorLayout(dset)
+                bursts = im_per_pos > 1
+
+                # normalize each block as it is read, if asked to
+                scale = self._readScale() if self.normalizeOnRead else None
+                if scale is not None:
+                    nmax = min(nmax, first + len(scale))
+                    scale = scale[:max(nmax - first, 0)]
+
+                if self.lazy and (bursts or self.xrdBinning > 1):
+                    print('lazy mode is not available with bursts or binning, loading everything')
+                if self.lazy and not (bursts or self.xrdBinning > 1):
+                    data = LazyDataset(self.fileName, dset.name, index=np.arange(first, nmax),
+                                       crop=crop, scale=scale,
+                                       dtype=self._storageDtype(dset.dtype, scaled=scale is not None))
+                    print('reading %s frames on demand from %s' % (str(data.shape), self.fileName))
                 else:
-                    i0, i1 = 0, dset.shape[-2]
-                    j0, j1 = 0, dset.shape[-1]                    
-
-                # maybe there were detector bursts - then no need to allocate the whole thing
-                im_per_pos = None
-                if dset.shape[0] > self.nAvailablePositions:
-                    nmax = self.nAvailablePositions
-                    if self.nMaxPositions:
-                        nmax = self.nMaxPositions
-                    im_per_pos = dset.shape[0] // self.nAvailablePositions
-                    print('more images than positions, assuming bursts of %u were made and summing these'%im_per_pos)
-                    data = np.empty(dtype=dset.dtype, shape=(nmax, *dset.shape[1:]))
-                    for i in range(nmax):
-                        data[i] = np.sum(dset[i*im_per_pos:(i+1)*im_per_pos], axis=0)
-                elif self.nMaxPositions:
-                    data = dset[:self.nMaxPositions, i0:i1, j0:j1]
-                elif self.xrdBinning == 1:
-                    data = dset[:, i0:i1, j0:j1]
-                else:
-                    shape = fastBinPixels(dset[0], self.xrdBinning).shape
-                    new_data_ = np.zeros((dset.shape[0],) + shape)
-                    for ii in range(dset.shape[0]):
-                        print('binning frame %u'%ii)
-                        new_data_[ii] = fastBinPixels(dset[ii], self.xrdBinning)
-                    data = new_data_
-
-            if self.I0:
-                data = data / I0_data[:, None, None]
+                    if bursts:
+                        print('more images than positions, assuming bursts of %u were made and taking the %s of these'%(im_per_pos, self.burstOp))
+                    dtype = frameLayout(self.fileName, dset.name, first, nmax, crop=crop,
+                                        burst=im_per_pos, burstOp=self.burstOp,
+                                        binning=self.xrdBinning, swmr=self.swmr)[1]
+                    data = readFrames(self.fileName, dset.name, first, nmax, crop=crop,
+                                      burst=im_per_pos, burstOp=self.burstOp,
+                                      binning=self.xrdBinning, scale=scale,
+                                      nWorkers=self.nWorkers,
+                                      directChunks=self.directChunks,
+                                      swmr=self.swmr,
+                                      dtype=self._storageDtype(dtype, scaled=scale is not None))
 
         elif self.dataSource in ('xspress3', 'x3mini'):
 
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 try:
                     dset = fp['entry/measurement/%s/data' % self.dataSource]
                 except KeyError:
@@ -308,19 +327,15 @@ class contrast_scan(Scan):
                     chans = self.xspress3Channels
                 else:
                     chans = self.x3miniChannels
-                data = np.sum(dset[:, chans, i0:i1], axis=1)
-
-            if self.I0:
-                print('****, %s, %s, %s'%(data.shape, I0_data.shape, I0_data[:, None].shape))
-                data = data / I0_data[:, None]
+                data = np.sum(dset[first:, chans, i0:i1], axis=1)
 
             self.dataDimLabels[name] = ['Approx. energy (keV)']
             self.dataAxes[name] = [np.arange(data.shape[-1]) * .01]
 
         elif self.sourceDims[self.dataSource] == 0:
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 try:
-                    data = fp['entry/measurement/%s' % self.dataSource][:]
+                    data = fp['entry/measurement/%s' % self.dataSource][first:]
                     print('#'*20)
                     print(f'did load {self.dataSource} ({np.shape(data)})')
                     data = data.flatten()
@@ -328,9 +343,6 @@ class contrast_scan(Scan):
                     print('couldnt find %s'%self.dataSource)
                     raise NoDataException
 
-            if self.I0:
-                data = data / I0_data
-
         elif self.dataSource in ('waxs', 'cake'):
             if self.waxsPath[0] == '/':
                 path = self.waxsPath
@@ -352,12 +364,12 @@ class contrast_scan(Scan):
             nmax = self.nAvailablePositions
             if self.nMaxPositions:
                 nmax = self.nMaxPositions
-            with h5py.File(waxs_file, 'r') as fp:
+            with self._openFile(waxs_file) as fp:
                 # waxs file is from the azint 2023 pipeline which is a bit like a NEXUS file
                 if 'entry' in fp:
                     print(f"waxs data is in azint pipeline (2023) format")
                     if self.dataSource == 'cake':
-                        dset = fp['/entry/data2d/cake'][:nmax]
+                        dset = fp['/entry/data2d/cake']
                         phi = fp['/entry/data2d/azi'][:]
 
                         if '/entry/data2d/q' in fp.keys():
@@ -372,7 +384,7 @@ class contrast_scan(Scan):
                         q = x_axis
 
                     elif self.dataSource == 'waxs':
-                        dset = fp['/entry/data1d/I'][:nmax]
+                        dset = fp['/entry/data1d/I']
                         if '/entry/data1d/q' in fp.keys():
                             x_axis = fp['/entry/data1d/q'][:]
                             x_label = 'q (1/nm)'
@@ -397,18 +409,16 @@ class contrast_scan(Scan):
                             raise NoDataException(f'azimuthal bins do not exist in {waxs_file}')
                     dset = fp['I']
                 if self.cake_downsample == 1:
-                    data = dset[:nmax]
+                    data = dset[first:nmax]
                 else:
                     shape = fastBinPixels(dset[0], self.cake_downsample).shape
-                    new_data_ = np.zeros((nmax,) + shape)
-                    for ii in range(nmax):
-                        new_data_[ii] = fastBinPixels(dset[ii], self.cake_downsample)
-                        print('downsampling cake frame %u'%ii)
+                    frames = range(first, min(nmax, dset.shape[0]))
+                    new_data_ = np.zeros((len(frames),) + shape, dtype=self._storageDtype(np.float64))
+                    for ii, frame in enumerate(frames):
+                        new_data_[ii] = fastBinPixels(dset[frame], self.cake_downsample)
+                        print('downsampling cake frame %u'%frame)
                     data = new_data_
 
-            if self.I0:
-                print('****, %s, %s, %s'%(data.shape, I0_data.shape, I0_data[:, None].shape))
-                data = data / I0_data[:, None]
             if self.dataSource == 'waxs':
                 self.dataAxes[name] = [q,]
                 self.dataDimLabels[name] = [x_label]
@@ -417,7 +427,7 @@ class contrast_scan(Scan):
                 self.dataDimLabels[name] = ['phi (rad.)', x_label]
 
         elif self.dataSource in ('qepro'):
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 dset = fp['entry/measurement/%s' % self.dataSource]
                 data = dset['frames'][:]
                 wavelengths = dset['wavelength'][:]
@@ -428,3 +438,101 @@ class contrast_scan(Scan):
             raise RuntimeError('Something is seriously wrong, we should never end up here since _updateOpts checks the options.')
         
         return data
+
+    def _detectorDataset(self, fp):
+        """
+        Finds the frames of the area detector in an open file.
+        """
+        source = 'eiger' if self.dataSource == 'eiger(old)' else self.dataSource
+        try:
+            group = fp['entry/measurement/%s' % source]
+        except KeyError:
+            raise NoDataException()
+        if 'frames' in group:
+            return group['frames']
+        elif 'data' in group:
+            return group['data']
+        print('couldnt find %s'%self.dataSource)
+        raise NoDataException()
+
+    def _detectorLayout(self, dset):
+        """
+        Works out the frame crop, the number of images per position
+        and the position to stop at for reading area detector data.
+        """
+        if self.xrdCropping:
+            i0, i1, j0, j1 = self.xrdCropping
+        else:
+            i0, i1 = 0, dset.shape[-2]
+            j0, j1 = 0, dset.shape[-1]
+
+        # maybe there were detector bursts, which are reduced while reading
+        bursts = dset.shape[0] > self.nAvailablePositions
+        im_per_pos = dset.shape[0] // self.nAvailablePositions if bursts else 1
+        nmax = self.nAvailablePositions if bursts else dset.shape[0]
+        if self.nMaxPositions:
+            nmax = min(nmax, self.nMaxPositions)
+        return (slice(i0, i1), slice(j0, j1)), im_per_pos, nmax
+
+    def _estimateData(self, name):
+        """
+        The (shape, dtype, transient) of area detector data as
+        _readData() would load it, from the file metadata. Data
+        normalized on reading is stored in the normalized dtype, and the
+        read buffers of readFrames come on top. Lazily loaded frames
+        stay on disk, and the other sources are assumed to be small.
+        """
+        if self.dataSource not in self.areaDetectors:
+            return None
+        scaled = self.normalizeOnRead and bool(self.I0)
+        with self._openFile(self.fileName) as fp:
+            dset = self._detectorDataset(fp)
+            crop, im_per_pos, nmax = self._detectorLayout(dset)
+            if self.lazy and im_per_pos == 1 and self.xrdBinning == 1:
+                return None
+            layout = {'crop': crop, 'burst': im_per_pos, 'burstOp': self.burstOp,
+                      'binning': self.xrdBinning, 'swmr': self.swmr}
+            shape, dtype = frameLayout(self.fileName, dset.name, self.firstPosition, nmax, **layout)
+            dtype = self._storageDtype(dtype, scaled=scaled)
+            transient = readBuffers(self.fileName, dset.name, self.firstPosition, nmax,
+                                    scaled=scaled, nWorkers=self.nWorkers,
+                                    directChunks=self.directChunks, dtype=dtype, **layout)
+        return shape, dtype, transient
+
+    def _memoryOptions(self, name):
+        """
+        Lazy mode where possible, then more binning, then centered
+        crops of half and a quarter of the frame size.
+        """
+        if self.dataSource not in self.areaDetectors:
+            return []
+        with self._openFile(self.fileName) as fp:
+            crop, im_per_pos, nmax = self._detectorLayout(self._detectorDataset(fp))
+        options = []
+        if im_per_pos == 1 and self.xrdBinning == 1 and not self.lazy:
+            options.append({'lazy': True})
+        for factor in (2, 4, 8):
+            options.append({'xrdBinning': self.xrdBinning * factor})
+        (i0, i1), (j0, j1) = [(s.start, s.stop) for s in crop]
+        for factor in (4, 8):
+            di, dj = (i1 - i0) // factor, (j1 - j0) // factor
+            ic, jc = (i0 + i1) // 2, (j0 + j1) // 2
+            options.append({'xrdCropping': [ic - di, ic + di, jc - dj, jc + dj]})
+        return options
+
+    def _readI0(self, channel=None):
+        """
+        Reads the I0 channel, by default that of the I0 option, from
+        self.firstPosition onwards. The qepro spectra are only
+        normalized when a channel is given explicitly.
+        """
+        if channel is None:
+            channel = '' if self.dataSource == 'qepro' else self.I0
+        if not channel:
+            return None
+        with self._openFile(self.fileName) as fp:
+            try:
+                return fp['entry/measurement/%s' % channel][:].flatten()[self.firstPosition:]
+            except KeyError:
+                print('I0 data %s not found'%channel)
+                raise NoDataException()
@@ -59,6 +59,7 @@ class contrast_stepscan_old(Scan):
             'type': bool,
             'doc': 'whether to normalize against I0 (ni/counter1)',
             },
+        'dataType': Scan.dataTypeOption,
         'nominalPositions': {
             'value': False,
             'type': bool,
@@ -88,6 +89,9 @@ class contrast_stepscan_old(Scan):
     sourceDims.update(albaDims)
     assert sorted(sourceDims.keys()) == sorted(default_opts['dataSource']['type'])
 
+    # options which determine the positions, see Scan.positionOptions
+    positionOptions = ('fileName', 'xMotor', 'yMotor', 'nominalPositions', 'nMaxPositions')
+
     def _prepareData(self, **kwargs):
         """ 
         This method gets the kwargs passed to the addData() method, and
@@ -110,6 +114,7 @@ class contrast_stepscan_old(Scan):
         self.xrdCropping = opts['xrdCropping']['value']
         self.xrdBinning = int(opts['xrdBinning']['value'])
         self.normalize_by_I0 = (opts['normalize_by_I0']['value'])
+        self.dataType = opts['dataType']['value']
         self.nominalPositions = bool(opts['nominalPositions']['value'])
         self.waxsPath = opts['waxsPath']['value']
         self.burstSum = opts['burstSum']['value']
@@ -117,7 +122,7 @@ class contrast_stepscan_old(Scan):
 
         # Sanity check
         try:
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 pass
         except OSError:
             raise NoDataException('Could not find or open the file %s' % self.fileName)
@@ -128,7 +133,7 @@ class contrast_stepscan_old(Scan):
         """
 
         if not os.path.exists(self.fileName): raise NoDataException
-        with h5py.File(self.fileName, 'r') as hf:
+        with self._openFile(self.fileName) as hf:
             x = np.array(hf.get('entry/measurement/%s' % self.xMotor))
             y = np.array(hf.get('entry/measurement/%s' % self.yMotor))
         if self.nMaxPositions:
@@ -155,13 +160,6 @@ class contrast_stepscan_old(Scan):
         path of the Lima hdf5 files.
         """
 
-        if self.normalize_by_I0:
-            if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as hf:
-                I0_data = self._safe_get_array(hf, 'entry/measurement/ni/counter1')
-                I0_data = I0_data.astype(float) * 1e-5
-                print(I0_data)
-
         if self.dataSource in ('merlin', 'pilatus', 'pilatus1m'):
             print("loading diffraction data...")
             path = os.path.split(os.path.abspath(self.fileName))[0]
@@ -171,7 +169,7 @@ class contrast_stepscan_old(Scan):
             missing = 0
             hdf_pattern = 'entry/measurement/%s/%%06u' % self.dataSource
 
-            with h5py.File(self.fileName, 'r') as hf:
+            with self._openFile(self.fileName) as hf:
                 print('loading diffraction data: ' + self.fileName)
                 for im in range(self.positions.shape[0]):
                     if self.nMaxPositions and im == self.nMaxPositions:
@@ -211,28 +209,24 @@ class contrast_stepscan_old(Scan):
             if missing:
                 print("there were %d missing images" % missing)
             data = np.array(data)
-            if self.normalize_by_I0:
-                data = data / I0_data[:, None, None]
 
         elif self.dataSource == 'xspress3':
             print("loading fluorescence data...")
             print("selecting xspress3 channel %d"%self.xrfChannel)
             data = []
-            with h5py.File(self.fileName, 'r') as hf:
+            with self._openFile(self.fileName) as hf:
                 for im in range(self.positions.shape[0]):
                     dataset = self._safe_get_dataset(hf, 'entry/measurement/xspress3/%06d' % im)
                     if not dataset:
                         break
                     data.append(np.array(dataset)[0, self.xrfChannel, :4096])
             data = np.array(data)
-            if self.normalize_by_I0:
-                data = data / I0_data[:, None]
             self.dataDimLabels[name] = ['Approx. energy (keV)']
             self.dataAxes[name] = [np.arange(data.shape[-1]) * .01]
 
         elif 'ni/' in self.dataSource or 'alba' in self.dataSource:
             entry = 'entry/measurement/%s' % self.dataSource
-            with h5py.File(self.fileName, 'r') as hf:
+            with self._openFile(self.fileName) as hf:
                 data = self._safe_get_array(hf, entry)
                 data = data.astype(float)
                 data = data.flatten()
@@ -248,7 +242,7 @@ class contrast_stepscan_old(Scan):
             waxsfn = fn.replace('.h5', '_waxs.h5')
             waxs_file = os.path.join(path, waxsfn)
             print('loading waxs data from %s' % waxs_file)
-            with h5py.File(waxs_file, 'r') as fp:
+            with self._openFile(waxs_file) as fp:
                 q = self._safe_get_array(fp, 'q')
                 I = self._safe_get_array(fp, 'I')
             data = I
@@ -260,6 +254,24 @@ class contrast_stepscan_old(Scan):
         
         return data
 
+    def _readI0(self, channel=None):
+        """
+        Reads the I0 channel. By default this is ni/counter1 if
+        normalize_by_I0 is set, which applies to the detector data.
+        """
+        if channel is None:
+            detector = self.dataSource in ('merlin', 'pilatus', 'pilatus1m', 'xspress3')
+            channel = 'ni/counter1' if (self.normalize_by_I0 and detector) else ''
+        if not channel:
+            return None
+        if not os.path.exists(self.fileName): raise NoDataException
+        with self._openFile(self.fileName) as hf:
+            I0_data = self._safe_get_array(hf, 'entry/measurement/%s' % channel)
+        I0_data = I0_data.astype(float).flatten()
+        if channel == 'ni/counter1':
+            I0_data *= 1e-5
+        return I0_data
+
 from . import Scan
 from ..utils import fastBinPixels
 from .. import NoDataException
@@ -322,6 +334,7 @@ class contrast_flyscan_old(Scan):
         'type': bool,
         'doc': 'whether or not to normalize (all) data against I0',
         },
+    'dataType': Scan.dataTypeOption,
     'waxsPath': {
         'value': '../../process/radial_integration/<sampledir>',
         'type': str,
@@ -338,6 +351,9 @@ class contrast_flyscan_old(Scan):
     sourceDims.update(albaDims)
     assert sorted(sourceDims.keys()) == sorted(default_opts['dataSource']['type'])
 
+    # options which determine the positions, see Scan.positionOptions
+    positionOptions = ('fileName', 'slowMotor', 'nMaxLines', 'globalPositions')
+
     def _prepareData(self, **kwargs):
         """ 
         Parse the derived options
@@ -360,11 +376,12 @@ class contrast_flyscan_old(Scan):
         self.nMaxLines = opts['nMaxLines']['value']
         self.globalPositions = opts['globalPositions']['value']
         self.normalize_by_I0 = opts['normalize_by_I0']['value']
+        self.dataType = opts['dataType']['value']
         self.waxsPath = opts['waxsPath']['value']
 
         # Sanity check
         try:
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 pass
         except OSError:
             raise NoDataException('Could not find or open the file %s' % self.fileName)
@@ -374,7 +391,7 @@ class contrast_flyscan_old(Scan):
         Override position reading.
         """
 
-        with h5py.File(self.fileName, 'r') as fp:
+        with self._openFile(self.fileName) as fp:
             # first, work out which is the flyscan axis and load that
             jranges = [self._safe_get_dataset(fp, 'entry/measurement/npoint_buff/%s'%ax)[0, :].ptp() for ax in 'xyz']
             fast = 'xyz'[np.argmax(jranges)]
@@ -422,7 +439,7 @@ class contrast_flyscan_old(Scan):
 
         # account for base motors
         if self.globalPositions:
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 x += self._safe_get_array(fp, 'entry/snapshot/basex')
                 y += self._safe_get_array(fp, 'entry/snapshot/basey')
 
@@ -437,15 +454,11 @@ class contrast_flyscan_old(Scan):
         path of the Lima hdf5 files.
         """
 
-        if self.normalize_by_I0:
-            with h5py.File(self.fileName, 'r') as fp:
-                I0_data = fp['entry/measurement/ni/counter1'][()].flatten()
-
         if self.dataSource in ('merlin', 'pilatus', 'pilatus1m', 'xspress3'):
             print("Loading %s data..." % self.dataSource)
             crop = (self.dataSource != 'xspress3') and self.xrdCropping
 
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
 
                 # pre-allocate an array, to avoid wasting memory
                 try:
@@ -478,7 +491,7 @@ class contrast_flyscan_old(Scan):
                 self.dataAxes[name] = [np.arange(4096) * .01]
 
         elif (self.dataSource[:4] == 'alba') or self.dataSource == 'adlink' or self.dataSource[:3] == 'ni/':
-            with h5py.File(self.fileName, 'r') as fp:
+            with self._openFile(self.fileName) as fp:
                 data = self._safe_get_array(fp, 'entry/measurement/%s'%self.dataSource).flatten()
 
         elif self.dataSource == 'waxs':
@@ -492,7 +505,7 @@ class contrast_flyscan_old(Scan):
             waxsfn = fn.replace('.h5', '_waxs.h5')
             waxs_file = os.path.join(path, waxsfn)
             print('loading waxs data from %s' % waxs_file)
-            with h5py.File(waxs_file, 'r') as fp:
+            with self._openFile(waxs_file) as fp:
                 q = self._safe_get_array(fp, 'q')
                 I = self._safe_get_array(fp, 'I')
             data = I
@@ -502,11 +515,19 @@ class contrast_flyscan_old(Scan):
         else:
             raise RuntimeError('Something is seriously wrong, we should never end up here since _updateOpts checks the options.')
 
-        # normalize
-        if self.normalize_by_I0:
-            data = (data.T / I0_data[:, ]).T # broadcasting
-
         # select/average the xrf channels
         if self.dataSource == 'xspress3':
             data = np.mean(data[:, self.xrfChannel, :4096], axis=1)
         return data
+
+    def _readI0(self, channel=None):
+        """
+        Reads the I0 channel, by default ni/counter1 if normalize_by_I0
+        is set.
+        """
+        if channel is None:
+            channel = 'ni/counter1' if self.normalize_by_I0 else ''
+        if not channel:
+            return None
+        with self._openFile(self.fileName) as fp:
+            return self._safe_get_array(fp, 'entry/measurement/%s' % channel).flatten()
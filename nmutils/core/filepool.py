@@ -0,0 +1,176 @@
+"""
+A process-wide pool of open, read-only HDF5 files. Opening a file can
+be slow on network file systems, and loading a scan touches the same
+file many times (positions, snapshots, normalization and one or more
+data sources), so the loaders borrow their handles from here instead
+of opening the file each time.
+
+Handles are kept in least-recently-used order and evicted beyond
+FilePool.maxFiles. A file which has been modified since it was opened
+(new mtime or size) is reopened, so that a changing file is never
+read through stale metadata. Handles are borrowed in with statements
+and counted, so a handle is never closed while in use: files which
+are evicted, closed or replaced are closed once they are given back.
+Scans keep their files open between loads until Scan.close().
+"""
+
+import os
+import threading
+import h5py
+from collections import OrderedDict
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+def openFile(fileName, swmr=False):
+    """
+    Opens an HDF5 file for reading, optionally in SWMR mode so that
+    data appended by a running writer can be followed. Falls back to
+    normal mode if SWMR isn't possible. This gives a new handle which
+    is not pooled.
+    """
+    if swmr:
+        try:
+            return h5py.File(fileName, 'r', swmr=True)
+        except (OSError, ValueError):
+            print('could not open %s in SWMR mode, opening normally' % fileName)
+    return h5py.File(fileName, 'r')
+
+
+class _Handle(object):
+    """
+    A pooled file with the (mtime, size) stamp it was opened at and
+    the number of with statements currently using it.
+    """
+    def __init__(self, fp, stamp):
+        self.fp = fp
+        self.stamp = stamp
+        self.borrows = 0
+        self.retired = False
+
+
+class _Borrowed(object):
+    """
+    Context manager which borrows a file from the pool on entry and
+    gives it back on exit, without closing it if it is still pooled.
+    """
+    def __init__(self, pool, fileName, swmr):
+        self.pool = pool
+        self.fileName = fileName
+        self.swmr = swmr
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = self.pool._acquire(self.fileName, self.swmr)
+        return self.handle.fp
+
+    def __exit__(self, *args):
+        self.pool._release(self.handle)
+        self.handle = None
+        return False
+
+
+class FilePool(object):
+    """
+    LRU pool of read-only h5py.File handles, keyed on absolute path
+    and SWMR mode, so that files followed in SWMR mode and files read
+    normally never share a handle.
+
+    Each handle counts its borrowers. A handle which is evicted, closed
+    or replaced because its file changed is retired: it leaves the pool
+    straight away but is only closed when its last borrower gives it
+    back, so that nested with statements on the same file are safe.
+    """
+
+    # maximum number of files kept open
+    maxFiles = 16
+
+    def __init__(self, maxFiles=None):
+        if maxFiles is not None:
+            self.maxFiles = maxFiles
+        self._files = OrderedDict() # (path, swmr) -> _Handle
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _acquire(self, fileName, swmr=False):
+        """
+        Returns a borrowed handle to the file, opening it if it isn't
+        in the pool or has changed since it was opened.
+        """
+        path = os.path.abspath(fileName)
+        key = (path, bool(swmr))
+        stamp = self._stamp(path)
+        with self._lock:
+            handle = self._files.pop(key, None)
+            if handle is not None:
+                if handle.fp.id.valid and handle.stamp == stamp:
+                    self._files[key] = handle
+                    handle.borrows += 1
+                    return handle
+                self._retire(handle)
+            handle = _Handle(openFile(path, swmr=swmr), stamp)
+            handle.borrows += 1
+            self._files[key] = handle
+            while len(self._files) > self.maxFiles:
+                self._retire(self._files.popitem(last=False)[1])
+            return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.borrows -= 1
+            if handle.retired and not handle.borrows:
+                self._close(handle.fp)
+
+    def _retire(self, handle):
+        """
+        Closes a handle which has left the pool, or marks it to be
+        closed when its last borrower gives it back.
+        """
+        handle.retired = True
+        if not handle.borrows:
+            self._close(handle.fp)
+
+    def borrow(self, fileName, swmr=False):
+        """
+        Returns a context manager giving an open handle to the file,
+        for use in with statements. The handle stays in the pool
+        afterwards and must not be closed by the caller.
+        """
+        return _Borrowed(self, fileName, swmr)
+
+    def close(self, fileName=None):
+        """
+        Closes a file in both modes if it is in the pool, or all files
+        by default. Files which are borrowed are closed when they are
+        given back.
+        """
+        with self._lock:
+            if fileName is None:
+                keys = list(self._files.keys())
+            else:
+                path = os.path.abspath(fileName)
+                keys = [key for key in self._files.keys() if key[0] == path]
+            for key in keys:
+                self._retire(self._files.pop(key))
+
+    @staticmethod
+    def _close(fp):
+        try:
+            fp.close()
+        except Exception:
+            pass
+
+    def __contains__(self, fileName):
+        path = os.path.abspath(fileName)
+        return any(key[0] == path for key in self._files.keys())
+
+    def __len__(self):
+        return len(self._files)
+
+
+# the pool shared by all loaders in this process
+pool = FilePool()
@@ -0,0 +1,372 @@
+"""
+Implements the LazyDataset class, an array-like proxy for detector
+stacks which stay in their HDF5 files. Frames are only read when they
+are indexed or reduced, so that the memory footprint scales with the
+working set rather than with the size of the scan. The ArrayProxy base
+class holds what LazyDataset shares with other array stand-ins.
+"""
+
+import numpy as np
+from .filepool import pool
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+class ArrayProxy(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Base class for read-only, array-like stand-ins for (Npositions x
+    ...) arrays. Subclasses provide shape, dtype, __getitem__ and an
+    iterBlocks method yielding (rows, block) pairs, and get the numpy
+    conversions and streamed reductions from here. Arithmetic, ufuncs
+    and the ndarray methods which return new arrays (astype, reshape,
+    copy and so on) work on the data read in full.
+    """
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[:]
+        return a if dtype is None else a.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(x, ArrayProxy) for x in kwargs.get('out', ())):
+            return NotImplemented
+        inputs = tuple(np.asarray(x) if isinstance(x, ArrayProxy) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def astype(self, dtype, copy=True):
+        return np.asarray(self).astype(dtype)
+
+    def copy(self):
+        return np.array(self)
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
+
+    def ravel(self):
+        return np.asarray(self).ravel()
+
+    def flatten(self):
+        return np.asarray(self).flatten()
+
+    def transpose(self, *axes):
+        return np.asarray(self).transpose(*axes)
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+    def _reduce(self, func, axis, out=None, keepdims=False, **kwargs):
+        """
+        Streams a numpy reduction (np.sum or np.max) through the blocks.
+        """
+        if out is not None:
+            raise NotImplementedError('%s reductions do not support out' % self.__class__.__name__)
+        if axis is None:
+            axis = tuple(range(self.ndim))
+        axis = tuple(a % self.ndim for a in np.atleast_1d(axis))
+        result = []
+        for rows, block in self.iterBlocks():
+            part = func(block, axis=axis, keepdims=True, **kwargs)
+            if 0 in axis and len(result):
+                result[0] = func(np.concatenate((result[0], part)), axis=0, keepdims=True)
+            else:
+                result.append(part)
+        result = np.concatenate(result, axis=0)
+        if not keepdims:
+            result = np.squeeze(result, axis=axis)
+        return result
+
+    def sum(self, axis=None, dtype=None, out=None, keepdims=False):
+        return self._reduce(np.sum, axis, out=out, keepdims=keepdims, dtype=dtype)
+
+    def max(self, axis=None, out=None, keepdims=False):
+        return self._reduce(np.max, axis, out=out, keepdims=keepdims)
+
+    def min(self, axis=None, out=None, keepdims=False):
+        return self._reduce(np.min, axis, out=out, keepdims=keepdims)
+
+    def mean(self, axis=None, dtype=None, out=None, keepdims=False):
+        if axis is None:
+            axis = tuple(range(self.ndim))
+        axis = tuple(a % self.ndim for a in np.atleast_1d(axis))
+        n = int(np.prod([self.shape[a] for a in axis]))
+        if dtype is None:
+            dtype = np.float64 if self.dtype.kind in 'iub' else self.dtype
+        return self.sum(axis=axis, dtype=dtype, out=out, keepdims=keepdims) / n
+
+
+class LazyDataset(ArrayProxy):
+    """
+    Read-only, array-like view of an (Npositions x ...) HDF5 dataset.
+
+    Indexing returns numpy arrays and supports integers, slices, index
+    lists and boolean masks, for example data[i], data[:, i0:i1] or
+    data[:, ii, jj]. The sum, mean, min and max methods stream through the
+    file block by block, which means np.mean(data, axis=(1,2)) and
+    friends work without loading everything.
+
+    Rows are mapped onto frames in the file through an index array,
+    where -1 denotes a missing frame. Missing frames read as the
+    average of the existing ones, like np.pad(mode='mean') would give,
+    or as fillValue if that is set.
+    An optional per-position scale vector (for example 1 / I0) is
+    applied to each frame as it is read.
+    """
+
+    # approximate number of bytes read from the file in one go
+    blockBytes = 1 << 27 # 128 MiB
+
+    def __init__(self, fileName, path, index=None, crop=None, scale=None, dtype=None):
+        """
+        fileName: the HDF5 file
+        path: path to the dataset within the file
+        index: source frame for each row, -1 for missing frames
+        crop: tuple of slices to apply to the frame dimensions
+        scale: optional length-N array multiplied onto each frame
+        dtype: the dtype of the frames read, by default that of the
+               dataset and the scale vector together
+        """
+        self.fileName = fileName
+        self.path = path
+        with pool.borrow(fileName) as fp:
+            dset = fp[path]
+            sourceShape = dset.shape
+            sourceDtype = dset.dtype
+            self._sourceChunks = dset.chunks
+
+        if index is None:
+            index = np.arange(sourceShape[0])
+        self.index = np.asarray(index, dtype=int)
+
+        if crop is None:
+            crop = (slice(None),) * (len(sourceShape) - 1)
+        crop = tuple(crop) + (slice(None),) * (len(sourceShape) - 1 - len(crop))
+        self.crop = tuple(slice(*s.indices(n)) for s, n in zip(crop, sourceShape[1:]))
+        self._frameShape = tuple(len(range(*s.indices(n))) for s, n in zip(self.crop, sourceShape[1:]))
+
+        if scale is not None:
+            scale = np.asarray(scale)
+            if not scale.shape == self.index.shape:
+                raise ValueError('The scale vector must have one value per position')
+            self.dtype = np.result_type(sourceDtype, scale.dtype)
+        else:
+            self.dtype = sourceDtype
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.fillValue = None
+        self._fill = None
+
+    @property
+    def shape(self):
+        return (len(self.index),) + self._frameShape
+
+    def __repr__(self):
+        return '<LazyDataset %s:%s, shape %s, dtype %s>' % (
+            self.fileName, self.path, self.shape, self.dtype)
+
+    def _view(self, index, scale):
+        """
+        Returns a new LazyDataset on the same file with different rows.
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.index = index
+        new.scale = scale
+        return new
+
+    def take(self, indices, axis=0):
+        """
+        Returns a lazy view of the selected rows, like ndarray.take()
+        with axis=0 but without reading anything.
+        """
+        if axis != 0:
+            raise ValueError('LazyDataset can only take rows along axis 0')
+        rows = self._rows(indices)
+        scale = None if self.scale is None else self.scale[rows]
+        return self._view(self.index[rows], scale)
+
+    def append(self, other):
+        """
+        Returns a lazy view with the rows of another LazyDataset on the
+        same file, dataset and crop appended.
+        """
+        if not (other.fileName == self.fileName and other.path == self.path
+                and other.crop == self.crop):
+            raise ValueError('Can only append LazyDatasets reading the same frames')
+        if (self.scale is None) != (other.scale is None):
+            raise ValueError('Can only append LazyDatasets which are both scaled or unscaled')
+        index = np.concatenate((self.index, other.index))
+        scale = None
+        if self.scale is not None:
+            scale = np.concatenate((self.scale, other.scale))
+        new = self._view(index, scale)
+        new._fill = None
+        return new
+
+    def pad(self, n, value=None):
+        """
+        Returns a lazy view with n missing frames appended, which read
+        as the average frame or as value (for example np.nan).
+        """
+        index = np.concatenate((self.index, -np.ones(n, dtype=int)))
+        scale = None
+        if self.scale is not None:
+            scale = np.concatenate((self.scale, np.ones(n, dtype=self.scale.dtype)))
+        new = self._view(index, scale)
+        if value is not None:
+            new.dtype = np.result_type(self.dtype, np.min_scalar_type(value))
+            new.fillValue = value
+            new._fill = None
+        return new
+
+    def _rows(self, key):
+        """
+        Converts a row selection into an array of row numbers.
+        """
+        if isinstance(key, slice):
+            return np.arange(*key.indices(len(self)))
+        key = np.asarray(key)
+        if key.dtype == bool:
+            if not key.shape == (len(self),):
+                raise IndexError('Boolean row mask has the wrong shape')
+            return np.flatnonzero(key)
+        rows = key.astype(int).reshape(-1)
+        if np.any((rows >= len(self)) | (rows < -len(self))):
+            raise IndexError('Row index out of range for %u positions' % len(self))
+        return np.where(rows < 0, rows + len(self), rows)
+
+    def _blockRows(self):
+        """
+        Number of rows to read at a time, chunk aligned if possible.
+        """
+        frameBytes = max(1, int(np.prod(self._frameShape)) * self.dtype.itemsize)
+        n = max(1, self.blockBytes // frameBytes)
+        if self._sourceChunks and n > self._sourceChunks[0]:
+            n -= n % self._sourceChunks[0]
+        return n
+
+    def _composeCrop(self, frameKey):
+        """
+        Combines a tuple of slices on the cropped frame with the crop
+        itself, returning the slices to read from the file, or None
+        if that isn't possible.
+        """
+        composed = []
+        for s, k in zip(self.crop, frameKey):
+            r = range(s.start, s.stop, s.step)[k]
+            if r.step < 0:
+                return None
+            composed.append(slice(r.start, max(r.start, r.stop), r.step))
+        return tuple(composed) + self.crop[len(frameKey):]
+
+    def _readRows(self, rows, frameKey=()):
+        """
+        Reads the specified rows from the file, optionally with a tuple
+        of slices frameKey applied to each frame. Consecutive frames are
+        read together, and missing frames are filled in.
+        """
+        crop = self._composeCrop(frameKey)
+        if crop is None:
+            return self._readRows(rows)[(slice(None),) + tuple(frameKey)]
+        shape = tuple(len(range(s.start, s.stop, s.step)) for s in crop)
+        out = np.empty((len(rows),) + shape, dtype=self.dtype)
+        src = self.index[rows]
+        valid = np.flatnonzero(src >= 0)
+        if len(valid):
+            # read runs of consecutive frames in single hyperslabs
+            order = valid[np.argsort(src[valid], kind='stable')]
+            frames = src[order]
+            breaks = np.flatnonzero(np.diff(frames) > 1) + 1
+            with pool.borrow(self.fileName) as fp:
+                dset = fp[self.path]
+                for run in np.split(np.arange(len(frames)), breaks):
+                    first, last = frames[run[0]], frames[run[-1]]
+                    block = dset[(slice(first, last + 1),) + crop]
+                    out[order[run]] = block[frames[run] - first]
+        missing = np.flatnonzero(src < 0)
+        if len(missing):
+            out[missing] = self._fillFrame()[tuple(frameKey)]
+        if self.scale is not None:
+            out *= self.scale[rows].reshape((-1,) + (1,) * len(shape))
+        return out
+
+    def _fillFrame(self):
+        """
+        The average frame, used for missing positions.
+        """
+        if self._fill is None:
+            valid = np.flatnonzero(self.index >= 0)
+            if self.fillValue is not None:
+                self._fill = np.full(self._frameShape, self.fillValue, dtype=self.dtype)
+            elif not len(valid):
+                self._fill = np.zeros(self._frameShape, dtype=self.dtype)
+            else:
+                total = np.zeros(self._frameShape, dtype=np.float64)
+                n = self._blockRows()
+                for i in range(0, len(valid), n):
+                    total += np.sum(self._readRows(valid[i:i+n]), axis=0)
+                total /= len(valid)
+                if self.dtype.kind in 'iub':
+                    total = np.around(total)
+                self._fill = total.astype(self.dtype)
+        return self._fill
+
+    def iterBlocks(self, rows=None):
+        """
+        Generator which yields (rows, block) pairs, reading the
+        specified rows (default all) in chunk-aligned blocks.
+        """
+        rows = np.arange(len(self)) if rows is None else self._rows(rows)
+        n = self._blockRows()
+        for i in range(0, len(rows), n):
+            yield rows[i:i+n], self._readRows(rows[i:i+n])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for LazyDataset')
+        rowKey, frameKey = key[0], key[1:]
+
+        # a single frame
+        if isinstance(rowKey, (int, np.integer)):
+            row = self._rows([rowKey])
+            if all(isinstance(k, slice) for k in frameKey):
+                return self._readRows(row, frameKey)[0]
+            return self._readRows(row)[0][frameKey]
+
+        # several frames, read block by block where numpy semantics allow
+        rows = self._rows(rowKey)
+        advanced = [i for i, k in enumerate(frameKey) if not isinstance(k, slice)]
+        if all(isinstance(k, slice) for k in frameKey):
+            n = self._blockRows()
+            blocks = [self._readRows(rows[i:i+n], frameKey) for i in range(0, len(rows), n)]
+        elif isinstance(rowKey, slice) and advanced == list(range(advanced[0], advanced[-1] + 1)):
+            blocks = [block[(slice(None),) + frameKey] for r, block in self.iterBlocks(rows)]
+        else:
+            rowSel = slice(None) if isinstance(rowKey, slice) else np.arange(len(rows))
+            return self._readRows(rows)[(rowSel,) + frameKey]
+        if not blocks:
+            return self._readRows(rows, ())[(slice(None),) + frameKey]
+        return np.concatenate(blocks, axis=0)
@@ -10,6 +10,15 @@ class flyscan_nov2017(flyscan_nov2018):
     Legacy format where the 2D detectors wrote one file per line.
     """
 
+    def _readI0(self, channel=None):
+        """
+        The pixel detectors are not normalized by default here, only
+        with a channel given to setI0().
+        """
+        if channel is None and self.dataSource in ('pil100k', 'merlin', 'pil1m'):
+            return None
+        return super(flyscan_nov2017, self)._readI0(channel)
+
     def _readData(self, name):
         """ 
         Override data reading.
@@ -19,14 +28,6 @@ class flyscan_nov2017(flyscan_nov2018):
         if not self.dataSource in ('pil100k', 'merlin', 'pil1m'):
             return super(flyscan_nov2017, self)._readData(name)
 
-        if self.normalize_by_I0:
-            entry = 'entry%d' % self.scanNr
-            if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as fp:
-                I0_data = self._safe_get_array(fp, entry+'/measurement/Ni6602_buff')
-                I0_data = I0_data.astype(float) * 1e-5
-                I0_data = I0_data[:, :self.images_per_line]
-
         print("loading diffraction data...")
         path = os.path.split(os.path.abspath(self.fileName))[0]
         
@@ -55,7 +56,7 @@ class flyscan_nov2017(flyscan_nov2018):
                         data_ = np.array(dataset)
                     if self.xrdBinning > 1:
                         shape = fastBinPixels(data_[0], self.xrdBinning).shape
-                        new_data_ = np.zeros((data_.shape[0],) + shape)
+                        new_data_ = np.zeros((data_.shape[0],) + shape, dtype=self._storageDtype(np.float64))
                         for ii in range(data_.shape[0]):
                             new_data_[ii] = fastBinPixels(data_[ii], self.xrdBinning)
                         data_ = new_data_
@@ -78,6 +78,7 @@ class flyscan_nov2018(Scan):
         'type': bool,
         'doc': 'whether or not to normalize against I0',
         },
+    'dataType': Scan.dataTypeOption,
     'waxsPath': {
         'value': '../../process/radial_integration/<sampledir>',
         'type': str,
@@ -90,6 +91,9 @@ class flyscan_nov2018(Scan):
     sourceDims = {'pil100k':2, 'xspress3':1, 'adlink':0, 'merlin':2, 'pil1m':2, 'counter':0, 'pil1m-waxs':1}
     assert sorted(sourceDims.keys()) == sorted(default_opts['dataSource']['type'])
 
+    # options which determine the positions, see Scan.positionOptions
+    positionOptions = ('fileName', 'scanNr', 'xMotor', 'yMotor', 'nMaxLines', 'globalPositions')
+
     def _prepareData(self, **kwargs):
         """ 
         Parse the derived options
@@ -113,6 +117,7 @@ class flyscan_nov2018(Scan):
         self.scanNr = opts['scanNr']['value']
         self.fileName = opts['fileName']['value']
         self.normalize_by_I0 = opts['normalize_by_I0']['value']
+        self.dataType = opts['dataType']['value']
         self.xrfChannel = list(map(int, opts['xrfChannel']['value']))
         self.waxsPath = opts['waxsPath']['value']
 
@@ -154,72 +159,68 @@ class flyscan_nov2018(Scan):
         entry = 'entry%d' % self.scanNr
         fileName = self.fileName
 
-        # open hdf5 file
-        try:
-            fp = h5py.File(fileName, 'r')
-        except IOError:
+        # get the hdf5 file
+        if not os.path.exists(fileName):
             raise NoDataException
+        with self._openFile(fileName) as fp:
+
+            # infer which is the slow axis
+            slowMotorHint = self._safe_get_str(fp, entry + '/title').split(' ')[1]
+            if slowMotorHint in ('sx', 'sy', 'sz'):
+                slowMotorHint = {'sx':'lc400_buff_2', 'sy':'lc400_buff_3', 'sz':'lc400_buff_1'}[slowMotorHint]
+            if slowMotorHint in self.xMotor:
+                fastMotor = self.yMotor
+                slowMotor = self.xMotor
+                print("Loader inferred that %s is the fast axis" % self.yMotor)
+            elif slowMotorHint in self.yMotor:
+                fastMotor = self.xMotor
+                slowMotor = self.yMotor
+                print("Loader inferred that %s is the fast axis" % self.xMotor)
+            else:
+                raise NoDataException("Couldn't determine which is the fast axis!")
 
-        # infer which is the slow axis
-        slowMotorHint = self._safe_get_str(fp, entry + '/title').split(' ')[1]
-        if slowMotorHint in ('sx', 'sy', 'sz'):
-            slowMotorHint = {'sx':'lc400_buff_2', 'sy':'lc400_buff_3', 'sz':'lc400_buff_1'}[slowMotorHint]
-        if slowMotorHint in self.xMotor:
-            fastMotor = self.yMotor
-            slowMotor = self.xMotor
-            print("Loader inferred that %s is the fast axis" % self.yMotor)
-        elif slowMotorHint in self.yMotor:
-            fastMotor = self.xMotor
-            slowMotor = self.yMotor
-            print("Loader inferred that %s is the fast axis" % self.xMotor)
-        else:
-            raise NoDataException("Couldn't determine which is the fast axis!")
-
-        # read the fast axis
-        fast, nLines, lineLen = self._read_buffered(fp, entry+'/measurement/%s'%fastMotor)
+            # read the fast axis
+            fast, nLines, lineLen = self._read_buffered(fp, entry+'/measurement/%s'%fastMotor)
 
-        # save number of lines for the _readData method
-        self.nlines = nLines
-        self.images_per_line = lineLen
+            # save number of lines for the _readData method
+            self.nlines = nLines
+            self.images_per_line = lineLen
 
-        # read the slow axis
-        slow_is_buffered = len(fp.get(entry+'/measurement/%s'%slowMotor).shape) > 1
-        if slow_is_buffered:
-            slow, _, _ = self._read_buffered(fp, entry+'/measurement/%s'%slowMotor)
-        else:
-            slow = self._read_non_buffered(fp, entry+'/measurement/%s'%slowMotor, lineLen, nLines)
-
-        # limit the number of lines if requested
-        if self.nMaxLines:
-            self.nlines = self.nMaxLines
-            fast = fast[:lineLen * self.nMaxLines]
-            slow = slow[:lineLen * self.nMaxLines]
-
-        # assign fast and slow positions
-        if fastMotor == self.xMotor:
-            x = fast
-            y = slow
-        else:
-            y = fast
-            x = slow
+            # read the slow axis
+            slow_is_buffered = len(fp.get(entry+'/measurement/%s'%slowMotor).shape) > 1
+            if slow_is_buffered:
+                slow, _, _ = self._read_buffered(fp, entry+'/measurement/%s'%slowMotor)
+            else:
+                slow = self._read_non_buffered(fp, entry+'/measurement/%s'%slowMotor, lineLen, nLines)
+
+            # limit the number of lines if requested
+            if self.nMaxLines:
+                self.nlines = self.nMaxLines
+                fast = fast[:lineLen * self.nMaxLines]
+                slow = slow[:lineLen * self.nMaxLines]
+
+            # assign fast and slow positions
+            if fastMotor == self.xMotor:
+                x = fast
+                y = slow
+            else:
+                y = fast
+                x = slow
 
-        print("x and y shapes:", x.shape, y.shape)
+            print("x and y shapes:", x.shape, y.shape)
 
-        # optionally add coarse stage position
-        if self.globalPositions:
-            sams_x = fp.get(entry+'/measurement/sams_x')[()] * 1e3
-            sams_y = fp.get(entry+'/measurement/sams_y')[()] * 1e3
-            sams_z = fp.get(entry+'/measurement/sams_z')[()] * 1e3
-            offsets = {'samx': sams_x, 'samy': sams_y, 'samz': sams_z}
-            x += offsets[self.xMotor[:4]]
-            y += offsets[self.yMotor[:4]]
-            print('*** added rough position offsets!')
+            # optionally add coarse stage position
+            if self.globalPositions:
+                sams_x = fp.get(entry+'/measurement/sams_x')[()] * 1e3
+                sams_y = fp.get(entry+'/measurement/sams_y')[()] * 1e3
+                sams_z = fp.get(entry+'/measurement/sams_z')[()] * 1e3
+                offsets = {'samx': sams_x, 'samy': sams_y, 'samz': sams_z}
+                x += offsets[self.xMotor[:4]]
+                y += offsets[self.yMotor[:4]]
+                print('*** added rough position offsets!')
 
         print("loaded positions from %d lines, %d positions on each"%(self.nlines, lineLen))
 
-        # close hdf5 file
-        fp.close()
-
         # save motor labels
         if self.globalPositions:
             rough = {'samx_buff':'sams_x', 'samy_buff':'sams_y', 'samz_buff':'sams_z'}
@@ -235,14 +236,6 @@ class flyscan_nov2018(Scan):
         Override data reading.
         """
 
-        if self.normalize_by_I0:
-            entry = 'entry%d' % self.scanNr
-            if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as fp:
-                I0_data = self._safe_get_array(fp, entry+'/measurement/Ni6602_buff')
-                I0_data = I0_data.astype(float) * 1e-5
-                I0_data = I0_data[:, :self.images_per_line]
-
         if self.dataSource in ('pil100k', 'merlin', 'pil1m'):
             print("loading diffraction data...")
             path = os.path.split(os.path.abspath(self.fileName))[0]
@@ -263,7 +256,7 @@ class flyscan_nov2018(Scan):
                  
             fn = os.path.join(path, filename_pattern%self.scanNr)
             if not os.path.exists(fn): raise NoDataException('No hdf5 file found.')
-            with h5py.File(fn, 'r') as hf:
+            with self._openFile(fn) as hf:
                 for line in range(self.nlines):
                     try:
                         print('loading data: ' + filename_pattern%self.scanNr + ', line %d'%line)
@@ -275,7 +268,7 @@ class flyscan_nov2018(Scan):
                             data_ = np.array(dataset)
                         if self.xrdBinning > 1:
                             shape = fastBinPixels(data_[0], self.xrdBinning).shape
-                            new_data_ = np.zeros((data_.shape[0],) + shape)
+                            new_data_ = np.zeros((data_.shape[0],) + shape, dtype=self._storageDtype(np.float64))
                             for ii in range(data_.shape[0]):
                                 new_data_[ii] = fastBinPixels(data_[ii], self.xrdBinning)
                             data_ = new_data_
@@ -283,9 +276,6 @@ class flyscan_nov2018(Scan):
                             for i in range(data_.shape[0]):
                                 data_[i] = np.flipud(data_[i]) # Merlin images indexed from the bottom left...
                         del dataset
-                        if self.normalize_by_I0:
-                            I0_line = I0_data[line]
-                            data_ = data_ / I0_line[:, None, None]
                         data.append(data_)
 
                     except IOError:
@@ -305,7 +295,7 @@ class flyscan_nov2018(Scan):
             data = []
             fn = os.path.join(path, filename_pattern%(self.scanNr))
             if not os.path.exists(fn): raise NoDataException
-            with h5py.File(fn, 'r') as hf:
+            with self._openFile(fn) as hf:
                 line = 0
                 while True:
                     if line >= self.nlines:
@@ -316,9 +306,6 @@ class flyscan_nov2018(Scan):
                     data_ = np.mean(np.array(dataset)[:, self.xrfChannel, :], axis=1)
                     if self.xrfCropping:
                         data_ = data_[:, self.xrfCropping[0]:self.xrfCropping[1]]
-                    if self.normalize_by_I0:
-                        I0_line = I0_data[line]
-                        data_ = data_ / I0_line[:, None]
                     data.append(data_)
                     line += 1
             print("loaded %d lines of fluorescence data"%len(data))
@@ -334,7 +321,7 @@ class flyscan_nov2018(Scan):
             channel = {'adlink': 'AdLinkAI_buff', 'counter': 'Ni6602_buff'}[self.dataSource]
             entry = 'entry%d' % self.scanNr
             if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as hf:
+            with self._openFile(self.fileName) as hf:
                 data = self._safe_get_array(hf, entry+'/measurement/%s'%channel)
                 data = data.astype(float)
                 data = data[:, :self.images_per_line]
@@ -350,20 +337,43 @@ class flyscan_nov2018(Scan):
                 path = os.path.abspath(os.path.join(os.path.dirname(self.fileName), self.waxsPath))
             fn = os.path.join(path, 'scan_%04d_pil1m_0000_waxs.hdf5' % self.scanNr)
             if not os.path.exists(fn): raise NoDataException
-            with h5py.File(fn, 'r') as fp:
+            with self._openFile(fn) as fp:
                 data = fp['I'][:]
                 q = fp['q'][:]
             self.dataAxes[name] = [q,]
             self.dataDimLabels[name] = ['q (1/nm)']
-            if self.normalize_by_I0:
-                data = data / I0_data.flatten()[:, None]
-                bad = np.where(np.isinf(data) | np.isnan(data))
-                good = np.where(np.isfinite(data))
-                data[bad] = np.mean(data[good])
         else:
             raise RuntimeError('Something is seriously wrong, we should never end up here since _updateOpts checks the options.')
         return data
 
+    def _readI0(self, channel=None):
+        """
+        Reads the I0 channel, one line of images_per_line values at a
+        time. By default this is Ni6602_buff if normalize_by_I0 is set,
+        which applies to all but the scalar data.
+        """
+        if channel is None:
+            scalar = self.dataSource in ('adlink', 'counter')
+            channel = 'Ni6602_buff' if (self.normalize_by_I0 and not scalar) else ''
+        if not channel:
+            return None
+        entry = 'entry%d' % self.scanNr
+        if not os.path.exists(self.fileName): raise NoDataException
+        with self._openFile(self.fileName) as fp:
+            I0_data = self._safe_get_array(fp, entry+'/measurement/%s' % channel)
+        I0_data = I0_data.astype(float)
+        if I0_data.ndim == 2:
+            I0_data = I0_data[:, :self.images_per_line]
+        if channel == 'Ni6602_buff':
+            I0_data *= 1e-5
+        return I0_data.flatten()
+
+    def _fillNonFinite(self):
+        """
+        The normalized WAXS data reads the mean where I0 is zero.
+        """
+        return self.dataSource == 'pil1m-waxs'
+
 
 class stepscan_nov2018(Scan):
     """
@@ -416,6 +426,7 @@ class stepscan_nov2018(Scan):
             'type': bool,
             'doc': 'whether to normalize against I0 (counter1)',
             },
+        'dataType': Scan.dataTypeOption,
         'nominalPositions': {
             'value': False,
             'type': bool,
@@ -443,6 +454,9 @@ class stepscan_nov2018(Scan):
     sourceDims = {'pil100k':2, 'xspress3':1, 'merlin':2, 'pil1m':2, 'counter1':0, 'counter2':0, 'counter3':0, 'pil1m-waxs':1}
     assert sorted(sourceDims.keys()) == sorted(default_opts['dataSource']['type'])
 
+    # options which determine the positions, see Scan.positionOptions
+    positionOptions = ('fileName', 'scanNr', 'xMotor', 'yMotor', 'nominalPositions', 'nMaxPositions')
+
     def _prepareData(self, **kwargs):
         """ 
         This method gets the kwargs passed to the addData() method, and
@@ -460,6 +474,7 @@ class stepscan_nov2018(Scan):
         self.xrdCropping = int(opts['xrdCropping']['value'])
         self.xrdBinning = int(opts['xrdBinning']['value'])
         self.normalize_by_I0 = (opts['normalize_by_I0']['value'])
+        self.dataType = opts['dataType']['value']
         self.nominalPositions = bool(opts['nominalPositions']['value'])
         self.scanNr = int(opts['scanNr']['value'])
         self.fileName = opts['fileName']['value']
@@ -473,7 +488,7 @@ class stepscan_nov2018(Scan):
         """
 
         if not os.path.exists(self.fileName): raise NoDataException
-        with h5py.File(self.fileName, 'r') as hf:
+        with self._openFile(self.fileName) as hf:
             if self.nominalPositions:
                 title = str(hf.get('entry%d' % self.scanNr + '/title')[()]).split(' ')
                 xmotorInd = title.index(self.xMotor)
@@ -527,14 +542,6 @@ class stepscan_nov2018(Scan):
         path of the Lima hdf5 files.
         """
 
-        if self.normalize_by_I0:
-            entry = 'entry%d' % self.scanNr
-            if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as hf:
-                I0_data = self._safe_get_array(hf, entry+'/measurement/counter1')
-                I0_data = I0_data.astype(float) * 1e-5
-                print(I0_data)
-
         if self.dataSource in ('merlin', 'pil100k', 'pil1m'):
             print("loading diffraction data...")
             path = os.path.split(os.path.abspath(self.fileName))[0]
@@ -557,7 +564,7 @@ class stepscan_nov2018(Scan):
             fn = os.path.join(path, filename_pattern%self.scanNr)
             if not os.path.exists(fn): raise NoDataException
             try:
-                with h5py.File(fn, 'r') as hf:
+                with self._openFile(fn) as hf:
                     print('loading data: ' + os.path.join(path, filename_pattern%self.scanNr))
                     for im in range(self.positions.shape[0]):
                         if self.nMaxPositions and im == self.nMaxPositions:
@@ -598,8 +605,6 @@ class stepscan_nov2018(Scan):
             if missing:
                 print("there were %d missing images" % missing)
             data = np.array(data)
-            if self.normalize_by_I0:
-                data = data / I0_data[:, None, None]
 
         elif self.dataSource == 'xspress3':
             print("loading fluorescence data...")
@@ -610,15 +615,13 @@ class stepscan_nov2018(Scan):
             data = []
             fn = os.path.join(path, filename_pattern%(self.scanNr))
             if not os.path.exists(fn): raise NoDataException
-            with h5py.File(fn, 'r') as hf:
+            with self._openFile(fn) as hf:
                 for im in range(self.positions.shape[0]):
                     dataset = self._safe_get_dataset(hf, 'entry_%04d/measurement/xspress3/data'%im)
                     if not dataset:
                         break
                     data.append(np.array(dataset)[0, self.xrfChannel])
             data = np.array(data)
-            if self.normalize_by_I0:
-                data = data / I0_data[:, None]
             self.dataDimLabels[name] = ['Approx. energy (keV)']
             self.dataAxes[name] = [np.arange(data.shape[-1]) * .01]
 
@@ -632,21 +635,16 @@ class stepscan_nov2018(Scan):
                 path = os.path.abspath(os.path.join(os.path.dirname(self.fileName), self.waxsPath))
             fn = os.path.join(path, 'scan_%04d_pil1m_0000_waxs.hdf5' % self.scanNr)
             if not os.path.exists(fn): raise NoDataException
-            with h5py.File(fn, 'r') as fp:
+            with self._openFile(fn) as fp:
                 data = fp['I'][:]
                 q = fp['q'][:]
             self.dataAxes[name] = [q,]
             self.dataDimLabels[name] = ['q (1/nm)']
-            try:
-                if self.normalize_by_I0:
-                    data = data / I0_data[:, None]
-            except:
-                raise NotImplementedError('Something went wrong when normalizing the WAXS data!')
 
         elif self.dataSource in ('counter1', 'counter2', 'counter3'):
             entry = 'entry%d' % self.scanNr
             if not os.path.exists(self.fileName): raise NoDataException
-            with h5py.File(self.fileName, 'r') as hf:
+            with self._openFile(self.fileName) as hf:
                 I0_data = self._safe_get_array(hf, entry+'/measurement/' + self.dataSource)
                 if I0_data.ndim == 2:
                     I0_data = I0_data[:, 0]
@@ -657,5 +655,24 @@ class stepscan_nov2018(Scan):
         
         return data
 
+    def _readI0(self, channel=None):
+        """
+        Reads the I0 channel. By default this is counter1 if
+        normalize_by_I0 is set, which applies to all but the counters.
+        """
+        if channel is None:
+            counter = self.dataSource in ('counter1', 'counter2', 'counter3')
+            channel = 'counter1' if (self.normalize_by_I0 and not counter) else ''
+        if not channel:
+            return None
+        entry = 'entry%d' % self.scanNr
+        if not os.path.exists(self.fileName): raise NoDataException
+        with self._openFile(self.fileName) as hf:
+            I0_data = self._safe_get_array(hf, entry+'/measurement/%s' % channel)
+        I0_data = I0_data.astype(float).flatten()
+        if channel == 'counter1':
+            I0_data *= 1e-5
+        return I0_data
+
 
 
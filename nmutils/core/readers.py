@@ -0,0 +1,335 @@
+"""
+Fast readers for (Nframes x ...) detector stacks in HDF5 files. The
+frame axis is split into chunk-aligned blocks which are read, and
+decompressed, by a pool of worker processes writing directly into a
+preallocated output array in shared memory. Each block passes through
+a pipeline of cropping, burst reduction, binning and normalization
+while it is read, so that only the final data is ever kept.
+
+Bitshuffle/LZ4 compressed datasets (as written by the Eiger detectors)
+can bypass the HDF5 filter pipeline: the compressed chunks are read
+with read_direct_chunk and decompressed by bitshuffle in a pool of
+threads, which release the GIL while decompressing.
+"""
+
+import numpy as np
+import h5py
+import mmap
+import struct
+import multiprocessing
+from math import gcd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import filepool
+
+try:
+    import bitshuffle
+    HAS_BITSHUFFLE = True
+except ImportError:
+    HAS_BITSHUFFLE = False
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+# approximate amount of data read by each task
+BLOCK_BYTES = 1 << 26 # 64 MiB
+
+BURST_OPS = ('sum', 'mean', 'max')
+
+# HDF5 filter id and compression flag of bitshuffle/LZ4
+BSHUF_FILTER = 32008
+BSHUF_LZ4 = 2
+
+
+def _blockRanges(start, stop, chunkRows, burst, rowBytes, blockBytes=BLOCK_BYTES):
+    """
+    Splits the output rows [start, stop) into blocks. Each output row
+    corresponds to burst frames, and the blocks are chosen so that their
+    frame boundaries coincide with the chunk boundaries of the dataset
+    where possible, so that no chunk is decompressed twice.
+    """
+    chunkRows = max(1, chunkRows)
+    unit = chunkRows // gcd(chunkRows, burst)
+    n = max(1, blockBytes // max(1, rowBytes * burst * unit)) * unit
+    edges = list(range((start // n + 1) * n, stop, n))
+    edges = [start] + edges + [stop]
+    return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def _accumulatorDtype(dtype, factor):
+    """
+    The integer type needed to hold sums of factor values of dtype,
+    without overflowing. Other types are returned unchanged.
+    """
+    dtype = np.dtype(dtype)
+    if factor <= 1 or dtype.kind not in 'iu':
+        return dtype
+    largest = int(np.iinfo(dtype).max) * factor
+    if dtype.kind == 'i':
+        return np.result_type(dtype, np.min_scalar_type(-largest))
+    return np.result_type(dtype, np.min_scalar_type(largest))
+
+
+def _outputDtype(dtype, burst, burstOp, binning, scaled=False):
+    """
+    The dtype resulting from the processing pipeline. Integers stay
+    integers unless averaged or normalized, which gives float32.
+    """
+    dtype = np.dtype(dtype)
+    if ((burst > 1 and burstOp == 'mean') or scaled) and dtype.kind in 'iub':
+        dtype = np.dtype(np.float32)
+    factor = (burst if burstOp == 'sum' else 1) * binning**2
+    return _accumulatorDtype(dtype, factor)
+
+
+def _processBlock(raw, burst, burstOp, binning, scale=None, outDtype=None, out=None):
+    """
+    Applies the burst reduction, binning and normalization to a block
+    of raw frames. The normalization is done in outDtype if given, and
+    written straight into the array out if that is given too.
+    """
+    dtype = _outputDtype(raw.dtype, burst, burstOp, binning)
+    if burst > 1:
+        raw = raw.reshape((raw.shape[0] // burst, burst) + raw.shape[1:])
+        if burstOp == 'sum':
+            raw = np.sum(raw, axis=1, dtype=dtype)
+        elif burstOp == 'mean':
+            raw = np.mean(raw, axis=1, dtype=dtype)
+        else:
+            raw = np.max(raw, axis=1)
+    if binning > 1:
+        n = binning
+        h, w = raw.shape[-2] // n, raw.shape[-1] // n
+        raw = raw[..., :h*n, :w*n].reshape(raw.shape[:-2] + (h, n, w, n))
+        raw = np.sum(raw, axis=(-3, -1), dtype=dtype)
+    if scale is not None:
+        dtype = _outputDtype(dtype, 1, 'sum', 1, scaled=True) if outDtype is None else outDtype
+        raw = np.multiply(raw, scale.reshape((-1,) + (1,) * (raw.ndim - 1)), dtype=dtype,
+                          out=out if (out is not None and out.dtype == dtype) else None)
+    return raw
+
+
+def _directChunkable(dset):
+    """
+    Whether the chunks of dset can be decompressed without the HDF5
+    filter pipeline, which is the case for bitshuffle/LZ4 as the only
+    filter and chunks holding whole frames.
+    """
+    if not HAS_BITSHUFFLE or dset.chunks is None or dset.chunks[1:] != dset.shape[1:]:
+        return False
+    plist = dset.id.get_create_plist()
+    filters = [plist.get_filter(i) for i in range(plist.get_nfilters())]
+    return (len(filters) == 1 and filters[0][0] == BSHUF_FILTER
+            and len(filters[0][2]) > 4 and filters[0][2][4] == BSHUF_LZ4)
+
+
+def _decodeChunk(dset, k, chunks, dtype):
+    """
+    Reads and decompresses chunk number k along the first axis.
+    """
+    offset = (k * chunks[0],) + (0,) * (len(chunks) - 1)
+    filterMask, raw = dset.id.read_direct_chunk(offset)
+    if filterMask & 1:
+        # the filter was skipped for this chunk
+        return np.frombuffer(raw, dtype=dtype).reshape(chunks)
+    # 12 byte header: uncompressed size (uint64) and block size (uint32), big-endian
+    nbytes, blockBytes = struct.unpack('>QI', raw[:12])
+    return bitshuffle.decompress_lz4(np.frombuffer(raw, dtype=np.uint8, offset=12),
+                                     chunks, dtype, blockBytes // dtype.itemsize)
+
+
+def _readDirect(dset, f0, f1, crop):
+    """
+    Reads frames [f0, f1) of dset with a crop, decompressing the chunks
+    directly.
+    """
+    chunks, dtype = dset.chunks, dset.dtype
+    c = chunks[0]
+    shape = tuple(len(range(s.start, s.stop, s.step)) for s in crop)
+    out = np.empty((f1 - f0,) + shape, dtype=dtype)
+    for k in range(f0 // c, (f1 - 1) // c + 1):
+        chunk = _decodeChunk(dset, k, chunks, dtype)
+        lo, hi = max(f0, k * c), min(f1, (k + 1) * c)
+        out[lo - f0:hi - f0] = chunk[(slice(lo - k * c, hi - k * c),) + crop]
+    return out
+
+
+def _readBlock(dset, a, b, crop, out, burst=1, burstOp='sum', binning=1, scale=None,
+               direct=False):
+    """
+    Reads output rows [a, b) of dset into the array out, applying
+    cropping, burst reduction, binning and normalization. The scale
+    vector holds one factor for each of the rows. With direct=True,
+    chunks are decompressed outside the HDF5 filter pipeline.
+    """
+    source = (slice(a * burst, b * burst),) + crop
+    plain = (burst == 1 and binning == 1 and scale is None and out.dtype == dset.dtype)
+    if plain and not direct:
+        dset.read_direct(out, source_sel=source)
+        return
+    raw = _readDirect(dset, a * burst, b * burst, crop) if direct else dset[source]
+    if not plain:
+        raw = _processBlock(raw, burst, burstOp, binning, scale, out.dtype, out=out)
+    if raw is not out:
+        out[:] = raw
+
+
+# the output buffer, inherited by forked worker processes
+_shared = {}
+
+def _initWorker(buf, shape, dtype):
+    count = int(np.prod(shape))
+    _shared['out'] = np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+def _workerTask(fileName, path, a, b, offset, crop, scale, opts, swmr):
+    # handles inherited from the parent's pool must not be used after fork
+    out = _shared['out']
+    with filepool.openFile(fileName, swmr=swmr) as fp:
+        _readBlock(fp[path], a, b, crop, out[a - offset:b - offset], scale=scale, **opts)
+    return b - a
+
+
+def _layout(dset, start, stop, crop, burst, binning):
+    """
+    Resolves the row range and crop for reading dset, returning
+    (stop, crop, shape) where shape is that of the output.
+    """
+    nRows = dset.shape[0] // burst
+    stop = nRows if stop is None else min(stop, nRows)
+    crop = () if crop is None else tuple(crop)
+    crop = crop + (slice(None),) * (dset.ndim - 1 - len(crop))
+    crop = tuple(slice(*s.indices(n)) for s, n in zip(crop, dset.shape[1:]))
+    frameShape = tuple(len(range(*s.indices(n))) for s, n in zip(crop, dset.shape[1:]))
+    if binning > 1:
+        frameShape = frameShape[:-2] + (frameShape[-2] // binning, frameShape[-1] // binning)
+    return stop, crop, (max(0, stop - start),) + frameShape
+
+
+def frameLayout(fileName, path, start=0, stop=None, crop=None, burst=1,
+                burstOp='sum', binning=1, scaled=False, swmr=False, dtype=None):
+    """
+    Returns the (shape, dtype) of what readFrames() gives with the same
+    arguments, from the metadata alone and without reading any frames.
+    Set scaled if a scale vector is to be passed.
+    """
+    with filepool.pool.borrow(fileName, swmr=swmr) as fp:
+        dset = fp[path]
+        stop, crop, shape = _layout(dset, start, stop, crop, burst, binning)
+        if dtype is None:
+            dtype = _outputDtype(dset.dtype, burst, burstOp, binning, scaled=scaled)
+    return shape, np.dtype(dtype)
+
+
+def readBuffers(fileName, path, start=0, stop=None, crop=None, burst=1,
+                burstOp='sum', binning=1, scaled=False, nWorkers=1, directChunks=True,
+                swmr=False, dtype=None):
+    """
+    Estimates the memory in bytes which readFrames() takes on top of
+    its output with the same arguments: the raw frames of a block,
+    their burst reduction and binning, for each block being read at the
+    same time.
+    Plain reads go straight into the output and take nothing.
+    """
+    with filepool.pool.borrow(fileName, swmr=swmr) as fp:
+        dset = fp[path]
+        stop, crop, shape = _layout(dset, start, stop, crop, burst, binning)
+        if dtype is None:
+            dtype = _outputDtype(dset.dtype, burst, burstOp, binning, scaled=scaled)
+        direct = directChunks and _directChunkable(dset)
+        plain = (burst == 1 and binning == 1 and not scaled and np.dtype(dtype) == dset.dtype)
+        if plain and not direct:
+            return 0
+        frame = int(np.prod([len(range(s.start, s.stop, s.step)) for s in crop]))
+        chunkRows = dset.chunks[0] if dset.chunks else 1
+        blocks = _blockRanges(start, stop, chunkRows, burst, frame * dset.dtype.itemsize)
+        rows = max([b - a for a, b in blocks] or [0])
+        perBlock = rows * burst * frame * dset.dtype.itemsize
+        if direct:
+            perBlock += chunkRows * int(np.prod(dset.shape[1:])) * dset.dtype.itemsize
+        if not plain:
+            acc = _accumulatorDtype(dset.dtype, burst if burstOp == 'sum' else 1)
+            perBlock += rows * frame * acc.itemsize
+        if binning > 1:
+            acc = _accumulatorDtype(acc, binning**2)
+            perBlock += rows * int(np.prod(shape[1:])) * acc.itemsize
+    return min(max(1, nWorkers), len(blocks)) * perBlock
+
+
+def readFrames(fileName, path, start=0, stop=None, crop=None, burst=1,
+               burstOp='sum', binning=1, scale=None, nWorkers=1, directChunks=True,
+               swmr=False, dtype=None):
+    """
+    Reads an HDF5 detector stack, passing each block of frames through
+    a crop, burst reduction, binning, normalization pipeline.
+
+    fileName, path: the HDF5 file and the dataset within it
+    start, stop: range of output rows (positions) to read
+    crop: tuple of slices applied to each frame
+    burst: number of consecutive frames making up each output row
+    burstOp: how to combine bursts, 'sum', 'mean' or 'max'
+    binning: bin pixels n by n after cropping, summing them
+    scale: one factor per output row to multiply with, such as 1 / I0
+    nWorkers: number of worker processes (or threads) reading in parallel
+    directChunks: decompress bitshuffle/LZ4 chunks in threads, bypassing
+                  the HDF5 filter pipeline, whenever the dataset allows it
+    swmr: open the file in SWMR mode, for reading a running scan
+    dtype: the dtype of the output, by default as below
+
+    Integer sums are stored in a type wide enough not to overflow, and
+    averaged or normalized integer data as float32. Returns a numpy
+    array of shape (stop - start, ...).
+    """
+    if burstOp not in BURST_OPS:
+        raise ValueError("Unknown burst operation '%s', choose from %s" % (burstOp, BURST_OPS))
+    with filepool.pool.borrow(fileName, swmr=swmr) as fp:
+        dset = fp[path]
+        stop, crop, shape = _layout(dset, start, stop, crop, burst, binning)
+        rowBytes = int(np.prod([len(range(s.start, s.stop, s.step)) for s in crop])) * dset.dtype.itemsize
+        if scale is not None:
+            scale = np.asarray(scale)
+            if not scale.shape == (shape[0],):
+                raise ValueError('Need one scale factor per row, got %s for %u rows'
+                                 % (scale.shape, shape[0]))
+        if dtype is None:
+            dtype = _outputDtype(dset.dtype, burst, burstOp, binning, scaled=(scale is not None))
+        dtype = np.dtype(dtype)
+        opts = {'burst': burst, 'burstOp': burstOp, 'binning': binning}
+        chunkRows = dset.chunks[0] if dset.chunks else 1
+        blocks = _blockRanges(start, stop, chunkRows, burst, rowBytes)
+
+        # the direct chunk fast path, where threads do the decompression
+        if directChunks and _directChunkable(dset):
+            out = np.empty(shape, dtype=dtype)
+            def task(block):
+                a, b = block
+                scale_ = None if scale is None else scale[a - start:b - start]
+                _readBlock(dset, a, b, crop, out[a - start:b - start], scale=scale_,
+                           direct=True, **opts)
+            with ThreadPoolExecutor(max(1, nWorkers)) as pool:
+                list(pool.map(task, blocks))
+            return out
+
+        # the serial case, or when forking isn't available
+        serial = (nWorkers <= 1 or len(blocks) <= 1
+                  or 'fork' not in multiprocessing.get_all_start_methods())
+        if serial:
+            if nWorkers > 1 and len(blocks) > 1:
+                print('parallel reading not available on this platform, reading serially')
+            out = np.empty(shape, dtype=dtype)
+            for a, b in blocks:
+                scale_ = None if scale is None else scale[a - start:b - start]
+                _readBlock(dset, a, b, crop, out[a - start:b - start], scale=scale_, **opts)
+            return out
+
+    # anonymous shared memory which the forked workers write into
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = mmap.mmap(-1, max(1, nbytes))
+    out = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(nWorkers, mp_context=ctx, initializer=_initWorker,
+                             initargs=(buf, shape, dtype)) as pool:
+        futures = [pool.submit(_workerTask, fileName, path, a, b, start, crop,
+                               None if scale is None else scale[a - start:b - start],
+                               opts, swmr)
+                   for a, b in blocks]
+        for f in futures:
+            f.result()
+    return out
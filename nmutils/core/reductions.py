@@ -0,0 +1,266 @@
+"""
+Streaming reductions over (Npositions x ...) datasets. The data is
+processed in blocks of positions with a bounded number of blocks in
+flight, so that sums, means and maxima over positions or over pixels
+never need the whole stack in memory. This works the same on numpy
+arrays and on LazyDataset instances, which read each block from file.
+Many ROIs can be integrated in the same way in a single pass, and the
+centers of mass of all frames found.
+"""
+
+import numpy as np
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+# approximate size of the blocks processed at a time
+BLOCK_BYTES = 1 << 27 # 128 MiB
+
+OPS = ('sum', 'mean', 'max', 'min')
+
+
+def iterBlocks(data, rows=None, blockBytes=BLOCK_BYTES):
+    """
+    Generator yielding (rows, block) pairs which together cover the
+    specified rows (default all) of data. Objects with their own
+    iterBlocks method (such as LazyDataset) decide on the blocking
+    themselves, and numpy arrays are cut into views where possible.
+    """
+    if hasattr(data, 'iterBlocks'):
+        for item in data.iterBlocks(rows):
+            yield item
+        return
+    frameBytes = max(1, int(np.prod(data.shape[1:])) * data.dtype.itemsize)
+    n = max(1, blockBytes // frameBytes)
+    if rows is None:
+        for i in range(0, data.shape[0], n):
+            yield np.arange(i, min(i + n, data.shape[0])), data[i:i+n]
+    else:
+        rows = np.asarray(rows, dtype=int)
+        for i in range(0, len(rows), n):
+            yield rows[i:i+n], data[rows[i:i+n]]
+
+
+def _partial(block, op, over, mask):
+    """
+    Reduces a single block.
+    """
+    if over == 'pixels':
+        flat = block.reshape((block.shape[0], -1))
+        if mask is not None:
+            flat = flat[:, mask]
+        if op in ('sum', 'mean'):
+            return np.sum(flat, axis=1, dtype=np.float64)
+        return getattr(np, op)(flat, axis=1)
+    if op in ('sum', 'mean'):
+        return np.sum(block, axis=0, dtype=np.float64)
+    return getattr(np, op)(block, axis=0)
+
+
+def reduce(data, op='sum', over='positions', mask=None, rows=None,
+           nThreads=1, blockBytes=BLOCK_BYTES):
+    """
+    Reduces an (Npositions x ...) dataset block by block.
+
+    data: numpy array or array-like with the iterBlocks method
+    op: 'sum', 'mean', 'max' or 'min'
+    over: 'positions' gives a frame, 'pixels' gives one value per position
+    mask: boolean frame-shaped array selecting the pixels to include,
+          only used with over='pixels'
+    rows: the positions to include, default all
+    nThreads: reduce this many blocks in parallel
+    blockBytes: approximate block size for numpy arrays
+
+    Sums and means are accumulated in float64. At most 2 * nThreads
+    blocks are held in memory at the same time.
+    """
+    if op not in OPS:
+        raise ValueError("Unknown reduction '%s', choose from %s" % (op, OPS))
+    if over not in ('positions', 'pixels'):
+        raise ValueError("Reductions go over 'positions' or 'pixels', not '%s'" % over)
+    if mask is not None:
+        if over != 'pixels':
+            raise ValueError('Pixel masks can only be used when reducing over pixels')
+        mask = np.asarray(mask, dtype=bool).reshape(-1)
+        if not mask.size == int(np.prod(data.shape[1:])):
+            raise ValueError('Mask shape does not match the data frames')
+
+    nRows = data.shape[0] if rows is None else len(rows)
+    parts = []
+    result = None
+
+    def combine(part):
+        nonlocal result
+        if over == 'pixels':
+            parts.append(part)
+        elif result is None:
+            result = part
+        elif op in ('sum', 'mean'):
+            result += part
+        elif op == 'max':
+            result = np.maximum(result, part)
+        else:
+            result = np.minimum(result, part)
+
+    blocks = iterBlocks(data, rows, blockBytes)
+    if nThreads > 1:
+        with ThreadPoolExecutor(nThreads) as pool:
+            pending = []
+            for rows_, block in blocks:
+                pending.append(pool.submit(_partial, block, op, over, mask))
+                # bound the number of blocks in flight
+                while len(pending) >= 2 * nThreads:
+                    combine(pending.pop(0).result())
+            for f in pending:
+                combine(f.result())
+    else:
+        for rows_, block in blocks:
+            combine(_partial(block, op, over, mask))
+
+    if over == 'pixels':
+        if not parts:
+            return np.zeros(0)
+        result = np.concatenate(parts)
+        if op == 'mean':
+            n = int(np.prod(data.shape[1:])) if mask is None else int(mask.sum())
+            result /= max(n, 1)
+    else:
+        if result is None:
+            # same conventions as numpy for empty reductions
+            if op in ('max', 'min'):
+                raise ValueError('Cannot take the %s over an empty set of positions' % op)
+            result = np.zeros(data.shape[1:]) * (np.nan if op == 'mean' else 1)
+        elif op == 'mean':
+            result /= nRows
+    return result
+
+
+def _windowBounds(rois, nChannels):
+    """
+    Lower and upper channels of a list of windows, clipped to the data.
+    """
+    windows = np.array([[int(lo), int(hi)] for lo, hi in rois], dtype=int).reshape((-1, 2))
+    windows = np.clip(windows, 0, nChannels)
+    windows[:, 1] = np.maximum(windows[:, 0], windows[:, 1])
+    return windows[:, 0], windows[:, 1]
+
+
+def _roiOperator(data, rois):
+    """
+    Converts a list of ROIs into a function which integrates a block,
+    and the number of elements in each ROI. Windows (lower, upper) on
+    1D data are integrated with a cumulative sum, and pixel masks on
+    frames with a sparse mask matrix.
+    """
+    frameShape = tuple(data.shape[1:])
+    if len(frameShape) == 1:
+        nChannels = frameShape[0]
+        lower, upper = _windowBounds(rois, nChannels)
+
+        def integrate(block):
+            cs = np.zeros((block.shape[0], nChannels + 1))
+            np.cumsum(block, axis=1, dtype=np.float64, out=cs[:, 1:])
+            return cs[:, upper] - cs[:, lower]
+        return integrate, upper - lower
+
+    masks = np.array([np.asarray(m, dtype=bool).reshape(-1) for m in rois]).reshape((len(rois), -1))
+    if not masks.shape[1] == int(np.prod(frameShape)):
+        raise ValueError('ROI mask shape does not match the data frames')
+    # (Npixels x Nrois), only rows of pixels in some ROI are kept
+    used = np.flatnonzero(masks.any(axis=0))
+    matrix = scipy.sparse.csr_matrix(masks[:, used].T.astype(np.float64))
+
+    def integrate(block):
+        flat = block.reshape((block.shape[0], -1))[:, used]
+        return np.asarray(matrix.T.dot(flat.T).T, dtype=np.float64)
+    return integrate, masks.sum(axis=1)
+
+
+def prefixSums(data, blockBytes=BLOCK_BYTES):
+    """
+    Cumulative sums along the channels of (Npositions x Nchannels)
+    data, as an (Npositions x Nchannels+1) float64 array starting with
+    a column of zeros. The integral over channels lower:upper is then
+    cs[:, upper] - cs[:, lower].
+    """
+    if not len(data.shape) == 2:
+        raise ValueError('Prefix sums need (Npositions x Nchannels) data')
+    cs = np.zeros((data.shape[0], data.shape[1] + 1))
+    for rows, block in iterBlocks(data, blockBytes=blockBytes):
+        cs[rows, 1:] = np.cumsum(block, axis=1, dtype=np.float64)
+    return cs
+
+
+def roiIntegrals(data, rois, op='sum', rows=None, nThreads=1, blockBytes=BLOCK_BYTES,
+                 prefixSums=None):
+    """
+    Integrates many ROIs in a single pass over an (Npositions x ...)
+    dataset, returning an (Npositions x Nrois) array.
+
+    data: numpy array or array-like with the iterBlocks method
+    rois: for 1D data, a list of channel windows (lower, upper) with
+          upper excluded, otherwise a list of boolean frame-shaped masks
+    op: 'sum' or 'mean'
+    rows: the positions to include, default all
+    nThreads: integrate this many blocks in parallel
+    blockBytes: approximate block size for numpy arrays
+    prefixSums: optional output of prefixSums() for 1D data, which
+                makes each window two column lookups without reading
+                the data
+    """
+    if op not in ('sum', 'mean'):
+        raise ValueError("ROIs can be integrated with 'sum' or 'mean', not '%s'" % op)
+    if prefixSums is not None:
+        lower, upper = _windowBounds(rois, prefixSums.shape[1] - 1)
+        cs = prefixSums if rows is None else prefixSums[np.asarray(rows, dtype=int)]
+        result = cs[:, upper] - cs[:, lower]
+        if op == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result /= upper - lower
+        return result
+
+    integrate, counts = _roiOperator(data, rois)
+    parts = []
+    blocks = iterBlocks(data, rows, blockBytes)
+    if nThreads > 1:
+        with ThreadPoolExecutor(nThreads) as pool:
+            pending = []
+            for rows_, block in blocks:
+                pending.append(pool.submit(integrate, block))
+                while len(pending) >= 2 * nThreads:
+                    parts.append(pending.pop(0).result())
+            parts += [f.result() for f in pending]
+    else:
+        parts = [integrate(block) for rows_, block in blocks]
+    result = np.concatenate(parts) if parts else np.zeros((0, len(counts)))
+    if op == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result /= counts
+    return result
+
+
+def centerOfMass(data, mask=None, rows=None, blockBytes=BLOCK_BYTES):
+    """
+    Center of mass (row, column) of each frame of (Npositions x M x N)
+    data, as an (Npositions x 2) array computed in a single pass as
+    three weighted sums over the pixels. Pixels where mask is True are
+    left out, and frames without intensity give NaN.
+    """
+    if not len(data.shape) == 3:
+        raise ValueError('Centers of mass need (Npositions x M x N) data')
+    frameShape = tuple(data.shape[1:])
+    weights = np.ones(frameShape)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.shape == frameShape:
+            raise ValueError('Mask shape does not match the data frames')
+        weights[mask] = 0
+    ii, jj = np.indices(frameShape)
+    matrix = np.stack((weights, weights * ii, weights * jj), axis=-1).reshape((-1, 3))
+    parts = []
+    for rows_, block in iterBlocks(data, rows, blockBytes):
+        sums = block.reshape((block.shape[0], -1)).dot(matrix)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            parts.append(sums[:, 1:] / sums[:, :1])
+    return np.concatenate(parts) if parts else np.zeros((0, 2))
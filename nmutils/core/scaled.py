@@ -0,0 +1,147 @@
+"""
+Implements the ScaledDataset class, which presents an (Npositions x
+...) dataset multiplied by a per-position vector, typically 1 / I0.
+The scaling is applied to whatever is read, so normalized data never
+takes more memory than the raw data, and the normalization can be
+replaced or removed without touching the data itself.
+"""
+
+import numpy as np
+from .lazy import ArrayProxy
+from .segmented import SegmentedDataset
+from . import reductions
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+class ScaledDataset(ArrayProxy):
+    """
+    Read-only, array-like view of base (a numpy array, LazyDataset or
+    SegmentedDataset) with each row multiplied by an element of scale.
+    Scan uses it for all normalized data, keeping the raw data as base.
+
+    Indexing works as on base and returns numpy arrays of the given
+    dtype, and the sum, mean, min and max methods as well as the
+    functions in reductions process one block at a time.
+    """
+
+    def __init__(self, base, scale, dtype=None, fillNonFinite=False):
+        """
+        base: the unscaled data
+        scale: length-N array multiplied onto each row
+        dtype: the dtype of the scaled data, by default that of base
+               and scale together
+        fillNonFinite: replace infinite and NaN values, as given by
+                       zeros in I0, with the mean of the finite ones
+        """
+        scale = np.asarray(scale)
+        if not scale.shape == (base.shape[0],):
+            raise ValueError('The scale vector must have one value per position')
+        self.base = base
+        self.scale = scale
+        if dtype is None:
+            dtype = np.result_type(base.dtype, scale.dtype)
+        self.dtype = np.dtype(dtype)
+        self.fillNonFinite = fillNonFinite
+        self._mean = None
+
+    @property
+    def shape(self):
+        return tuple(self.base.shape)
+
+    def __repr__(self):
+        return '<ScaledDataset of %r, dtype %s>' % (self.base, self.dtype)
+
+    def _factors(self):
+        """
+        The scale broadcast to the full shape, without taking memory,
+        so that indexing it gives the factors for any selection.
+        """
+        return np.broadcast_to(self.scale.reshape((-1,) + (1,) * (self.ndim - 1)), self.shape)
+
+    def _multiply(self, block, factors):
+        """
+        Scales a block, filling in non-finite values if asked to.
+        """
+        with np.errstate(invalid='ignore', over='ignore'):
+            block = np.multiply(block, factors, dtype=self.dtype)
+        if self.fillNonFinite:
+            bad = ~np.isfinite(block)
+            if np.ndim(block) and np.any(bad):
+                block[bad] = self._finiteMean()
+            elif not np.ndim(block) and bad:
+                block = self.dtype.type(self._finiteMean())
+        return block
+
+    def _finiteMean(self):
+        """
+        The mean of all finite scaled values, worked out once.
+        """
+        if self._mean is None:
+            total, count = 0., 0
+            for rows, block in reductions.iterBlocks(self.base):
+                factors = self.scale[rows].reshape((-1,) + (1,) * (self.ndim - 1))
+                with np.errstate(invalid='ignore', over='ignore'):
+                    block = np.multiply(block, factors, dtype=self.dtype)
+                good = np.isfinite(block)
+                total += np.sum(block, where=good, dtype=np.float64)
+                count += np.count_nonzero(good)
+            self._mean = total / count if count else 0.
+        return self._mean
+
+    def __getitem__(self, key):
+        block = np.asarray(self.base[key])
+        return self._multiply(block, self._factors()[key])
+
+    def iterBlocks(self, rows=None):
+        """
+        Generator which yields scaled (rows, block) pairs, blocked as
+        the base data decides.
+        """
+        for part, block in reductions.iterBlocks(self.base, rows):
+            factors = self.scale[part].reshape((-1,) + (1,) * (self.ndim - 1))
+            yield part, self._multiply(block, factors)
+
+    def _view(self, base, scale, dtype=None):
+        """
+        A ScaledDataset like this one on other data. Non-finite values
+        keep reading as the mean over the whole of this dataset.
+        """
+        new = ScaledDataset(base, scale, dtype=self.dtype if dtype is None else dtype,
+                            fillNonFinite=self.fillNonFinite)
+        if self.fillNonFinite:
+            new._mean = self._finiteMean()
+        return new
+
+    def take(self, indices, axis=0):
+        """
+        Returns the selected rows as a new ScaledDataset, where proxies
+        stay proxies and arrays are sliced where the rows are
+        consecutive, copying only other selections.
+        """
+        if axis != 0:
+            raise ValueError('ScaledDataset can only take rows along axis 0')
+        rows = np.arange(len(self))[indices].reshape(-1)
+        if isinstance(self.base, ArrayProxy):
+            base = self.base.take(rows)
+        elif len(rows) and np.all(np.diff(rows) == 1):
+            base = self.base[rows[0]:rows[-1] + 1]
+        else:
+            base = self.base[rows]
+        return self._view(base, self.scale[rows])
+
+    def pad(self, n, value=None):
+        """
+        Appends n rows holding the average scaled frame or value, as a
+        new ScaledDataset. The padding is a broadcast view which is not
+        scaled, so it takes no memory.
+        """
+        if value is None:
+            fill = reductions.reduce(self, op='mean', over='positions').astype(self.dtype)
+        else:
+            dtype = np.result_type(self.dtype, np.min_scalar_type(value))
+            fill = np.full(self.shape[1:], value, dtype=dtype)
+        base = SegmentedDataset([self.base])
+        base.append(np.broadcast_to(fill, (n,) + fill.shape))
+        scale = np.concatenate((self.scale, np.ones(n, dtype=self.scale.dtype)))
+        return self._view(base, scale, dtype=np.result_type(self.dtype, fill.dtype))
@@ -0,0 +1,197 @@
+"""
+Implements the SegmentedDataset class, which presents a list of
+(Npositions x ...) arrays, for example from several merged scans, as
+one logical array. Appending a segment does not copy anything, so
+building up a large dataset piece by piece costs no more than the
+pieces themselves.
+"""
+
+import numpy as np
+from .lazy import ArrayProxy
+from . import reductions
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+class SegmentedDataset(ArrayProxy):
+    """
+    Read-only, array-like concatenation of segments along the first
+    axis. The segments can be numpy arrays or other array proxies such
+    as LazyDataset instances, and must have the same frame shape.
+
+    Indexing returns numpy arrays, and the sum, mean, min and max methods as
+    well as the functions in reductions process one block at a time. Use
+    consolidate() to get a contiguous array.
+    """
+
+    def __init__(self, segments=()):
+        self.segments = []
+        for seg in segments:
+            self.append(seg)
+
+    def append(self, segment):
+        """
+        Appends a segment, or all segments of another SegmentedDataset,
+        without copying any data.
+        """
+        if isinstance(segment, SegmentedDataset):
+            for seg in segment.segments:
+                self.append(seg)
+            return
+        if not isinstance(segment, ArrayProxy):
+            segment = np.asarray(segment)
+        if self.segments and not tuple(segment.shape[1:]) == self.shape[1:]:
+            raise ValueError('Cannot append a segment with frames of shape %s to frames of shape %s'
+                             % (tuple(segment.shape[1:]), self.shape[1:]))
+        self.segments.append(segment)
+
+    @property
+    def offsets(self):
+        """
+        The first row of each segment, followed by the total length.
+        """
+        return np.cumsum([0] + [seg.shape[0] for seg in self.segments])
+
+    @property
+    def shape(self):
+        if not self.segments:
+            return (0,)
+        return (int(self.offsets[-1]),) + tuple(self.segments[0].shape[1:])
+
+    @property
+    def dtype(self):
+        if not self.segments:
+            return np.dtype(float)
+        return np.result_type(*[seg.dtype for seg in self.segments])
+
+    def __repr__(self):
+        return '<SegmentedDataset, %u segments, shape %s, dtype %s>' % (
+            len(self.segments), self.shape, self.dtype)
+
+    def _rows(self, key):
+        """
+        Converts a row selection into an array of row numbers.
+        """
+        n = len(self)
+        if isinstance(key, slice):
+            return np.arange(*key.indices(n))
+        key = np.asarray(key)
+        if key.dtype == bool:
+            if not key.shape == (n,):
+                raise IndexError('Boolean row mask has the wrong shape')
+            return np.flatnonzero(key)
+        rows = key.astype(int).reshape(-1)
+        if np.any((rows >= n) | (rows < -n)):
+            raise IndexError('Row index out of range for %u positions' % n)
+        return np.where(rows < 0, rows + n, rows)
+
+    def _runs(self, rows):
+        """
+        Splits row numbers into runs within the same segment, yielding
+        (segment, positions in rows, local rows) in the original order.
+        """
+        offsets = self.offsets
+        which = np.searchsorted(offsets, rows, side='right') - 1
+        breaks = np.flatnonzero(np.diff(which)) + 1
+        for run in np.split(np.arange(len(rows)), breaks):
+            if len(run):
+                i = which[run[0]]
+                yield self.segments[i], run, rows[run] - offsets[i]
+
+    def take(self, indices, axis=0):
+        """
+        Returns the selected rows as a new SegmentedDataset, keeping
+        lazy and other proxy segments as proxies and copying only the
+        selected rows of the others.
+        """
+        if axis != 0:
+            raise ValueError('SegmentedDataset can only take rows along axis 0')
+        new = SegmentedDataset()
+        for seg, run, local in self._runs(self._rows(indices)):
+            if isinstance(seg, ArrayProxy):
+                new.append(seg.take(local))
+            elif np.all(np.diff(local) == 1):
+                new.append(seg[local[0]:local[-1] + 1])
+            else:
+                new.append(seg[local])
+        if not new.segments:
+            new.append(self.segments[0][:0] if self.segments else np.zeros((0,)))
+        return new
+
+    def pad(self, n, value=None):
+        """
+        Appends n rows holding the average frame, like np.pad with
+        mode='mean' would, or value, as a new SegmentedDataset. The
+        padding is a broadcast view, so it takes no memory.
+        """
+        if value is None:
+            fill = reductions.reduce(self, op='mean', over='positions')
+            if self.dtype.kind in 'iub':
+                fill = np.around(fill)
+            fill = fill.astype(self.dtype)
+        else:
+            dtype = np.result_type(self.dtype, np.min_scalar_type(value))
+            fill = np.full(self.shape[1:], value, dtype=dtype)
+        new = SegmentedDataset(self.segments)
+        new.append(np.broadcast_to(fill, (n,) + fill.shape))
+        return new
+
+    def iterBlocks(self, rows=None):
+        """
+        Generator which yields (rows, block) pairs, block by block
+        within each segment.
+        """
+        offsets = self.offsets
+        if rows is None:
+            for seg, offset in zip(self.segments, offsets):
+                for local, block in reductions.iterBlocks(seg):
+                    yield local + offset, block
+            return
+        rows = self._rows(rows)
+        for seg, run, local in self._runs(rows):
+            for part, block in reductions.iterBlocks(seg, local):
+                yield part + (rows[run[0]] - local[0]), block
+
+    def _gather(self, rows, frameKey=()):
+        """
+        Reads the specified rows, with a tuple of slices applied to
+        each frame, into a new array.
+        """
+        parts = [(run, np.asarray(seg[(local,) + tuple(frameKey)]))
+                 for seg, run, local in self._runs(rows)]
+        if not parts:
+            return self.segments[0][(slice(0, 0),) + tuple(frameKey)].astype(self.dtype)
+        out = np.empty((len(rows),) + parts[0][1].shape[1:], dtype=self.dtype)
+        for run, part in parts:
+            out[run] = part
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for SegmentedDataset')
+        rowKey, frameKey = key[0], key[1:]
+
+        # a single frame
+        if isinstance(rowKey, (int, np.integer)):
+            row = self._rows([rowKey])
+            seg, run, local = next(self._runs(row))
+            return np.asarray(seg[(int(local[0]),) + frameKey])
+
+        rows = self._rows(rowKey)
+        if all(isinstance(k, slice) for k in frameKey):
+            return self._gather(rows, frameKey)
+        rowSel = slice(None) if isinstance(rowKey, slice) else np.arange(len(rows))
+        return self._gather(rows)[(rowSel,) + frameKey]
+
+    def consolidate(self):
+        """
+        Returns the whole dataset as one contiguous numpy array.
+        """
+        if len(self.segments) == 1 and isinstance(self.segments[0], np.ndarray):
+            return self.segments[0]
+        return self._gather(np.arange(len(self)))
@@ -67,7 +67,7 @@ class softimax_nxus_scan(Scan):
         if not os.path.exists(self.path):
             print('File not found! \n    ', self.path)
             raise NoDataException(self.path)
-        with h5py.File(self.path, 'r') as fp:
+        with self._openFile(self.path) as fp:
             # read the positions
             entry_name = 'entry%u' % self.scanNr
             try:
@@ -94,7 +94,7 @@ class softimax_nxus_scan(Scan):
         data treatment here, with if clauses as needed.
         """
 
-        with h5py.File(self.path, 'r') as fp:
+        with self._openFile(self.path) as fp:
             try:
                 data = fp['entry%u/measurement/%s' % (self.scanNr, self.dataSource)][:]
             except KeyError:
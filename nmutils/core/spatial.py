@@ -0,0 +1,241 @@
+"""
+Spatial lookups on scan positions. PositionIndex keeps the positions
+sorted along the first scanning dimension, which makes box queries
+a binary search plus a check of the candidates, and builds a KD-tree
+on demand for nearest-neighbour and radius queries. voronoiRaster maps
+scattered positions onto a pixel grid without any tree at all.
+"""
+
+from collections import OrderedDict
+import numpy as np
+from scipy.spatial import cKDTree, Delaunay
+from scipy.ndimage import distance_transform_edt
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+
+def inRangeMask(positions, posRange):
+    """
+    Boolean mask of the positions within a box, array([[xmin, ymin,
+    ...], [xmax, ymax, ...]]), edges included. Vectorised, O(N).
+    """
+    posRange = np.asarray(posRange)
+    return np.all((positions >= posRange[0]) & (positions <= posRange[1]), axis=1)
+
+
+def _lines(slow):
+    """
+    Groups positions into lines by their slow coordinate, returning a
+    list of index arrays or None if there is no clear grouping. The
+    gaps between lines are taken as those larger than half the largest
+    gap between sorted slow coordinates.
+    """
+    order = np.argsort(slow, kind='stable')
+    gaps = np.diff(slow[order])
+    if not len(gaps) or gaps.max() <= 0:
+        return None
+    breaks = np.flatnonzero(gaps > gaps.max() / 2) + 1
+    if breaks.size and gaps[gaps <= gaps.max() / 2].max(initial=0) > gaps.max() / 4:
+        return None
+    lines = np.split(order, breaks)
+    if len(lines) < 2 or len(set(len(l) for l in lines)) != 1:
+        return None
+    return lines
+
+
+def regularGrid(positions, tol=.25):
+    """
+    Recognizes 2D positions which lie on a rectilinear mesh, as from
+    raster or snake scans in any order. Returns (order, x, y), where
+    order is an (ny x nx) array of position indices and x, y are the
+    increasing mean coordinates of the columns and rows, or None for
+    irregular positions. Positions may deviate from the mesh by tol
+    times the step size.
+    """
+    if positions.ndim != 2 or positions.shape[1] != 2 or len(positions) < 4:
+        return None
+    for slowDim in (1, 0):
+        fastDim = 1 - slowDim
+        lines = _lines(positions[:, slowDim])
+        if lines is None:
+            continue
+        # sort each line along the fast axis, giving (nlines x npoints)
+        order = np.array([l[np.argsort(positions[l, fastDim], kind='stable')] for l in lines])
+        fast = positions[order, fastDim]
+        slow = positions[order, slowDim]
+        fastCoords = fast.mean(axis=0)
+        slowCoords = slow.mean(axis=1)
+        fastSteps, slowSteps = np.diff(fastCoords), np.diff(slowCoords)
+        if len(fastSteps) < 1 or fastSteps.min() <= 0 or slowSteps.min() <= 0:
+            continue
+        # all points in a column, and in a row, should agree
+        if np.abs(fast - fastCoords).max() > tol * fastSteps.min():
+            continue
+        if np.abs(slow - slowCoords[:, None]).max() > tol * slowSteps.min():
+            continue
+        if slowDim == 1:
+            return order, fastCoords, slowCoords
+        return order.T, slowCoords, fastCoords
+    return None
+
+
+def voronoiRaster(positions, x, y):
+    """
+    Rasterizes the Voronoi cells of 2D positions onto the regular grid
+    given by the 2D coordinate arrays x (varying along columns) and y
+    (along rows), returning the index of the nearest position for each
+    pixel. Each position is splatted onto its pixel, and a Euclidean
+    distance transform spreads the indices over the grid, so the cost
+    is linear in the number of pixels. As this measures distances from
+    pixel centres, the cell boundaries are then corrected with exact
+    distances to the positions of neighbouring pixels until nothing
+    changes. Cells which lose out in the first step and are too thin
+    to reach over neighbouring pixel centres can still be missed, which
+    in tests left a few pixels in a thousand with a position up to half
+    a pixel further away than the nearest one.
+    """
+    x0, y0 = x[0, 0], y[0, 0]
+    dx = x[0, 1] - x0 if x.shape[1] > 1 else 1.
+    dy = y[1, 0] - y0 if y.shape[0] > 1 else 1.
+    col = (positions[:, 0] - x0) / dx
+    row = (positions[:, 1] - y0) / dy
+    icol = np.clip(np.round(col).astype(int), 0, x.shape[1] - 1)
+    irow = np.clip(np.round(row).astype(int), 0, x.shape[0] - 1)
+
+    # write the seeds furthest from their pixel centres first, so that
+    # the closest ones win
+    offset = ((col - icol) * dx)**2 + ((row - irow) * dy)**2
+    order = np.argsort(-offset, kind='stable')
+    seeds = np.full(x.shape, -1, dtype=int)
+    seeds[irow[order], icol[order]] = order
+
+    rows, cols = distance_transform_edt(seeds < 0, sampling=(abs(dy), abs(dx)),
+                                        return_distances=False, return_indices=True)
+    nearest = seeds[rows, cols]
+    dist2 = lambda i, px, py: (positions[i, 0] - px)**2 + (positions[i, 1] - py)**2
+
+    # positions which lost their pixel to another one compete for the
+    # pixels around it
+    lost = np.ones(len(positions), dtype=bool)
+    lost[seeds[seeds >= 0]] = False
+    lost = np.flatnonzero(lost)
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            r = np.clip(irow[lost] + i, 0, x.shape[0] - 1)
+            c = np.clip(icol[lost] + j, 0, x.shape[1] - 1)
+            d = dist2(lost, x[r, c], y[r, c])
+            closer = np.flatnonzero(d < dist2(nearest[r, c], x[r, c], y[r, c]))
+            closer = closer[np.argsort(-d[closer], kind='stable')]
+            nearest[r[closer], c[closer]] = lost[closer]
+
+    # the quantization errs at cell boundaries, so compare pixels with
+    # the positions of their neighbours, again around those which change
+    ny, nx = x.shape
+    padded = np.pad(nearest, 1, mode='edge')
+    edge = np.zeros(x.shape, dtype=bool)
+    for i, j in ((0, 1), (2, 1), (1, 0), (1, 2)):
+        edge |= padded[i:i + ny, j:j + nx] != nearest
+    pixels = np.flatnonzero(edge)
+    while pixels.size:
+        r, c = np.divmod(pixels, nx)
+        neighbours = [np.clip(r + i, 0, ny - 1) * nx + np.clip(c + j, 0, nx - 1)
+                      for i, j in ((-1, 0), (1, 0), (0, -1), (0, 1))]
+        px, py = x.flat[pixels], y.flat[pixels]
+        best = nearest.flat[pixels]
+        bestDist = dist2(best, px, py)
+        for neighbour in neighbours:
+            other = nearest.flat[neighbour]
+            d = dist2(other, px, py)
+            closer = d < bestDist
+            best[closer], bestDist[closer] = other[closer], d[closer]
+        changed = best != nearest.flat[pixels]
+        nearest.flat[pixels] = best
+        pixels = np.unique(np.concatenate([n[changed] for n in neighbours]))
+    return nearest
+
+
+class PositionIndex(object):
+    """
+    Index on an (N x ndim) array of positions, built once and reused
+    for repeated queries. The positions should not be modified while
+    the index is in use.
+    """
+
+    # number of map operators kept, least recently used first out
+    maxMaps = 8
+
+    def __init__(self, positions):
+        self.positions = positions
+        self._order = np.argsort(positions[:, 0], kind='stable')
+        self._sorted = positions[self._order, 0]
+        self._tree = None
+        self._triangulation = None
+        self._grid = False
+
+        # cached map operators, see Scan.mapOperator
+        self.maps = OrderedDict()
+
+    @property
+    def tree(self):
+        """
+        KD-tree on the positions, built the first time it is needed.
+        """
+        if self._tree is None:
+            self._tree = cKDTree(self.positions)
+        return self._tree
+
+    @property
+    def triangulation(self):
+        """
+        Delaunay triangulation of the positions, built when first needed.
+        """
+        if self._triangulation is None:
+            self._triangulation = Delaunay(self.positions)
+        return self._triangulation
+
+    @property
+    def grid(self):
+        """
+        The regular mesh of the positions, see regularGrid(), detected
+        the first time it is needed.
+        """
+        if self._grid is False:
+            self._grid = regularGrid(self.positions)
+        return self._grid
+
+    def inRange(self, posRange):
+        """
+        Sorted indices of the positions within a box, array([[xmin,
+        ymin, ...], [xmax, ymax, ...]]), edges included. Costs
+        O(log N + k) where k is the number of candidates in the first
+        dimension.
+        """
+        posRange = np.asarray(posRange)
+        i0 = np.searchsorted(self._sorted, posRange[0, 0], side='left')
+        i1 = np.searchsorted(self._sorted, posRange[1, 0], side='right')
+        candidates = np.sort(self._order[i0:i1])
+        ok = inRangeMask(self.positions[candidates], posRange)
+        return candidates[ok]
+
+    def nearest(self, points):
+        """
+        Index of the position closest to each point, and the distances.
+        """
+        dist, index = self.tree.query(np.asarray(points, dtype=float))
+        return index, dist
+
+    def within(self, points, radius):
+        """
+        Sorted indices of the positions within radius (inclusive) of
+        any of the points. When there are more points than positions,
+        a temporary tree on the points is queried instead.
+        """
+        points = np.asarray(points, dtype=float).reshape((-1, self.positions.shape[1]))
+        if not len(points):
+            return np.zeros(0, dtype=int)
+        if len(points) > len(self.positions):
+            dist, index = cKDTree(points).query(self.positions,
+                                                distance_upper_bound=radius * (1 + 1e-9))
+            return np.flatnonzero(dist <= radius)
+        hits = self.tree.query_ball_point(points, radius)
+        return np.unique(np.concatenate([np.asarray(h, dtype=int) for h in hits]))
@@ -0,0 +1,143 @@
+"""
+Chunk-streamed writing of large datasets to HDF5, as used by
+Scan.export. Data is written one chunk-aligned block at a time, so
+that the memory needed is bounded by the block size however large the
+scan is.
+
+With gzip or bitshuffle/LZ4 compression, the chunks of each block are
+compressed by a pool of threads and handed to HDF5 with
+write_direct_chunk, bypassing the filter pipeline which would otherwise
+compress one chunk at a time. LZF and uncompressed data are written
+through h5py as usual.
+"""
+
+import zlib
+import struct
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .reductions import BLOCK_BYTES
+
+__docformat__ = 'restructuredtext'  # This is what we're using! Learn about it.
+
+# bitshuffle is needed for bitshuffle/LZ4 compression, and its h5
+# module registers the filter with HDF5.
+try:
+    import bitshuffle
+    import bitshuffle.h5
+    HAS_BITSHUFFLE = True
+except ImportError:
+    HAS_BITSHUFFLE = False
+
+COMPRESSIONS = (None, 'lzf', 'gzip', 'bitshuffle')
+
+# compressions done here rather than by HDF5
+DIRECT = ('gzip', 'bitshuffle')
+
+
+def createDataset(group, name, shape, dtype, chunks=None, compression='lzf'):
+    """
+    Creates an empty dataset for writeBlocks(), chunked as specified
+    or as guessed by h5py if compressed.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression should be one of %s' % (COMPRESSIONS,))
+    opts = {}
+    if compression == 'bitshuffle':
+        if not HAS_BITSHUFFLE:
+            raise ImportError('bitshuffle is needed for bitshuffle compression')
+        opts = {'compression': bitshuffle.h5.H5FILTER,
+                'compression_opts': (0, bitshuffle.h5.H5_COMPRESS_LZ4)}
+    elif compression is not None:
+        opts = {'compression': compression}
+    return group.create_dataset(name=name, shape=shape, dtype=dtype, chunks=chunks, **opts)
+
+
+def blockShape(dset, full=(), blockBytes=BLOCK_BYTES):
+    """
+    Shape of the blocks to write at a time, made up of whole chunks.
+    The axes listed in full always span the dataset, and the others
+    are grown from the last axis to the first as far as about
+    blockBytes allows, so that frames are kept whole where possible.
+    """
+    shape = dset.shape
+    chunks = dset.chunks or (1,) * len(shape)
+    block = [n if d in full else min(c, n) for d, (n, c) in enumerate(zip(shape, chunks))]
+    for d in reversed(range(len(shape))):
+        if d in full:
+            continue
+        other = int(np.prod(block)) // block[d] * dset.dtype.itemsize
+        n = max(1, blockBytes // max(1, other))
+        block[d] = min(shape[d], max(block[d], n - n % chunks[d]))
+    return tuple(block)
+
+
+def blockOffsets(shape, block):
+    """
+    Offsets of all blocks of the given shape in a dataset.
+    """
+    return itertools.product(*[range(0, n, b) for n, b in zip(shape, block)])
+
+
+def _compressor(dset, compression):
+    """
+    Returns a function which compresses a full chunk into the bytes
+    that the dataset's filter would have written.
+    """
+    if compression == 'gzip':
+        level = dset.compression_opts
+        level = 4 if level is None else level
+        return lambda chunk: zlib.compress(chunk, level)
+    itemsize = dset.dtype.itemsize
+    # bitshuffle's default block size, which the header needs in bytes
+    size = max(128, 8192 // itemsize // 8 * 8)
+    header = lambda chunk: struct.pack('>QI', chunk.nbytes, size * itemsize)
+    return lambda chunk: header(chunk) + bitshuffle.compress_lz4(chunk, size).tobytes()
+
+
+def _chunkOffsets(shape, chunks, offset, blockShape):
+    """
+    Offsets of all chunks in a block at offset.
+    """
+    ranges = [range(o, min(o + b, n), c) for o, b, n, c in zip(offset, blockShape, shape, chunks)]
+    return list(itertools.product(*ranges))
+
+
+def _chunk(block, offset, start, chunks):
+    """
+    Cuts the chunk at offset out of a block at start, and pads edge
+    chunks to the full chunk shape as HDF5 expects.
+    """
+    part = block[tuple(slice(o - s, o - s + c) for o, s, c in zip(offset, start, chunks))]
+    if not part.shape == tuple(chunks):
+        full = np.zeros(chunks, dtype=block.dtype)
+        full[tuple(slice(0, n) for n in part.shape)] = part
+        part = full
+    return np.ascontiguousarray(part)
+
+
+def writeBlocks(dset, blocks, compression=None, nThreads=1):
+    """
+    Writes (offset, block) pairs into dset, where offset is the index
+    of the first element of block in each axis. Blocks should start
+    on chunk boundaries, as from blockShape() and blockOffsets(). With
+    compression in DIRECT, chunks are compressed by nThreads threads,
+    and the compression should be that given to createDataset().
+    """
+    if compression not in DIRECT:
+        for offset, block in blocks:
+            dset[tuple(slice(o, o + n) for o, n in zip(offset, block.shape))] = block
+        return
+    if compression == 'bitshuffle' and not HAS_BITSHUFFLE:
+        raise ImportError('bitshuffle is needed for bitshuffle compression')
+    chunks = dset.chunks
+    compress = _compressor(dset, compression)
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        for offset, block in blocks:
+            if any(o % c for o, c in zip(offset, chunks)):
+                raise ValueError('Blocks must start on chunk boundaries')
+            block = np.asarray(block, dtype=dset.dtype)
+            offsets = _chunkOffsets(dset.shape, chunks, offset, block.shape)
+            compressed = executor.map(lambda o: compress(_chunk(block, o, offset, chunks)), offsets)
+            for o, data in zip(offsets, compressed):
+                dset.id.write_direct_chunk(o, data)
@@ -98,6 +98,13 @@ class ScanViewer(qt.QMainWindow):
         # connect load button
         self.ui.loadButton.clicked.connect(self.load)
 
+        # a refresh button for following running scans, not in the design file
+        self.refreshButton = qt.QPushButton('Refresh')
+        self.refreshButton.setToolTip('Read the positions and frames recorded since loading')
+        self.refreshButton.setEnabled(False)
+        self.ui.gridLayout.addWidget(self.refreshButton, 2, 5, 1, 1)
+        self.refreshButton.clicked.connect(self.refresh)
+
         # connect the PyMCA button to the slot on that widget
         self.ui.pymcaButton.clicked.connect(self.ui.xrfWidget.exportPyMCA)
 
@@ -275,6 +282,7 @@ class ScanViewer(qt.QMainWindow):
     @scan.setter
     def scan(self, scn):
         self._scan = scn
+        self.refreshButton.setEnabled(scn is not None)
         if scn is None:
             # clear all the widgets' references
             self.ui.xrdWidget.setScan(None)
@@ -297,6 +305,27 @@ class ScanViewer(qt.QMainWindow):
             if '0d' in scn.data.keys():
                 self.ui.scalarWidget.setScan(scn)
 
+    def refresh(self):
+        """
+        Appends whatever has been recorded since the scan was loaded.
+        """
+        if not self.scan:
+            return
+        try:
+            self.statusOutput("Refreshing...")
+            n = self.scan.refresh()
+            self.scan.close()
+        except (RuntimeError, ValueError) as e:
+            print(e)
+            self.statusOutput("Could not refresh")
+            return
+        except nmutils.NoDataException:
+            self.statusOutput("No data found")
+            return
+        if n:
+            self._update()
+        self.statusOutput("%u new positions" % n)
+
     def load(self):
         try:
             self.statusOutput("Loading data...")
@@ -328,6 +357,9 @@ class ScanViewer(qt.QMainWindow):
                     print("loaded 2D was %uD, discarding" % dim)
                     raise nmutils.NoDataException
                 print("loaded 2D data: %d positions, %d x %d pixels"%(scan_.data['2d'].shape))
+            except nmutils.MemoryBudgetError as e:
+                # raised before reading anything, with suggestions
+                print(e)
             except MemoryError:
                 print("Out of memory! Consider cropping or binning your images")
             except nmutils.NoDataException:
@@ -375,6 +407,9 @@ class ScanViewer(qt.QMainWindow):
                 self.statusOutput("")
                 return
 
+            # all sources were read through the same file handles
+            scan_.close()
+
             # maybe there was no data at all
             if scan_.positions is None:
                 self.statusOutput("No data found")
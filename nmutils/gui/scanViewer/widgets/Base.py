@@ -70,8 +70,8 @@ class PairedWidgetBase(qt.QWidget):
         self.selectionMode = 'roi'
 
     def selectByPosition(self, x, y):
-        idx = np.argmin(np.linalg.norm(self.scan.positions - np.array((x, y)), axis=1))
-        self.map.indexBox.setValue(idx)
+        index, dist = self.scan.nearest((x, y))
+        self.map.indexBox.setValue(int(index[0]))
 
     def clearSelection(self):
         # This does everything
@@ -1,5 +1,4 @@
 from silx.gui import qt
-import scipy.ndimage.measurements
 import numpy as np
 
 from .MapWidget import MapWidget
@@ -105,16 +104,13 @@ class ComWidget(qt.QWidget):
             xlims = self.map.getGraphXLimits()
             ylims = self.map.getGraphYLimits()
             # calculate COM
-            com = []
             mask = self.image.getMaskToolsDockWidget().widget().getSelectionMask()
             if (mask is None) or (not np.sum(mask)):
-                mask = np.zeros(self.scan.data['2d'][0].shape, dtype=int)
-            for im in self.scan.data['2d']:
-                com_ = scipy.ndimage.measurements.center_of_mass(im * (1 - mask))
-                if np.any(np.isnan(com_)):
-                    com_ = (0, 0)
-                com.append(com_)
-            com = np.array(com)
+                mask = None
+            else:
+                mask = (mask != 0)
+            com = self.scan.centerOfMass('2d', mask=mask)
+            com[np.any(np.isnan(com), axis=1)] = 0
             # choose which COM to show
             if direction == 1:
                 com = com[:, 1] - np.mean(com[:, 1])
@@ -105,14 +105,9 @@ class ScalarWidget(PairedWidgetBase):
                     dummy = np.zeros(self.scan.nPositions)
                     x, y, z = self.scan.interpolatedMap(dummy, self.map.interpolBox.value(), origin='ul')
                     maskedPoints = np.vstack((x[np.where(mask)], y[np.where(mask)])).T
-                    pointSpacing2 = (x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2
-                    # go through actual positions and find the masked ones
-                    maskedPositions = []
-                    for i in range(self.scan.nPositions):
-                        # the minimum distance of the current position to a selected grid point:
-                        dist2 = np.sum((maskedPoints - self.scan.positions[i])**2, axis=1).min()
-                        if dist2 < pointSpacing2:
-                            maskedPositions.append(i)
+                    pointSpacing = np.sqrt((x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2)
+                    # find the actual positions close to a selected grid point
+                    maskedPositions = self.scan.within(maskedPoints, pointSpacing)
                     # get the average and replace the image with legend 'data'
                     print('calculating average scalar from %d positions'%len(maskedPositions))
                     data = np.mean(self.scan.data['0d'][maskedPositions], axis=0)
@@ -101,11 +101,10 @@ class XrdWidget(PairedWidgetBase):
             # if the mask is cleared, reset without wasting time
             if (mask is None) or (not np.sum(mask)):
                 print('building 2D data map by averaging all pixels')
-                average = np.mean(self.scan.data['2d'], axis=(1,2))
+                average = self.scan.reduceData('2d', 'mean', over='pixels')
             else:
-                ii, jj = np.where(mask)
-                print('building 2D data map by averaging %d pixels'%len(ii))
-                average = np.mean(self.scan.data['2d'][:, ii, jj], axis=1)
+                print('building 2D data map by averaging %d pixels'%np.sum(mask != 0))
+                average = self.scan.reduceData('2d', 'mean', over='pixels', mask=(mask != 0))
             sampling = self.map.interpolBox.value()
             x, y, z = self.scan.interpolatedMap(average, sampling, origin='ul', method='nearest')
             self.map.addImage(z, legend='data', 
@@ -145,24 +144,19 @@ class XrdWidget(PairedWidgetBase):
                 if (mask is None) or (not np.sum(mask)):
                     # the mask is empty, don't waste time with positions
                     print('building 2D image from all positions')
-                    data = np.mean(self.scan.data['2d'], axis=0)
+                    data = self.scan.reduceData('2d', 'mean', over='positions')
                 else:
                     # recreate the interpolated grid from above, to find masked
                     # positions on the oversampled grid
                     dummy = np.zeros(self.scan.nPositions)
                     x, y, z = self.scan.interpolatedMap(dummy, self.map.interpolBox.value(), origin='ul')
                     maskedPoints = np.vstack((x[np.where(mask)], y[np.where(mask)])).T
-                    pointSpacing2 = (x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2
-                    # go through actual positions and find the masked ones
-                    maskedPositions = []
-                    for i in range(self.scan.nPositions):
-                        # the minimum distance of the current position to a selected grid point:
-                        dist2 = np.sum((maskedPoints - self.scan.positions[i])**2, axis=1).min()
-                        if dist2 < pointSpacing2:
-                            maskedPositions.append(i)
+                    pointSpacing = np.sqrt((x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2)
+                    # find the actual positions close to a selected grid point
+                    maskedPositions = self.scan.within(maskedPoints, pointSpacing)
                     print('building 2D image from %d positions'%len(maskedPositions))
                     # get the average and replace the image with legend 'data'
-                    data = np.mean(self.scan.data['2d'][maskedPositions], axis=0)
+                    data = self.scan.reduceData('2d', 'mean', over='positions', positions=maskedPositions)
             self.image.addImage(data, legend='data', resetzoom=False)
             self.image.setGraphTitle(self.scan.dataTitles['2d'])
             self.image.setGraphXLabel(self.scan.dataDimLabels['2d'][1])
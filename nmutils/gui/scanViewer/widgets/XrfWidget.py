@@ -69,8 +69,13 @@ class XrfWidget(PairedWidgetBase):
         if self.map.positionsAction.isChecked():
             self.togglePositions()
         self.map.indexBox.setMaximum(scan.nPositions - 1)
+        # prefix sums make any ROI map two column lookups, built once
+        # per scan and again when it is refreshed or merged
+        fast = scan.prefixSums('1d') is not None
         self.resetMap()
         self.resetSpectrum()
+        if not fast:
+            self.window().statusOutput('Not enough memory for fast ROI maps, integrating each ROI in full')
 
     def resetMap(self):
         self.updateMap()
@@ -98,7 +103,7 @@ class XrfWidget(PairedWidgetBase):
             roi = self.spectrum.getCurvesRoiWidget().currentRoi
             if roi is None:
                 print("building 1D data map from the whole spectrum")
-                average = np.mean(self.scan.data['1d'], axis=1)
+                average = self.scan.reduceData('1d', 'mean', over='pixels')
             else:
                 lowerval = roi.getFrom()
                 upperval = roi.getTo()
@@ -106,7 +111,7 @@ class XrfWidget(PairedWidgetBase):
                 upper = (np.abs(xvector - upperval)).argmin()
                 lower = (np.abs(xvector - lowerval)).argmin()
                 print("building 1D data map from channels %d to %d"%(lower, upper))
-                average = np.mean(self.scan.data['1d'][:, lower:upper], axis=1)
+                average = self.scan.roiIntegrals('1d', [(lower, upper)], op='mean')[:, 0]
 
             # interpolate and plot map
             sampling = self.map.interpolBox.value()
@@ -138,24 +143,19 @@ class XrfWidget(PairedWidgetBase):
                 if (mask is None) or (not np.sum(mask)):
                     # the mask is empty, don't waste time with positions
                     print('building 1D curve from all positions')
-                    data = np.mean(self.scan.data['1d'], axis=0)
+                    data = self.scan.reduceData('1d', 'mean', over='positions')
                 else:
                     # recreate the interpolated grid from above, to find masked
                     # positions on the oversampled grid
                     dummy = np.zeros(self.scan.nPositions)
                     x, y, z = self.scan.interpolatedMap(dummy, self.map.interpolBox.value(), origin='ul')
                     maskedPoints = np.vstack((x[np.where(mask)], y[np.where(mask)])).T
-                    pointSpacing2 = (x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2
-                    # go through actual positions and find the masked ones
-                    maskedPositions = []
-                    for i in range(self.scan.nPositions):
-                        # the minimum distance of the current position to a selected grid point:
-                        dist2 = np.sum((maskedPoints - self.scan.positions[i])**2, axis=1).min()
-                        if dist2 < pointSpacing2:
-                            maskedPositions.append(i)
+                    pointSpacing = np.sqrt((x[0,1] - x[0,0])**2 + (y[0,0] - y[1,0])**2)
+                    # find the actual positions close to a selected grid point
+                    maskedPositions = self.scan.within(maskedPoints, pointSpacing)
                     print('building 1D curve from %d positions'%len(maskedPositions))
                     # get the average and replace the image with legend 'data'
-                    data = np.mean(self.scan.data['1d'][maskedPositions], axis=0)
+                    data = self.scan.reduceData('1d', 'mean', over='positions', positions=maskedPositions)
             self.spectrum.addCurve(self.scan.dataAxes['1d'][0], data, legend='data',
                 resetzoom = False)
             self.spectrum.setGraphTitle(self.scan.dataTitles['1d'])
@@ -0,0 +1,88 @@
+import os
+import h5py
+import numpy as np
+import pytest
+
+import nmutils.core
+from nmutils.core import filepool
+
+try:
+    import hdf5plugin
+    HAS_HDF5PLUGIN = True
+except ImportError:
+    HAS_HDF5PLUGIN = False
+
+
+class ContrastFile(object):
+    """
+    A small scan in the contrast format, on an nx by ny raster with a
+    little jitter, and the arrays written to it.
+    """
+
+    def __init__(self, path, scanNr=1, nx=8, ny=6, frame=(16, 12), bursts=1, missing=0,
+                 chunks=None, growable=False, seed=0):
+        rng = np.random.default_rng(seed)
+        n = nx * ny
+        self.path, self.scanNr = path, scanNr
+        self.fileName = os.path.join(path, '%06u.h5' % scanNr)
+        self.x = np.tile(np.arange(nx) * .1, ny) + rng.normal(0, .002, n)
+        self.y = np.repeat(np.arange(ny) * .2, nx) + rng.normal(0, .002, n)
+        self.frames = rng.integers(0, 100, size=(n * bursts - missing,) + frame, dtype=np.uint16)
+        self.I0 = rng.uniform(.5, 1.5, n)
+        self.xrf = rng.poisson(3, size=(n, 4, 64)).astype(np.float32)
+        chunks = chunks or (1,) + frame
+        grow = lambda shape: {'maxshape': (None,) + shape[1:]} if growable else {}
+        filepool.pool.close()
+        with h5py.File(self.fileName, 'w', libver='latest') as fp:
+            m = fp.create_group('entry/measurement')
+            for key, value in (('pseudo/x', self.x), ('pseudo/y', self.y),
+                               ('alba2/1', self.I0), ('alba2/2', 2 * self.I0)):
+                m.create_dataset(key, data=value, chunks=(16,) if growable else None,
+                                 **grow(value.shape))
+            m.create_dataset('merlin/frames', data=self.frames, chunks=chunks,
+                             **grow(self.frames.shape))
+            if HAS_HDF5PLUGIN:
+                m.create_dataset('eiger4m/frames', data=self.frames.astype(np.uint32),
+                                 chunks=chunks, **hdf5plugin.Bitshuffle(cname='lz4'))
+            m.create_dataset('xspress3/data', data=self.xrf, chunks=(8, 4, 64),
+                             **grow(self.xrf.shape))
+            fp.create_group('entry/snapshot')
+
+    def resize(self, n):
+        """
+        Cuts the growable datasets to, or grows them back to, the first
+        n positions, as a running scan would have written them.
+        """
+        filepool.pool.close()
+        with h5py.File(self.fileName, 'a', libver='latest') as fp:
+            m = fp['entry/measurement']
+            for key, value in (('pseudo/x', self.x), ('pseudo/y', self.y), ('alba2/1', self.I0),
+                               ('alba2/2', 2 * self.I0), ('merlin/frames', self.frames),
+                               ('xspress3/data', self.xrf)):
+                m[key].resize(min(n, len(value)), axis=0)
+                m[key][:] = value[:m[key].shape[0]]
+
+    @property
+    def nPositions(self):
+        return len(self.x)
+
+    def load(self, name='m', dataSource='merlin', **kwargs):
+        """
+        Returns a contrast_scan with this file loaded as dataset name.
+        """
+        scan = nmutils.core.contrast_scan()
+        scan.productCache = None
+        scan.addData(name=name, dataSource=dataSource, path=self.path,
+                     scanNr=self.scanNr, **kwargs)
+        return scan
+
+
+@pytest.fixture
+def contrastFile(tmp_path):
+    """
+    Factory writing ContrastFile scans to a temporary directory.
+    """
+    def make(**kwargs):
+        return ContrastFile(str(tmp_path), **kwargs)
+    yield make
+    filepool.pool.close()
@@ -0,0 +1,110 @@
+import os
+import time
+import numpy as np
+import pytest
+
+from nmutils.core import ProductCache, reductions
+
+
+def _entries(cache):
+    return sorted(f for f in os.listdir(cache.directory) if f.endswith('.npz'))
+
+
+def test_keys():
+    key = ProductCache.key
+    a = np.arange(6)
+    assert key('x', a, {'b': 1, 'a': [1, 2]}) == key('x', a.copy(), {'a': [1, 2], 'b': 1})
+    assert key('x', a) != key('x', a.reshape((2, 3)))
+    assert key('x', a) != key('x', a.astype(np.int32))
+    assert key((1, 2)) != key([1, 2]) and key(1, 2) != key((1, 2))
+    assert key(None) != key('None')
+
+
+def test_get_put_and_eviction(tmp_path):
+    cache = ProductCache(str(tmp_path / 'cache'), maxBytes=10 ** 6)
+    assert cache.get('missing') is None
+    values = [np.random.default_rng(i).random(2000) for i in range(4)]
+    for i, value in enumerate(values):
+        cache.put(cache.key(i), value)
+        os.utime(cache._path(cache.key(i)), ns=(i * 10 ** 9, i * 10 ** 9))
+    assert len(_entries(cache)) == 4
+    assert np.array_equal(cache.get(cache.key(2)), values[2])
+    # reading refreshes an entry, so the oldest unread ones go first
+    size = os.path.getsize(cache._path(cache.key(0)))
+    cache.evict(2 * size)
+    assert _entries(cache) == sorted([cache.key(2) + '.npz', cache.key(3) + '.npz'])
+    cache.clear()
+    assert _entries(cache) == []
+
+
+def test_broken_entries_miss(tmp_path):
+    cache = ProductCache(str(tmp_path))
+    with open(cache._path('broken'), 'w') as fp:
+        fp.write('not a zip file')
+    assert cache.get('broken') is None
+
+
+@pytest.fixture
+def cachedScan(contrastFile, tmp_path):
+    f = contrastFile(scanNr=3)
+    cache = ProductCache(str(tmp_path / 'cache'))
+
+    def load(I0='alba2/1', **kwargs):
+        scan = f.load(I0=I0, **kwargs)
+        scan.productCache = cache
+        scan.cacheMinBytes = 0
+        return scan
+    return f, cache, load
+
+
+def test_scan_products_are_reused(cachedScan, monkeypatch):
+    f, cache, load = cachedScan
+    scan = load()
+    mask = np.zeros(f.frames.shape[1:], dtype=bool)
+    mask[:5] = True
+    mean = scan.meanData('m')
+    com = scan.centerOfMass('m', mask=mask)
+    sums = scan.reduceData('m', 'sum', over='pixels')
+    assert np.allclose(mean, (f.frames / f.I0[:, None, None]).mean(axis=0))
+    assert len(_entries(cache)) == 3
+    # a new scan on the same file reads them back without reducing
+    again = load()
+    with monkeypatch.context() as m:
+        m.setattr(reductions, 'reduce', None)
+        m.setattr(reductions, 'centerOfMass', None)
+        assert np.array_equal(again.meanData('m'), mean)
+        assert np.array_equal(again.centerOfMass('m', mask=mask), com)
+        assert np.array_equal(again.reduceData('m', 'sum', over='pixels'), sums)
+    assert len(_entries(cache)) == 3
+
+
+def test_changes_miss_the_cache(cachedScan):
+    f, cache, load = cachedScan
+    scan = load()
+    mean = scan.meanData('m')
+    # other load options
+    assert not np.allclose(load(I0='alba2/2').meanData('m'), mean)
+    assert len(_entries(cache)) == 2
+    # the raw data is what the file gives without I0
+    scan.setI0(None)
+    assert np.allclose(scan.meanData('m'), f.frames.mean(axis=0))
+    assert len(_entries(cache)) == 3
+    # changed data is not cached
+    scan.setI0(np.ones(f.nPositions))
+    scan.meanData('m')
+    subset = load().subset(np.array([[0, 0], [.35, .5]]))
+    subset.meanData('m')
+    assert len(_entries(cache)) == 3
+    # a touched file is a new file
+    stamp = time.time_ns() + 10 ** 9
+    os.utime(f.fileName, ns=(stamp, stamp))
+    assert np.allclose(load().meanData('m'), mean)
+    assert len(_entries(cache)) == 4
+
+
+def test_small_products_are_not_cached(cachedScan):
+    f, cache, load = cachedScan
+    scan = load()
+    scan.cacheMinBytes = scan.data['m'].nbytes + 1
+    scan.meanData('m')
+    assert not os.path.exists(cache.directory) or not _entries(cache)
@@ -0,0 +1,116 @@
+import h5py
+import numpy as np
+import pytest
+
+from nmutils.core import LazyDataset, SegmentedDataset, ScaledDataset
+
+
+def _stack(shape=(20, 6, 5), seed=0):
+    return np.random.default_rng(seed).integers(0, 50, size=shape, dtype=np.uint16)
+
+
+def _keys(n):
+    return [3, -1, slice(2, 9), slice(None, None, 3), [4, 0, 7], np.arange(n) % 3 == 0,
+            (slice(1, 5), slice(2, 4)), (slice(None), 2, 3), (slice(None), [1, 2], [3, 4]),
+            ([5, 2], slice(None), 1), (Ellipsis, 0), (2, slice(1, 3))]
+
+
+def _lazy(tmp_path, data, **kwargs):
+    path = str(tmp_path / 'frames.h5')
+    with h5py.File(path, 'w') as fp:
+        fp.create_dataset('frames', data=data, chunks=(4,) + data.shape[1:])
+    return LazyDataset(path, 'frames', **kwargs)
+
+
+def test_lazy_indexing(tmp_path):
+    data = _stack()
+    lazy = _lazy(tmp_path, data)
+    assert lazy.shape == data.shape and lazy.dtype == data.dtype
+    for key in _keys(len(data)):
+        assert np.array_equal(lazy[key], data[key]), key
+    assert np.array_equal(np.asarray(lazy), data)
+
+
+def test_lazy_crop_missing_frames_and_scale(tmp_path):
+    data = _stack()
+    crop = (slice(1, 5), slice(0, 4))
+    index = np.array([0, 3, -1, 5, 19, -1])
+    lazy = _lazy(tmp_path, data, index=index, crop=crop)
+    frames = data[index[index >= 0]][(slice(None),) + crop]
+    fill = np.around(frames.astype(float).mean(axis=0)).astype(data.dtype)
+    assert np.array_equal(lazy[[0, 1, 3, 4]], frames)
+    assert np.array_equal(lazy[2], fill) and np.array_equal(lazy[5], fill)
+    assert np.all(np.isnan(lazy.pad(2, value=np.nan)[6:]))
+
+    scale = np.linspace(1, 2, len(index))
+    scaled = LazyDataset(lazy.fileName, 'frames', index=index[:2], crop=crop, scale=scale[:2])
+    assert np.allclose(scaled[:], frames[:2] * scale[:2, None, None])
+    both = scaled.append(scaled.take([1]))
+    assert np.allclose(both[2], frames[1] * scale[1])
+
+
+def test_segmented_dataset():
+    data = _stack()
+    segmented = SegmentedDataset([data[:7], data[7:8], data[8:]])
+    assert segmented.shape == data.shape and len(segmented.segments) == 3
+    for key in _keys(len(data)):
+        assert np.array_equal(segmented[key], data[key]), key
+    taken = segmented.take([1, 2, 3, 9, 4])
+    assert isinstance(taken, SegmentedDataset)
+    assert np.array_equal(taken[:], data[[1, 2, 3, 9, 4]])
+    # consecutive rows are views into the segments
+    assert np.shares_memory(taken.segments[0], data)
+    padded = segmented.pad(3)
+    assert np.array_equal(padded[20:], np.broadcast_to(
+        np.around(data.mean(axis=0)).astype(data.dtype), (3,) + data.shape[1:]))
+    consolidated = segmented.consolidate()
+    assert isinstance(consolidated, np.ndarray) and np.array_equal(consolidated, data)
+    with pytest.raises(ValueError):
+        segmented.append(np.zeros((2, 3, 3)))
+
+
+def test_scaled_dataset():
+    data = _stack()
+    scale = np.linspace(.5, 2, len(data))
+    scaled = ScaledDataset(data, scale, dtype=np.float32)
+    reference = (data * scale[:, None, None]).astype(np.float32)
+    assert scaled.dtype == np.float32 and scaled.shape == data.shape
+    for key in _keys(len(data)):
+        assert np.allclose(scaled[key], reference[key]), key
+    taken = scaled.take(np.arange(3, 9))
+    assert np.shares_memory(taken.base, data)
+    assert np.allclose(taken[:], reference[3:9])
+    assert np.allclose(scaled.pad(2)[20:], reference.mean(axis=0), rtol=1e-5)
+    with pytest.raises(ValueError):
+        ScaledDataset(data, scale[1:])
+
+
+def test_scaled_dataset_behaves_like_an_array():
+    data = _stack()
+    scale = np.linspace(.5, 2, len(data))
+    scaled = ScaledDataset(data, scale)
+    reference = data * scale[:, None, None]
+    assert np.allclose(scaled * 2 + 1, reference * 2 + 1)
+    assert np.array_equal(scaled > 20, reference > 20)
+    assert np.allclose(np.log1p(scaled), np.log1p(reference))
+    assert scaled.astype(np.float32).dtype == np.float32
+    assert scaled.T.shape == reference.T.shape
+    assert scaled.reshape((len(data), -1)).shape == (len(data), 30)
+    assert np.isclose(scaled.min(), reference.min()) and np.isclose(scaled.max(), reference.max())
+    assert np.allclose(scaled.mean(axis=(1, 2)), reference.mean(axis=(1, 2)))
+    assert np.allclose(scaled.copy(), reference)
+
+
+def test_scaled_dataset_fills_non_finite_values():
+    data = _stack().astype(float)
+    I0 = np.linspace(.5, 2, len(data))
+    I0[[2, 11]] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference = data / I0[:, None, None]
+        scaled = ScaledDataset(data, 1 / I0, fillNonFinite=True)
+    good = np.isfinite(reference)
+    reference[~good] = reference[good].mean()
+    assert np.allclose(scaled[:], reference)
+    assert np.allclose(scaled[11, 2, 3], reference[11, 2, 3])
+    # subsets keep the mean of the whole dataset
+    assert np.allclose(scaled.take([2, 3])[:], reference[[2, 3]])
@@ -0,0 +1,97 @@
+import h5py
+import numpy as np
+import pytest
+
+from nmutils.core import Scan, SegmentedDataset
+from nmutils.core import writers
+
+
+def _scan(nx=40, ny=30, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    scan = Scan()
+    scan.positions = np.vstack((xx.ravel() + .01 * rng.random(nx * ny), yy.ravel())).T.astype(float)
+    # large enough to be chunked
+    scan.data['img'] = rng.integers(0, 100, (nx * ny, 32, 30)).astype(np.float32)
+    half = nx * ny // 2
+    scan.data['xrf'] = SegmentedDataset([rng.random((half, 300)), rng.random((nx * ny - half, 300))])
+    scan.data['i0'] = rng.random(nx * ny)
+    return scan
+
+
+def _old(scan, name, method):
+    """
+    The datasets as the export used to write them, whole.
+    """
+    data = np.asarray(scan.data[name])
+    if method == 'reshape':
+        return data.reshape((30, 40) + data.shape[1:])
+    if method == 'resample':
+        return scan.interpolatedMap(data, 1, equal=True)[-1].astype(data.dtype)
+    return data
+
+
+@pytest.fixture
+def smallBlocks(monkeypatch):
+    """
+    Writes in many blocks, so that the block edges are exercised.
+    """
+    monkeypatch.setattr(writers.blockShape, '__defaults__', ((), 20000))
+
+
+@pytest.mark.parametrize('compression', writers.COMPRESSIONS)
+@pytest.mark.parametrize('method', ['reshape', 'resample', 'none'])
+def test_export_matches_old_layout(tmp_path, smallBlocks, method, compression):
+    if compression == 'bitshuffle' and not writers.HAS_BITSHUFFLE:
+        pytest.skip('bitshuffle is not installed')
+    scan = _scan()
+    fileName = str(tmp_path / 'export.h5')
+    scan.export(fileName, method=method, compression=compression, nThreads=3)
+    with h5py.File(fileName, 'r') as fp:
+        assert fp['entry0'].attrs['version'] == '0.1'
+        x = fp['entry0/data/positions_x'][:]
+        if method == 'reshape':
+            assert np.array_equal(x, scan.positions[:, 0].reshape((30, 40)))
+        elif method == 'none':
+            assert np.array_equal(x, scan.positions[:, 0])
+        for name in scan.data:
+            old = _old(scan, name, method)
+            dset = fp['entry0/data/' + name]
+            assert dset.shape == old.shape and dset.dtype == old.dtype
+            assert np.allclose(dset[:], old, equal_nan=True), name
+
+
+@pytest.mark.parametrize('access', ['frames', 'maps', 'balanced'])
+def test_export_access_patterns(tmp_path, smallBlocks, access):
+    scan = _scan()
+    fileName = str(tmp_path / 'export.h5')
+    scan.export(fileName, method='reshape', compression='gzip', nThreads=2, access=access)
+    with h5py.File(fileName, 'r') as fp:
+        dset = fp['entry0/data/img']
+        assert dset.chunks == scan._calcChunkSize(dset.shape, 4, access, 2)
+        assert np.array_equal(dset[:], _old(scan, 'img', 'reshape'))
+        # small datasets are not chunked more than h5py would
+        assert np.array_equal(fp['entry0/data/i0'][:], _old(scan, 'i0', 'reshape'))
+
+
+def test_chunk_shapes():
+    scan = Scan()
+    shape = (100, 200, 512, 512)
+    assert scan._calcChunkSize((10, 10), 8) is None
+    frames = scan._calcChunkSize(shape, 4, 'frames', 2)
+    assert frames[2:] == (512, 512) and np.prod(frames) * 4 <= 1 << 22
+    maps = scan._calcChunkSize(shape, 4, 'maps', 2)
+    assert maps[:2] == (100, 200) and np.prod(maps) * 4 <= 1 << 22
+    balanced = scan._calcChunkSize(shape, 4, 'balanced', 2)
+    assert 1 < np.prod(balanced[:2]) < 100 * 200 and 1 < np.prod(balanced[2:]) < 512 * 512
+    assert scan._calcChunkSize((1 << 22,), 8, 'frames', 1)[0] == 1 << 19
+    with pytest.raises(ValueError):
+        scan._calcChunkSize(shape, 4, 'pixels', 2)
+
+
+def test_export_refuses_to_overwrite(tmp_path):
+    scan = _scan(nx=4, ny=3)
+    fileName = str(tmp_path / 'export.h5')
+    scan.export(fileName, method='none')
+    with pytest.raises((OSError, ValueError)):
+        scan.export(fileName, method='none')
@@ -0,0 +1,91 @@
+import os
+import time
+import h5py
+import numpy as np
+
+from nmutils.core.filepool import FilePool
+
+
+def _write(path, value):
+    with h5py.File(path, 'w') as fp:
+        fp['x'] = value
+
+
+def test_nested_borrows(tmp_path):
+    path = str(tmp_path / 'a.h5')
+    _write(path, np.arange(3))
+    pool = FilePool()
+    with pool.borrow(path) as outer:
+        with pool.borrow(path) as inner:
+            assert inner is outer
+        # the inner with statement must not close the outer handle
+        assert outer.id.valid
+        pool.close(path)
+        assert outer.id.valid
+        assert outer['x'][()].tolist() == [0, 1, 2]
+    assert not outer.id.valid
+    assert len(pool) == 0
+
+
+def test_file_changed_between_borrows(tmp_path):
+    path = str(tmp_path / 'a.h5')
+    _write(path, np.arange(3))
+    pool = FilePool()
+    with pool.borrow(path) as fp:
+        assert fp['x'].shape == (3,)
+    # an idle handle is closed when its file changes
+    pool.close(path)
+    time.sleep(.01)
+    _write(path, np.arange(5))
+    with pool.borrow(path) as fp:
+        assert fp['x'].shape == (5,)
+
+
+def test_file_changed_while_borrowed(tmp_path):
+    path = str(tmp_path / 'a.h5')
+    _write(path, np.arange(3))
+    pool = FilePool()
+    with pool.borrow(path) as outer:
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        with pool.borrow(path) as inner:
+            # a new handle is opened, the old one stays usable
+            assert inner is not outer
+            assert outer.id.valid
+        assert inner.id.valid
+        assert outer['x'].shape == (3,)
+    # the stale handle is closed when its last borrower is done
+    assert not outer.id.valid
+    assert len(pool) == 1
+    pool.close()
+    assert not inner.id.valid
+
+
+def test_eviction_waits_for_borrowers(tmp_path):
+    paths = [str(tmp_path / ('%u.h5' % i)) for i in range(3)]
+    for path in paths:
+        _write(path, np.arange(3))
+    pool = FilePool(maxFiles=1)
+    with pool.borrow(paths[0]) as first:
+        for path in paths[1:]:
+            with pool.borrow(path):
+                pass
+        assert paths[0] not in pool
+        assert first.id.valid
+    assert not first.id.valid
+    assert len(pool) == 1
+
+
+def test_swmr_and_normal_handles_are_separate(tmp_path):
+    path = str(tmp_path / 'a.h5')
+    with h5py.File(path, 'w', libver='latest') as fp:
+        fp['x'] = np.arange(3)
+    pool = FilePool()
+    with pool.borrow(path) as normal:
+        with pool.borrow(path, swmr=True) as swmr:
+            assert swmr is not normal
+        with pool.borrow(path) as again:
+            assert again is normal
+    assert len(pool) == 2
+    pool.close(path)
+    assert len(pool) == 0 and path not in pool
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from scipy.interpolate import griddata
+from scipy.spatial import cKDTree
+
+from nmutils.core import Scan
+from nmutils.core.spatial import regularGrid, voronoiRaster
+
+
+def _raster(nx=12, ny=9, snake=False, jitter=.002, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.tile(np.arange(nx) * .1, ny)
+    if snake:
+        x = x.reshape(ny, nx)
+        x[1::2] = x[1::2, ::-1]
+        x = x.ravel()
+    y = np.repeat(np.arange(ny) * .2, nx)
+    return np.vstack((x, y)).T + rng.normal(0, jitter, (nx * ny, 2))
+
+
+def _spiral(n=400):
+    r = .05 * np.sqrt(np.arange(n))
+    phi = np.arange(n) * np.pi * (3 - np.sqrt(5))
+    return np.vstack((r * np.cos(phi), r * np.sin(phi))).T
+
+
+def _scan(positions):
+    scan = Scan()
+    scan.positions = positions
+    return scan
+
+
+@pytest.mark.parametrize('snake', [False, True])
+def test_regular_grid(snake):
+    positions = _raster(snake=snake)
+    order, x, y = regularGrid(positions)
+    assert order.shape == (9, 12)
+    assert np.array_equal(np.sort(order.ravel()), np.arange(len(positions)))
+    assert np.allclose(x, np.arange(12) * .1, atol=.01)
+    assert np.allclose(y, np.arange(9) * .2, atol=.01)
+    assert np.allclose(positions[order, 0], x[None, :], atol=.01)
+
+
+def test_irregular_positions_have_no_grid():
+    assert regularGrid(_spiral()) is None
+    assert regularGrid(_raster()[:-1]) is None
+
+
+def test_regular_map_is_a_reshape():
+    positions = _raster()
+    values = np.arange(len(positions), dtype=float)
+    scan = _scan(positions)
+    order = regularGrid(positions)[0]
+    x, y, z = scan.interpolatedMap(values, 1, origin='ul', method='nearest')
+    assert z.shape == order.shape
+    assert np.array_equal(z, values[order])
+    x, y, z = scan.interpolatedMap(values, 1, origin='lr', method='nearest')
+    assert np.array_equal(z, values[order][::-1, ::-1])
+
+
+@pytest.mark.parametrize('method', ['nearest', 'linear'])
+def test_scattered_maps_match_griddata(method):
+    positions = _spiral()
+    values = np.sin(positions[:, 0] * 5) + positions[:, 1]
+    scan = _scan(positions)
+    x, y, z = scan.interpolatedMap(values, 2, origin='lr', method=method)
+    reference = griddata(positions, values, (x, y), method=method)
+    assert np.allclose(z, reference, equal_nan=True)
+    # stacks of maps in one product
+    stack = np.vstack((values, 2 * values)).T
+    assert np.allclose(scan.interpolatedMap(stack, 2, method=method)[2][..., 1], 2 * z,
+                       equal_nan=True)
+
+
+def test_cubic_maps_still_use_griddata():
+    positions = _spiral()
+    values = positions[:, 0] ** 2
+    x, y, z = _scan(positions).interpolatedMap(values, 1, method='cubic')
+    assert np.allclose(z, griddata(positions, values, (x, y), method='cubic'), equal_nan=True)
+
+
+def test_voronoi_raster_approximates_nearest():
+    positions = _spiral(1000)
+    scan = _scan(positions)
+    x, y = scan._mapGrid(3, False)
+    nearest = voronoiRaster(positions, x, y)
+    points = np.vstack((x.ravel(), y.ravel())).T
+    distance, exact = cKDTree(positions).query(points)
+    wrong = nearest.ravel() != exact
+    assert np.mean(wrong) < .01
+    pixel = np.hypot(x[0, 1] - x[0, 0], y[1, 0] - y[0, 0])
+    excess = np.linalg.norm(positions[nearest.ravel()] - points, axis=1) - distance
+    assert np.all(excess <= pixel / 2)
+
+
+def test_map_operators_are_cached():
+    scan = _scan(_spiral())
+    values = np.arange(scan.nPositions, dtype=float)
+    first = scan.mapOperator(1, method='nearest')
+    assert scan.mapOperator(1, method='nearest') is first
+    x, y, operator, outside = first
+    assert np.allclose(scan.interpolatedMap(values, 1)[2], (operator @ values).reshape(x.shape))
+    # only the most recently used operators are kept
+    index = scan.positionIndex
+    for oversampling in range(2, index.maxMaps + 2):
+        scan.mapOperator(oversampling, method='nearest')
+    assert len(index.maps) == index.maxMaps
+    assert scan.mapOperator(1, method='nearest') is not first
+    # new positions need new operators
+    scan.positions = scan.positions + 1
+    assert scan.positionIndex is not index
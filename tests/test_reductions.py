@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import scipy.ndimage
+
+from nmutils.core import reductions, SegmentedDataset, ScaledDataset
+
+
+def _stack(shape=(40, 9, 7), seed=0):
+    return np.random.default_rng(seed).integers(0, 50, size=shape, dtype=np.uint16)
+
+
+@pytest.mark.parametrize('op', ['sum', 'mean', 'max', 'min'])
+@pytest.mark.parametrize('nThreads', [1, 3])
+def test_reduce_matches_numpy(op, nThreads):
+    data = _stack()
+    mask = np.zeros(data.shape[1:], dtype=bool)
+    mask[2:5, 1:6] = True
+    rows = np.array([3, 1, 30, 7])
+    kwargs = {'nThreads': nThreads, 'blockBytes': 500}
+    reference = getattr(np, op)
+    assert np.allclose(reductions.reduce(data, op, 'positions', **kwargs),
+                       reference(data.astype(float), axis=0))
+    assert np.allclose(reductions.reduce(data, op, 'pixels', **kwargs),
+                       reference(data.reshape(len(data), -1).astype(float), axis=1))
+    assert np.allclose(reductions.reduce(data, op, 'pixels', mask=mask, **kwargs),
+                       reference(data[:, mask].astype(float), axis=1))
+    assert np.allclose(reductions.reduce(data, op, 'positions', rows=rows, **kwargs),
+                       reference(data[rows].astype(float), axis=0))
+
+
+def test_reduce_proxies_like_arrays():
+    data = _stack()
+    scale = np.linspace(.5, 2, len(data))
+    segmented = SegmentedDataset([data[:13], data[13:]])
+    scaled = ScaledDataset(data, scale)
+    for op in ('sum', 'mean', 'max'):
+        assert np.allclose(reductions.reduce(segmented, op), reductions.reduce(data, op))
+        assert np.allclose(reductions.reduce(scaled, op, 'pixels'),
+                           reductions.reduce(data * scale[:, None, None], op, 'pixels'))
+    # the numpy functions use the streamed methods
+    assert np.allclose(np.mean(segmented, axis=(1, 2)), np.mean(data, axis=(1, 2)))
+    assert np.allclose(np.sum(scaled, axis=0), np.sum(data * scale[:, None, None], axis=0))
+
+
+def test_unknown_reduction():
+    with pytest.raises(ValueError):
+        reductions.reduce(_stack(), 'median')
+
+
+def test_window_integrals_and_prefix_sums():
+    spectra = np.random.default_rng(1).poisson(3, size=(25, 64)).astype(np.float32)
+    windows = [(0, 10), (5, 6), (60, 80), (30, 30)]
+    reference = np.array([spectra[:, lo:hi].sum(axis=1) for lo, hi in windows]).T
+    counts = np.array([10, 1, 4, 0])
+    assert np.allclose(reductions.roiIntegrals(spectra, windows, blockBytes=300), reference)
+    cs = reductions.prefixSums(spectra, blockBytes=300)
+    assert cs.shape == (25, 65)
+    assert np.allclose(reductions.roiIntegrals(spectra, windows, prefixSums=cs), reference)
+    rows = [4, 2, 20]
+    assert np.allclose(reductions.roiIntegrals(spectra, windows, rows=rows, prefixSums=cs),
+                       reference[rows])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = reference / counts
+    assert np.allclose(reductions.roiIntegrals(spectra, windows, op='mean', prefixSums=cs),
+                       mean, equal_nan=True)
+    assert np.allclose(reductions.roiIntegrals(spectra, windows, op='mean'), mean, equal_nan=True)
+
+
+def test_mask_integrals():
+    data = _stack()
+    masks = [np.zeros(data.shape[1:], dtype=bool) for i in range(3)]
+    masks[0][1:4, 2:5] = True
+    masks[1][:, 0] = True
+    masks[2][8, 6] = True
+    reference = np.array([data[:, m].sum(axis=1) for m in masks]).T
+    for nThreads in (1, 2):
+        result = reductions.roiIntegrals(data, masks, rows=None, nThreads=nThreads, blockBytes=500)
+        assert np.allclose(result, reference)
+    assert np.allclose(reductions.roiIntegrals(data, masks, op='mean'),
+                       reference / [m.sum() for m in masks])
+
+
+def test_center_of_mass_matches_scipy():
+    data = _stack().astype(float)
+    data[5] = 0
+    mask = np.zeros(data.shape[1:], dtype=bool)
+    mask[0, :] = True
+    com = reductions.centerOfMass(data, blockBytes=700)
+    assert np.all(np.isnan(com[5]))
+    for i in (0, 17, 39):
+        assert np.allclose(com[i], scipy.ndimage.center_of_mass(data[i]))
+    masked = reductions.centerOfMass(data, mask=mask, rows=[3, 4])
+    assert np.allclose(masked[0], scipy.ndimage.center_of_mass(np.where(mask, 0, data[3])))
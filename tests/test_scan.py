@@ -0,0 +1,238 @@
+import numpy as np
+import pytest
+
+import nmutils
+from nmutils.core import LazyDataset, SegmentedDataset, ScaledDataset
+from nmutils.utils import fastBinPixels
+
+from conftest import HAS_HDF5PLUGIN
+
+
+def _normalized(f):
+    return f.frames / f.I0[:, None, None]
+
+
+def _xrf(f):
+    # channel 3 without the last 10 bins, as contrast_scan reads it
+    return f.xrf[:, 3, :54]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_lazy_and_eager_loads_agree(contrastFile, lazy):
+    f = contrastFile()
+    scan = f.load(lazy=lazy)
+    assert isinstance(scan.data['m'], LazyDataset) == lazy
+    assert scan.data['m'].dtype == np.uint16
+    assert np.array_equal(np.asarray(scan.data['m']), f.frames)
+    assert np.allclose(scan.positions, np.vstack((f.x, f.y)).T)
+    scan.addData(name='xrf', dataSource='xspress3', path=f.path, scanNr=f.scanNr)
+    assert np.allclose(scan.data['xrf'], _xrf(f))
+
+
+@pytest.mark.skipif(not HAS_HDF5PLUGIN, reason='hdf5plugin is not installed')
+@pytest.mark.parametrize('directChunks', [False, True])
+def test_compressed_frames(contrastFile, directChunks):
+    f = contrastFile()
+    scan = f.load(dataSource='eiger4m', directChunks=directChunks, nWorkers=2)
+    assert np.array_equal(scan.data['m'], f.frames)
+
+
+def test_missing_frames_are_padded(contrastFile):
+    f = contrastFile(missing=3)
+    data = np.asarray(f.load().data['m'])
+    assert data.shape[0] == f.nPositions
+    assert np.array_equal(data[:-3], f.frames)
+    assert np.array_equal(data[-3:], np.broadcast_to(
+        np.around(f.frames.mean(axis=0)).astype(np.uint16), (3,) + f.frames.shape[1:]))
+
+
+@pytest.mark.parametrize('burstOp', ['sum', 'mean', 'max'])
+def test_bursts_match_old_reduction(contrastFile, burstOp):
+    f = contrastFile(bursts=3)
+    data = f.load(burstOp=burstOp).data['m']
+    bursts = f.frames.reshape((f.nPositions, 3) + f.frames.shape[1:])
+    assert np.allclose(data, getattr(np, burstOp)(bursts, axis=1))
+
+
+def test_binning_matches_fast_bin_pixels(contrastFile):
+    f = contrastFile()
+    crop = [2, 14, 1, 11]
+    data = f.load(xrdBinning=2, xrdCropping=crop).data['m']
+    reference = np.array([fastBinPixels(frame[2:14, 1:11], 2) for frame in f.frames])
+    assert data.shape == reference.shape and np.allclose(data, reference)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_I0_normalization(contrastFile, lazy):
+    f = contrastFile()
+    scan = f.load(I0='alba2/1', lazy=lazy)
+    data = scan.data['m']
+    assert isinstance(data, ScaledDataset) and data.dtype == np.float32
+    assert np.allclose(data[:], _normalized(f), rtol=1e-6)
+    raw = data.base
+    # another channel only swaps the scale
+    scan.setI0('alba2/2')
+    assert scan.data['m'].base is raw
+    assert np.allclose(scan.data['m'][:], _normalized(f) / 2, rtol=1e-6)
+    scan.setI0(np.ones(f.nPositions))
+    assert np.allclose(scan.data['m'][:], f.frames)
+    # no I0 gives the raw data back as it was read
+    scan.setI0(None)
+    assert scan.data['m'] is raw and scan.data['m'].dtype == np.uint16
+    assert np.array_equal(np.asarray(scan.data['m']), f.frames)
+
+
+def test_normalize_on_read(contrastFile):
+    f = contrastFile()
+    deferred = f.load(I0='alba2/1')
+    scan = f.load(I0='alba2/1', normalizeOnRead=True)
+    assert isinstance(scan.data['m'], np.ndarray) and scan.data['m'].dtype == np.float32
+    assert np.allclose(scan.data['m'], deferred.data['m'][:])
+    lazy = f.load(I0='alba2/1', normalizeOnRead=True, lazy=True)
+    assert np.allclose(lazy.data['m'][:], deferred.data['m'][:])
+    with pytest.raises(RuntimeError):
+        scan.setI0('alba2/2')
+    with pytest.raises(RuntimeError):
+        scan.setI0(None)
+
+
+def test_data_types(contrastFile):
+    f = contrastFile()
+    assert f.load(I0='alba2/1', dataType='float64').data['m'].dtype == np.float64
+    scan = f.load(dataType='float32')
+    assert scan.data['m'].dtype == np.float32
+    assert np.array_equal(scan.data['m'], f.frames)
+
+
+def test_memory_budget(contrastFile):
+    f = contrastFile()
+    scan = nmutils.core.contrast_scan()
+    scan.productCache = None
+    scan.memoryBudget = f.frames.nbytes // 3
+    opts = dict(name='m', dataSource='merlin', path=f.path, scanNr=f.scanNr)
+    with pytest.raises(nmutils.MemoryBudgetError) as info:
+        scan.addData(**opts)
+    assert isinstance(info.value, MemoryError)
+    assert info.value.suggestions[0] == {'lazy': True}
+    assert 'm' not in scan.data
+    # lazy data fits, and the suggestions can be taken automatically
+    scan.addData(lazy=True, **opts)
+    assert isinstance(scan.data['m'], LazyDataset)
+    scan = nmutils.core.contrast_scan()
+    scan.productCache = None
+    scan.memoryBudget = f.frames.nbytes // 3
+    scan.memoryPolicy = 'adapt'
+    scan.addData(**opts)
+    assert isinstance(scan.data['m'], LazyDataset) and scan._loadOptions['m']['lazy']
+    # bursts can't be read lazily, so smaller frames are read instead
+    f = contrastFile(scanNr=2, bursts=2)
+    scan.memoryBudget = f.frames.nbytes // 2
+    scan.addData(name='b', dataSource='merlin', path=f.path, scanNr=f.scanNr)
+    assert not scan._loadOptions['b'].get('lazy')
+    assert isinstance(scan.data['b'], np.ndarray)
+    assert np.prod(scan.data['b'].shape[1:]) < np.prod(f.frames.shape[1:])
+    scan.memoryPolicy = 'other'
+    with pytest.raises(ValueError):
+        scan.addData(name='c', dataSource='merlin', path=f.path, scanNr=f.scanNr)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_refresh(contrastFile, lazy):
+    f = contrastFile(growable=True)
+    f.resize(20)
+    opts = dict(I0='alba2/1', lazy=lazy)
+    scan = f.load(**opts)
+    scan.addData(name='xrf', dataSource='xspress3', path=f.path, scanNr=f.scanNr, I0='alba2/1')
+    assert scan.nPositions == 20 and scan.refresh() == 0
+    f.resize(35)
+    assert scan.refresh() == 15
+    f.resize(f.nPositions)
+    assert scan.refresh() == f.nPositions - 35
+    fresh = f.load(**opts)
+    assert np.allclose(scan.positions, fresh.positions)
+    assert np.allclose(scan.data['m'][:], fresh.data['m'][:])
+    assert np.allclose(scan.data['xrf'][:], _xrf(f) / f.I0[:, None])
+    scan.setI0(None)
+    assert np.array_equal(np.asarray(scan.data['m']), f.frames)
+    # merged scans can't be refreshed
+    fresh.merge(fresh.copy())
+    with pytest.raises(RuntimeError):
+        fresh.refresh()
+
+
+def test_copies_share_data_read_only(contrastFile):
+    f = contrastFile()
+    scan = f.load(I0='alba2/1')
+    scan.addData(name='xrf', dataSource='xspress3', path=f.path, scanNr=f.scanNr)
+    other = scan.copy()
+    assert other.data['xrf'] is scan.data['xrf'] and other.positions is scan.positions
+    for s in (scan, other):
+        with pytest.raises(ValueError):
+            s.data['xrf'][0] = 0
+        with pytest.raises(ValueError):
+            s.data['m'].base[0] = 0
+    other.ownData()
+    other.data['xrf'][0] = 0
+    other.data['m'].base[0] = 0
+    other.positions[0] = 0
+    assert np.allclose(scan.data['xrf'], _xrf(f))
+    assert np.allclose(scan.data['m'][:], _normalized(f), rtol=1e-6)
+    assert isinstance(other.data['m'], ScaledDataset) and other.data['m'].dtype == np.float32
+    empty = scan.copy(data=False)
+    assert empty.positions is None and empty.data == {'m': None, 'xrf': None}
+
+
+def test_merge_and_consolidate(contrastFile):
+    a = contrastFile(scanNr=1, seed=1)
+    b = contrastFile(scanNr=2, seed=2)
+    scan = a.load(I0='alba2/1')
+    other = b.load(I0='alba2/1')
+    scan.merge(other)
+    reference = np.concatenate((_normalized(a), _normalized(b)))
+    assert scan.nPositions == a.nPositions + b.nPositions
+    assert isinstance(scan.data['m'], SegmentedDataset)
+    assert np.allclose(scan.data['m'][:], reference, rtol=1e-6)
+    assert scan.data['m'].segments[1] is other.data['m']
+    scan.consolidate()
+    assert isinstance(scan.data['m'], ScaledDataset)
+    assert isinstance(scan.data['m'].base, np.ndarray)
+    assert np.allclose(scan.data['m'][:], reference, rtol=1e-6)
+    scan.setI0(None)
+    assert np.array_equal(scan.data['m'], np.concatenate((a.frames, b.frames)))
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_subset(contrastFile, lazy):
+    f = contrastFile()
+    scan = f.load(lazy=lazy)
+    posRange = np.array([[.15, .3], [.45, .7]])
+    rows = np.flatnonzero((f.x >= .15) & (f.x <= .45) & (f.y >= .3) & (f.y <= .7))
+    sub = scan.subset(posRange)
+    assert len(rows) and sub.nPositions == len(rows)
+    assert np.array_equal(np.asarray(sub.data['m']), f.frames[rows])
+    # the same with the position index built
+    scan.positionIndex
+    assert np.array_equal(scan.subset(posRange).positions, sub.positions)
+    closest = scan.subset(np.array([[5, 5], [6, 6]]), closest=True)
+    assert closest.nPositions == 1 and np.argmax(f.x + f.y) in \
+        np.flatnonzero(np.all(scan.positions == closest.positions[0], axis=1))
+    assert scan.subset(np.array([[5, 5], [6, 6]])).nPositions == 0
+
+
+def test_scan_reductions(contrastFile):
+    f = contrastFile()
+    scan = f.load(I0='alba2/1')
+    reference = _normalized(f)
+    assert np.allclose(scan.meanData('m'), reference.mean(axis=0), rtol=1e-5)
+    assert np.allclose(scan.reduceData('m', 'sum', over='pixels'), reference.sum(axis=(1, 2)),
+                       rtol=1e-5)
+    mask = np.zeros(f.frames.shape[1:], dtype=bool)
+    mask[3:9, 2:5] = True
+    assert np.allclose(scan.roiIntegrals('m', [mask])[:, 0], reference[:, mask].sum(axis=1),
+                       rtol=1e-5)
+    scan.addData(name='xrf', dataSource='xspress3', path=f.path, scanNr=f.scanNr)
+    windows = [(0, 10), (20, 54)]
+    sums = np.array([_xrf(f)[:, lo:hi].sum(axis=1) for lo, hi in windows]).T
+    assert np.allclose(scan.roiIntegrals('xrf', windows), sums)
+    scan.prefixSums('xrf')
+    assert np.allclose(scan.roiIntegrals('xrf', windows), sums)